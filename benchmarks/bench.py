@@ -0,0 +1,377 @@
+"""
+Benchmarks of cenv on synthetic sheets, with a local stand-in for the Sheets API.
+
+Scenarios:
+    sheet_to_map   converting downloaded rows into a snapshot
+    lookup         reading a stored snapshot and getting values from it, per store format
+    inject         rendering a generated template against stored snapshots
+    startup        'cenv get' served from the store in a new process, cold (empty bytecode cache) and warm
+    network        downloading a sheet and prefetching a template through the local Sheets stand-in
+
+The results are written as JSON, so they can be compared between releases.
+
+Usage: python benchmarks/bench.py [--rows 1000,10000] [--envs 1,10] [--template-lines 100,1000]
+                                  [--latency-ms 50] [--repeat 5] [--scenarios sheet_to_map,lookup]
+                                  [--output bench.json]
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+from urllib.parse import parse_qs, unquote, urlparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SPREADSHEET_ID = "bench_spreadsheet"
+SHEET = "Bench"
+MODIFIED_TIME = "2024-01-01T00:00:00.000Z"
+
+# The store lives in a temporary directory, cenv reads its configuration when it's imported
+WORK_DIR = tempfile.mkdtemp(prefix="cenv-bench-")
+CENV_ENV = {
+    "CENV_GOOGLE_CREDENTIAL_BASE64": "e30=",
+    "CENV_GOOGLE_SHEET_ID": SPREADSHEET_ID,
+    "CENV_STORE_CONFIG_FILE": os.path.join(WORK_DIR, "config.json"),
+    "CENV_STORE_MAX_ENTRIES": "1024",
+    "CENV_STORE_MAX_BYTES": str(16 * 1024 ** 3),
+    "CENV_SOCKET": "",
+}
+os.environ.update(CENV_ENV)
+sys.path.insert(0, ROOT)
+
+import cenv  # noqa: E402
+from cenv import configs  # noqa: E402
+
+SCENARIOS = ["sheet_to_map", "lookup", "inject", "startup", "network"]
+
+
+# ------------------------------------------------------------
+# SYNTHETIC DATA
+# ------------------------------------------------------------
+
+def env_names(envs: int) -> list[str]:
+    return [f"env_{i}" for i in range(envs)]
+
+
+def generate_sheet(rows: int, envs: int, names_per_category: int = 20) -> list[list[str]]:
+    """Rows of a sheet with a header, Category and Name columns and one value column per env."""
+    sheet = [["Category", "Name", *env_names(envs)]]
+    for i in range(rows):
+        category, name = divmod(i, names_per_category)
+        sheet.append([f"Category{category}", f"Name{name}", *(f"value-{i}-{env}" for env in range(envs))])
+    return sheet
+
+
+def sheet_keys(rows: int, names_per_category: int = 20) -> list[tuple[str, str]]:
+    return [(f"Category{i // names_per_category}", f"Name{i % names_per_category}") for i in range(rows)]
+
+
+def generate_template(lines: int, rows: int, env: str, seed: int = 0) -> str:
+    """A .env template of cenv:// lookups with some variables and comments, like real templates."""
+    rnd = random.Random(seed)
+    keys = sheet_keys(rows)
+    output = [f"SHEET={SHEET}", f"ENV={env}", "# generated by benchmarks/bench.py"]
+    for i in range(lines):
+        category, name = rnd.choice(keys)
+        if i % 10 == 0:
+            output.append(f'VALUE_{i}="cenv://$SHEET/${{ENV}}/{category}/{name}" # quoted')
+        else:
+            output.append(f"VALUE_{i}=cenv://$SHEET/$ENV/{category}/{name}")
+    return "\n".join(output) + "\n"
+
+
+# ------------------------------------------------------------
+# SHEETS API STAND-IN
+# ------------------------------------------------------------
+
+def column_index(letters: str) -> int:
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - ord("A") + 1
+    return index - 1
+
+
+def parse_range(a1: str) -> tuple[str, str | None]:
+    """Splits an A1 range into the sheet name and the cell range."""
+    if a1.startswith("'"):
+        end = a1.index("'!") if "'!" in a1 else len(a1) - 1
+        return a1[1:end].replace("''", "'"), a1[end + 2:] or None
+    sheet, _, cells = a1.partition("!")
+    return sheet, cells or None
+
+
+def range_values(sheet: list[list[str]], cells: str | None) -> list[list[str]]:
+    """Values of a whole sheet, rows like 1:1 or columns like A:B, as returned by the Sheets API."""
+    if cells is None:
+        return sheet
+    first, last = cells.split(":")
+    if first.isdigit():
+        return sheet[int(first) - 1:int(last)]
+
+    start, stop = column_index(first), column_index(last) + 1
+    values = [row[start:stop] for row in sheet]
+    while values and not values[-1]:
+        values.pop()
+    return values
+
+
+class SheetsStandIn:
+    """Serves the Sheets values endpoints and the Drive modifiedTime from memory, after a configurable latency."""
+
+    def __init__(self, sheets: dict[str, list[list[str]]], latency: float = 0.0):
+        self.sheets = sheets
+        self.latency = latency
+        self.requests = 0
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                stand_in.requests += 1
+                time.sleep(stand_in.latency)
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                if url.path.startswith("/drive/v3/files/"):
+                    body = {"modifiedTime": MODIFIED_TIME}
+                elif url.path.endswith("/values:batchGet"):
+                    body = {"spreadsheetId": SPREADSHEET_ID,
+                            "valueRanges": [stand_in.value_range(a1) for a1 in query.get("ranges", [])]}
+                elif "/values/" in url.path:
+                    body = stand_in.value_range(unquote(url.path.split("/values/", 1)[1]))
+                else:
+                    self.send_error(404)
+                    return
+
+                content = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def value_range(self, a1: str) -> dict:
+        sheet, cells = parse_range(a1)
+        return {"range": a1, "majorDimension": "ROWS", "values": range_values(self.sheets.get(sheet, []), cells)}
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def use_stand_in(stand_in: SheetsStandIn):
+    """Routes cenv's Google API requests to the stand-in, with anonymous credentials."""
+    import httplib2
+    from google.auth.credentials import AnonymousCredentials
+
+    class StandInHttp(httplib2.Http):
+        def request(self, uri, *args, **kwargs):
+            for prefix in ("https://sheets.googleapis.com", "https://www.googleapis.com"):
+                if uri.startswith(prefix):
+                    uri = stand_in.url + uri[len(prefix):]
+            return super().request(uri, *args, **kwargs)
+
+    cenv.http_local.__dict__.clear()
+    cenv.sheets_service = None
+    patches = [patch("httplib2.Http", StandInHttp), patch.object(cenv, "google_credentials", AnonymousCredentials())]
+    for patcher in patches:
+        patcher.start()
+    return patches
+
+
+# ------------------------------------------------------------
+# SCENARIOS
+# ------------------------------------------------------------
+
+def measure(function, repeat: int, setup=None) -> dict:
+    """Runs the function repeat times, the setup isn't timed."""
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return {
+        "repeat": repeat,
+        "min": min(timings),
+        "median": statistics.median(timings),
+        "mean": statistics.mean(timings),
+        "max": max(timings),
+    }
+
+
+def store_sheet(sheet: list[list[str]], envs: list[str]):
+    for env in envs:
+        cenv.save_to_file(cenv.stamp_snapshot(cenv.sheet_to_map(sheet, SHEET, env), sheet, MODIFIED_TIME))
+
+
+def bench_sheet_to_map(args, results):
+    for rows in args.rows:
+        for envs in args.envs:
+            sheet = generate_sheet(rows, envs)
+            env = env_names(envs)[-1]
+            timing = measure(lambda: cenv.sheet_to_map(sheet, SHEET, env), args.repeat)
+            results.append({"scenario": "sheet_to_map", "rows": rows, "envs": envs, **timing})
+
+
+def bench_lookup(args, results):
+    lookups = 1000
+    for store_format in cenv.SnapshotStore.SUFFIXES:
+        with patch.object(configs, "STORE_FORMAT", store_format):
+            for rows in args.rows:
+                cenv.delete_file()
+                store_sheet(generate_sheet(rows, 1), ["env_0"])
+                keys = random.Random(0).choices(sheet_keys(rows), k=lookups)
+
+                def lookup():
+                    data = cenv.get_file_content(SHEET, "env_0")
+                    for category, name in keys:
+                        cenv.get_value(data, category, name)
+
+                timing = measure(lookup, args.repeat)
+                results.append({"scenario": "lookup", "format": store_format, "rows": rows, "lookups": lookups,
+                                **timing})
+
+
+def bench_inject(args, results):
+    template_path = os.path.join(WORK_DIR, "bench.template")
+    for rows in args.rows:
+        cenv.delete_file()
+        store_sheet(generate_sheet(rows, 1), ["env_0"])
+        for lines in args.template_lines:
+            with open(template_path, "w") as f:
+                f.write(generate_template(lines, rows, "env_0"))
+
+            def inject():
+                cenv.prefetch_cenv_urls(cenv.collect_template_cenv_urls(template_path, False))
+                for _ in cenv.render_template(template_path, False):
+                    pass
+
+            timing = measure(inject, args.repeat)
+            results.append({"scenario": "inject", "rows": rows, "template_lines": lines, **timing})
+
+
+def bench_startup(args, results):
+    cenv.delete_file()
+    store_sheet(generate_sheet(args.rows[0], 1), ["env_0"])
+    category, name = sheet_keys(args.rows[0])[0]
+    command = [sys.executable, os.path.join(ROOT, "cenv.py"), "get", "--sheet", SHEET, "--env", "env_0",
+               "--category", category, "--name", name]
+    pycache = os.path.join(WORK_DIR, "pycache")
+    env = {**os.environ, **CENV_ENV, "PYTHONPYCACHEPREFIX": pycache}
+
+    def run():
+        subprocess.run(command, env=env, check=True, capture_output=True)
+
+    results.append({"scenario": "startup", "cache": "cold", "rows": args.rows[0],
+                    **measure(run, args.repeat, setup=lambda: shutil.rmtree(pycache, ignore_errors=True))})
+    run()
+    results.append({"scenario": "startup", "cache": "warm", "rows": args.rows[0], **measure(run, args.repeat)})
+
+
+def bench_network(args, results):
+    template_path = os.path.join(WORK_DIR, "network.template")
+    for rows in args.rows:
+        for envs in args.envs:
+            sheets = {SHEET: generate_sheet(rows, envs)}
+            env = env_names(envs)[-1]
+            with open(template_path, "w") as f:
+                f.write(generate_template(args.template_lines[0], rows, env))
+
+            with SheetsStandIn(sheets, args.latency_ms / 1000) as stand_in:
+                patches = use_stand_in(stand_in)
+                try:
+                    # every run starts from an empty store, the header row is downloaded before the env column
+                    stand_in.requests = 0
+                    timing = measure(lambda: cenv.load_file_and_save(SHEET, env), args.repeat, setup=cenv.delete_file)
+                    results.append({"scenario": "network", "operation": "load", "rows": rows, "envs": envs,
+                                    "latency_ms": args.latency_ms, "requests": stand_in.requests / args.repeat,
+                                    **timing})
+
+                    stand_in.requests = 0
+                    timing = measure(
+                        lambda: cenv.prefetch_cenv_urls(cenv.collect_template_cenv_urls(template_path, False)),
+                        args.repeat, setup=cenv.delete_file
+                    )
+                    results.append({"scenario": "network", "operation": "prefetch", "rows": rows, "envs": envs,
+                                    "template_lines": args.template_lines[0], "latency_ms": args.latency_ms,
+                                    "requests": stand_in.requests / args.repeat, **timing})
+                finally:
+                    for patcher in patches:
+                        patcher.stop()
+
+
+def int_list(value: str) -> list[int]:
+    return [int(item) for item in value.split(",") if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of cenv on synthetic sheets.")
+    parser.add_argument("--rows", type=int_list, default=[1000, 10000, 100000],
+                        help="Sheet sizes in rows, up to 1000000")
+    parser.add_argument("--envs", type=int_list, default=[1, 10], help="Numbers of env columns, up to 50")
+    parser.add_argument("--template-lines", type=int_list, default=[100, 1000], help="Template sizes in lines")
+    parser.add_argument("--latency-ms", type=float, default=50, help="Latency of the Sheets stand-in")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per measurement")
+    parser.add_argument("--scenarios", type=lambda value: value.split(","), default=SCENARIOS,
+                        help=f"Scenarios to run, among: {', '.join(SCENARIOS)}")
+    parser.add_argument("--output", "-o", type=str, help="Write the results to this file instead of stdout")
+    args = parser.parse_args()
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+    results = []
+    try:
+        for scenario in args.scenarios:
+            print(f"Running {scenario}...", file=sys.stderr)
+            globals()[f"bench_{scenario}"](args, results)
+    finally:
+        cenv.delete_file()
+
+    report = {
+        "cenv_version": cenv.project_version,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "parameters": {
+            "rows": args.rows,
+            "envs": args.envs,
+            "template_lines": args.template_lines,
+            "latency_ms": args.latency_ms,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+        print(f"Results written to {args.output}.", file=sys.stderr)
+    else:
+        print(json.dumps(report, indent=4))
+
+
+if __name__ == "__main__":
+    main()
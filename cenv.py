@@ -1,29 +1,37 @@
 import argparse
+import array
+import atexit
 import base64
 import configparser
+import contextlib
+import functools
+import hashlib
 import json
+import mmap
 import os
 import pickle
 import pkgutil
+import random
+import shutil
+import socket
+import stat
+import struct
 import sys
 import platform
+import threading
+import time
 import zlib
 
 from enum import Enum
 from sys import exit
 
-import requests
 import subprocess
 import re
 
-import yaml
 from dotenv import load_dotenv
-from google.oauth2.service_account import Credentials
-from google_auth_httplib2 import Request
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
-from google_auth_oauthlib.flow import InstalledAppFlow
-import httplib2
+
+# The Google, requests and YAML stacks are imported by the functions that use them,
+# so commands served from the local snapshot store start without loading them
 
 load_dotenv()
 
@@ -100,6 +108,68 @@ def ensure_directory_exists(directory):
         os.makedirs(directory, exist_ok=True)
 
 
+@contextlib.contextmanager
+def open_atomic(path: str, mode: int | None = None, text: bool = False):
+    """
+    Opens a temp file next to the path, renamed into place once the block succeeds,
+    so readers never see the file half-written. The temp file is removed on failure.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_path, 'w' if text else 'wb') as f:
+            if mode is not None:
+                os.chmod(temp_path, mode)
+            yield f
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def write_file_atomic(path: str, data: bytes, mode: int | None = None):
+    """Writes the file through a temp file renamed into place, so readers never see it half-written."""
+    with open_atomic(path, mode) as f:
+        f.write(data)
+
+
+@contextlib.contextmanager
+def file_lock(path: str):
+    """
+    Holds an exclusive lock on the lock file for the block, across processes and threads.
+    The lock is released by the OS when its holder dies.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'a+b') as f:
+        if platform.system() == "Windows":
+            import msvcrt
+            while True:
+                f.seek(0)
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK gives up after 10 seconds
+                    continue
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
 def update_add_to_path_if_needed(directory):
     """Adds the specified directory to PATH if not already included."""
     path = os.environ["PATH"]
@@ -109,45 +179,141 @@ def update_add_to_path_if_needed(directory):
         print("You may need to restart your terminal for changes to take effect.")
 
 
-def update_get_latest_release_url():
-    """Fetches the latest release URL from GitHub API for the platform."""
+# Big chunks keep the download loop out of the way of the network
+UPDATE_CHUNK_SIZE = 1024 * 1024
+
+
+def parse_version(version: str) -> tuple[int, ...]:
+    """Parses "v1.8.1" or "1.8.1" into a comparable tuple, non-numeric parts are ignored."""
+    return tuple(int(part) for part in re.findall(r"\d+", version.split("-", 1)[0]))
+
+
+def update_get_latest_release() -> dict:
+    """
+    Fetches the latest release from GitHub API. The release is cached with its ETag,
+    so an unchanged release costs a 304 without a body (which doesn't count against the API rate limit).
+    """
+    import requests
+
+    try:
+        with open(configs.RELEASE_CACHE_FILE, 'r') as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        cached = {}
+
     api_url = f"https://api.github.com/repos/{project_owner}/{project_repository}/releases/latest"
-    response = requests.get(api_url)
+    headers = {"Accept": "application/vnd.github+json"}
+    if cached.get("etag") and cached.get("release"):
+        headers["If-None-Match"] = cached["etag"]
+    response = requests.get(api_url, headers=headers, timeout=30)
+    if response.status_code == 304:
+        return cached["release"]
     response.raise_for_status()  # Ensure we got a valid response
-    release_info = response.json()
-    for asset in release_info["assets"]:
-        if update_filename in asset["name"]:
-            return asset["browser_download_url"]
+
+    release = response.json()
+    if response.headers.get("ETag"):
+        write_file_atomic(configs.RELEASE_CACHE_FILE,
+                          json.dumps({"etag": response.headers["ETag"], "release": release}).encode())
+    return release
+
+
+def update_find_asset(release: dict) -> dict | None:
+    """Returns the release asset of the platform."""
+    for asset in release.get("assets", []):
+        if update_filename in asset["name"] and not asset["name"].endswith(".sha256"):
+            return asset
+    return None
+
+
+def update_asset_sha256(release: dict, asset: dict) -> str | None:
+    """Returns the sha256 of the asset, from the digest GitHub computes or from a published NAME.sha256 file."""
+    digest = asset.get("digest") or ""
+    if digest.startswith("sha256:"):
+        return digest[len("sha256:"):].lower()
+
+    import requests
+
+    for checksum_asset in release.get("assets", []):
+        if checksum_asset["name"] == asset["name"] + ".sha256":
+            response = requests.get(checksum_asset["browser_download_url"], timeout=30)
+            response.raise_for_status()
+            return response.text.split()[0].lower()
     return None
 
 
-def update_download_binary(url, dest_path):
-    """Downloads the binary and saves it to the destination path."""
-    response = requests.get(url, stream=True)
-    response.raise_for_status()
-    with open(dest_path, "wb") as file:
-        for chunk in response.iter_content(chunk_size=8192):
-            file.write(chunk)
+def update_file_sha256(path: str):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(UPDATE_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256
 
 
-def update_cenv_command():
-    """Updates the cenv tool by downloading and replacing the binary."""
+def update_download_binary(url, dest_path, expected_sha256: str | None = None):
+    """
+    Downloads the binary to the destination path. A partial file left by an interrupted download is
+    resumed with an HTTP Range request, the sha256 is computed while streaming and checked at the end.
+    Without a sha256 to check, the partial file could be a prefix of another release, so it's downloaded again.
+    """
+    import requests
+
+    offset = os.path.getsize(dest_path) if os.path.exists(dest_path) and expected_sha256 is not None else 0
+    if offset and expected_sha256 is not None and update_file_sha256(dest_path).hexdigest() == expected_sha256:
+        # downloaded before, but not installed
+        return
+
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    with requests.get(url, stream=True, headers=headers, timeout=60) as response:
+        if response.status_code == 416:
+            # the partial file isn't a prefix of this binary, it's downloaded again
+            os.remove(dest_path)
+            return update_download_binary(url, dest_path, expected_sha256)
+        response.raise_for_status()
+
+        if response.status_code == 206:
+            print(f"Resuming the download at {offset} bytes...")
+            sha256 = update_file_sha256(dest_path)
+        else:
+            sha256 = hashlib.sha256()
+        with open(dest_path, "ab" if response.status_code == 206 else "wb") as file:
+            for chunk in response.iter_content(chunk_size=UPDATE_CHUNK_SIZE):
+                sha256.update(chunk)
+                file.write(chunk)
+
+    if expected_sha256 is not None and sha256.hexdigest() != expected_sha256:
+        # a corrupted file isn't resumed next time
+        os.remove(dest_path)
+        raise CenvError(f"The downloaded binary doesn't match its sha256 {expected_sha256}, update aborted.")
+
+
+def update_cenv_command(force: bool = False):
+    """Updates the cenv tool by downloading and replacing the binary, unless it's already the latest version."""
 
     ensure_directory_exists(update_install_dir)
 
-    download_url = update_get_latest_release_url()
-    if not download_url:
+    release = update_get_latest_release()
+    latest_version = release.get("tag_name", "")
+    if not force and latest_version and parse_version(latest_version) <= parse_version(project_version):
+        print(f"cenv {project_version} is already the latest version.")
+        return
+
+    asset = update_find_asset(release)
+    if not asset:
         print(f"No download URL found for platform '{update_filename}', update aborted.")
         return
+    download_url = asset["browser_download_url"]
+    expected_sha256 = update_asset_sha256(release, asset)
+    if expected_sha256 is None:
+        print("No sha256 published for the binary, it can't be verified.")
 
-    print(f"Downloading latest version of cenv from {download_url}...")
+    print(f"Downloading cenv {latest_version} from {download_url}...")
     dest_path = os.path.join(update_install_dir, "cenv" + (".exe" if platform.system() == "Windows" else ""))
     temp_path = dest_path + ".new"
 
     if platform.system() == "Windows":
         update_add_to_path_if_needed(update_install_dir)
 
-    update_download_binary(download_url, temp_path)
+    update_download_binary(download_url, temp_path, expected_sha256)
 
     # Make the binary executable (if not Windows)
     if platform.system() != "Windows":
@@ -213,15 +379,53 @@ ENV_CENV_GOOGLE_SHEET_ID = "CENV_GOOGLE_SHEET_ID"
 ENV_CENV_GOOGLE_SHEET_NAME = "CENV_GOOGLE_SHEET_NAME"
 ENV_CENV_STORE_CONFIG_FILE = "CENV_STORE_CONFIG_FILE"
 ENV_CENV_TOKEN = "CENV_TOKEN"
+ENV_CENV_STORE_MAX_ENTRIES = "CENV_STORE_MAX_ENTRIES"
+ENV_CENV_STORE_MAX_BYTES = "CENV_STORE_MAX_BYTES"
+ENV_CENV_STORE_FORMAT = "CENV_STORE_FORMAT"
+ENV_CENV_SOCKET = "CENV_SOCKET"
+ENV_CENV_MAX_AGE = "CENV_MAX_AGE"
+ENV_CENV_STALE_WHILE_REVALIDATE = "CENV_STALE_WHILE_REVALIDATE"
+ENV_CENV_BUNDLE = "CENV_BUNDLE"
+ENV_CENV_OFFLINE = "CENV_OFFLINE"
+ENV_CENV_TRACE = "CENV_TRACE"
+ENV_CENV_TRACE_FORMAT = "CENV_TRACE_FORMAT"
+ENV_CENV_RATE_LIMIT = "CENV_RATE_LIMIT"
+ENV_CENV_MAX_RETRIES = "CENV_MAX_RETRIES"
+ENV_CENV_SPREADSHEETS = "CENV_SPREADSHEETS"
+
+
+def parse_spreadsheet_aliases(value: str) -> dict[str, str]:
+    aliases = {}
+    for item in value.split(","):
+        alias, _, spreadsheet_id = item.partition("=")
+        if alias.strip() and spreadsheet_id.strip():
+            aliases[alias.strip()] = spreadsheet_id.strip()
+    return aliases
 
 
 class Configs:
     GOOGLE_CREDENTIAL_BASE64: str
     GOOGLE_SHEET_ID: str
     GOOGLE_SHEET_NAME: str
+    SPREADSHEETS: dict[str, str]
     CONFIG_FILE: str
+    STORE_MAX_ENTRIES: int
+    STORE_MAX_BYTES: int
+    STORE_FORMAT: str
+    SOCKET_FILE: str
+    MAX_AGE: int | None
+    STALE_WHILE_REVALIDATE: int
+    BUNDLE: str | None
+    OFFLINE: bool
+    TRACE: str | None
+    TRACE_FORMAT: str | None
+    RATE_LIMIT: int
+    MAX_RETRIES: int
     SCOPES: list[str]
     USER_TOKEN_FILE: str
+    ACCESS_TOKEN_FILE: str
+    RATE_LIMIT_FILE: str
+    RELEASE_CACHE_FILE: str
     TOKEN_VALUE: str
 
     def __init__(self):
@@ -232,15 +436,177 @@ class Configs:
         self.GOOGLE_CREDENTIAL_BASE64 = os.getenv(ENV_CENV_GOOGLE_CREDENTIAL_BASE64, token.google_cred_base64)
         self.GOOGLE_SHEET_ID = os.getenv(ENV_CENV_GOOGLE_SHEET_ID, token.google_sheet_id)
         self.GOOGLE_SHEET_NAME = os.getenv(ENV_CENV_GOOGLE_SHEET_NAME, token.google_sheet_name or "Env")
+        # aliases of other spreadsheets for cenv://ALIAS@SHEET/ENV/CATEGORY/NAME, as "alias=id,alias=id"
+        self.SPREADSHEETS = parse_spreadsheet_aliases(os.getenv(ENV_CENV_SPREADSHEETS, ""))
         self.CONFIG_FILE = os.getenv(ENV_CENV_STORE_CONFIG_FILE, token.store_config_file or "./cenv_config.json")
-        self.SCOPES = ["https://www.googleapis.com/auth/spreadsheets.readonly"]
+        self.STORE_MAX_ENTRIES = int(os.getenv(ENV_CENV_STORE_MAX_ENTRIES, "32"))
+        self.STORE_MAX_BYTES = int(os.getenv(ENV_CENV_STORE_MAX_BYTES, str(64 * 1024 * 1024)))
+        self.STORE_FORMAT = os.getenv(ENV_CENV_STORE_FORMAT, "json")
+        # snapshots never expire unless a max age is set
+        max_age = os.getenv(ENV_CENV_MAX_AGE)
+        self.MAX_AGE = int(max_age) if max_age else None
+        self.STALE_WHILE_REVALIDATE = int(os.getenv(ENV_CENV_STALE_WHILE_REVALIDATE, "0"))
+        # values are only resolved from the bundle, or from the stored snapshots when offline
+        self.BUNDLE = normalize_path(os.getenv(ENV_CENV_BUNDLE)) if os.getenv(ENV_CENV_BUNDLE) else None
+        self.OFFLINE = os.getenv(ENV_CENV_OFFLINE, "").lower() in ("1", "true", "yes")
+        # spans are written to this file, as JSON lines or in Chrome trace format for *.json files
+        self.TRACE = os.getenv(ENV_CENV_TRACE) or None
+        self.TRACE_FORMAT = os.getenv(ENV_CENV_TRACE_FORMAT) or None
+        # Sheets requests per minute shared by the local processes, 0 disables the budget
+        self.RATE_LIMIT = int(os.getenv(ENV_CENV_RATE_LIMIT, "0"))
+        self.MAX_RETRIES = int(os.getenv(ENV_CENV_MAX_RETRIES, "5"))
+        self.SCOPES = [
+            "https://www.googleapis.com/auth/spreadsheets.readonly",
+            # the spreadsheet's modifiedTime is the cheap change signal of the snapshot revalidation
+            "https://www.googleapis.com/auth/drive.metadata.readonly"
+        ]
         self.USER_TOKEN_FILE = normalize_path("~/.cenv/.token")
-        ensure_directory_exists(os.path.dirname(self.USER_TOKEN_FILE))
+        self.ACCESS_TOKEN_FILE = normalize_path("~/.cenv/access_tokens.json")
+        self.RATE_LIMIT_FILE = normalize_path("~/.cenv/rate_limit.json")
+        self.RELEASE_CACHE_FILE = normalize_path("~/.cenv/latest_release.json")
+        # an empty value disables the 'cenv serve' daemon lookups
+        self.SOCKET_FILE = os.getenv(ENV_CENV_SOCKET, normalize_path("~/.cenv/cenv.sock"))
 
 
 configs = Configs()
 
 
+def is_offline() -> bool:
+    """Whether nothing is downloaded, a bundle implies it."""
+    return configs.OFFLINE or configs.BUNDLE is not None
+
+
+# ------------------------------------------------------------
+# TRACING
+# ------------------------------------------------------------
+
+TRACE_FORMATS = ["jsonl", "chrome"]
+
+
+class Span:
+    """A timed phase, its attributes can be completed while it runs."""
+
+    __slots__ = ("name", "attributes")
+
+    def __init__(self, name: str, attributes: dict):
+        self.name = name
+        self.attributes = attributes
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+
+class Tracer:
+    """Writes the spans to a file, as JSON lines when they end or in Chrome trace format when the process exits."""
+
+    def __init__(self, path: str, fmt: str):
+        if fmt not in TRACE_FORMATS:
+            raise CenvError(f"Unknown trace format '{fmt}', expect one of: {', '.join(TRACE_FORMATS)}.")
+        self.path = path
+        self.format = fmt
+        self.events = []
+        self.lock = threading.Lock()
+        if fmt == "chrome":
+            atexit.register(self.flush)
+
+    def record(self, span: Span, start: float, duration: float):
+        if self.format == "chrome":
+            with self.lock:
+                self.events.append({
+                    "name": span.name, "ph": "X", "ts": start * 1e6, "dur": duration * 1e6,
+                    "pid": os.getpid(), "tid": threading.get_ident(), "args": span.attributes
+                })
+            return
+
+        # Appended line by line, so the processes of a pipeline can share the file
+        line = json.dumps({
+            "name": span.name, "start": start, "duration_ms": duration * 1000,
+            "pid": os.getpid(), "thread": threading.get_ident(), "attributes": span.attributes
+        }, default=str)
+        with self.lock, open(self.path, "a") as f:
+            f.write(line + "\n")
+
+    def flush(self):
+        with self.lock:
+            events = list(self.events)
+        write_file_atomic(self.path, json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}, default=str).encode())
+
+
+# Created on the first span once CENV_TRACE is set
+tracer = None
+
+
+def get_tracer() -> Tracer | None:
+    global tracer
+    if tracer is None and configs.TRACE:
+        fmt = configs.TRACE_FORMAT or ("chrome" if configs.TRACE.endswith(".json") else "jsonl")
+        tracer = Tracer(configs.TRACE, fmt)
+    return tracer
+
+
+@contextlib.contextmanager
+def trace_span(name: str, **attributes):
+    """Times the block as a span with the attributes, nothing is recorded unless tracing."""
+    span = Span(name, attributes)
+    current = get_tracer()
+    if current is None:
+        yield span
+        return
+
+    start = time.time()
+    started = time.perf_counter()
+    try:
+        yield span
+    except BaseException as err:
+        span.set(error=type(err).__name__)
+        raise
+    finally:
+        current.record(span, start, time.perf_counter() - started)
+
+
+def traced(name: str, attributes=None):
+    """Decorates a function to run in a span, the attributes are computed from its arguments."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if get_tracer() is None:
+                return function(*args, **kwargs)
+            with trace_span(name, **(attributes(*args, **kwargs) if attributes else {})):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class CenvError(Exception):
+    """Raised when a value can't be resolved, the message is printed by the command line."""
+    pass
+
+
+class CenvURLError(CenvError, ValueError):
+    """Raised for a malformed cenv:// URL."""
+    pass
+
+
+class CenvTemplateError(CenvError, ValueError):
+    """Raised for a template line that can't be parsed."""
+    pass
+
+
+class CenvNotFoundError(CenvError, LookupError):
+    """Raised when the sheet, category or name of a cenv:// URL doesn't exist."""
+    pass
+
+
+class CenvAuthError(CenvError):
+    """Raised when the Google credentials are missing or invalid."""
+    pass
+
+
+class CenvFetchError(CenvError):
+    """Raised when the Google API request fails."""
+    pass
+
+
 class Base64CredentialStatus(Enum):
     EMPTY = "empty"
     OK = "ok"
@@ -258,61 +624,599 @@ def get_base64_credentials_status(base64_credentials: str) -> Base64CredentialSt
             return Base64CredentialStatus.INVALID_PADDING
         credential_str = base64.b64decode(base64str)
         credential_json = json.loads(credential_str)
+        from google.oauth2.service_account import Credentials
         cred = Credentials.from_service_account_info(credential_json, scopes=configs.SCOPES)
         return Base64CredentialStatus.OK if cred is not None else Base64CredentialStatus.INVALID
     except Exception:
         return Base64CredentialStatus.INVALID
 
 
-def save_to_file(data):
-    """Saves the Google Sheets data to a local file."""
+# ------------------------------------------------------------
+# SNAPSHOT STORE
+# ------------------------------------------------------------
+
+class BinarySnapshot:
+    """
+    Memory-mapped snapshot with a precomputed hash index, a lookup only touches the pages it needs.
+
+    Layout (little-endian):
+        header   magic, metadata offset and length, slot count, slots offset
+        metadata JSON object with the "__KEY__" entries of the snapshot
+        slots    slot count x u64 record offsets (0 is an empty slot), open addressing with linear probing
+        records  u32 hash, u32 key length, u32 value length, key, value
+    Keys are "CATEGORY\x1fNAME" for values and "\x1eCATEGORY" for the category markers.
+    """
+    MAGIC = b"CENVSNP1"
+    HEADER = struct.Struct("<8sQQQQ")
+    SLOT = struct.Struct("<Q")
+    RECORD = struct.Struct("<III")
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, meta_offset, meta_length, self.slot_count, self.slots_offset = self.HEADER.unpack_from(self.mm, 0)
+        if magic != self.MAGIC:
+            self.mm.close()
+            raise ValueError(f"'{path}' is not a cenv binary snapshot.")
+        self.meta = json.loads(self.mm[meta_offset:meta_offset + meta_length])
+
+    @staticmethod
+    def value_key(category: str, name: str) -> bytes:
+        return f"{category}\x1f{name}".encode()
+
+    @staticmethod
+    def category_key(category: str) -> bytes:
+        return f"\x1e{category}".encode()
+
+    def find(self, key: bytes) -> str | None:
+        key_hash = zlib.crc32(key)
+        mask = self.slot_count - 1
+        slot = key_hash & mask
+        while True:
+            (offset,) = self.SLOT.unpack_from(self.mm, self.slots_offset + slot * self.SLOT.size)
+            if offset == 0:
+                return None
+            record_hash, key_length, value_length = self.RECORD.unpack_from(self.mm, offset)
+            start = offset + self.RECORD.size
+            if record_hash == key_hash and self.mm[start:start + key_length] == key:
+                start += key_length
+                return self.mm[start:start + value_length].decode()
+            slot = (slot + 1) & mask
+
+    def __contains__(self, category):
+        return category in self.meta or self.find(self.category_key(category)) is not None
+
+    def __getitem__(self, key):
+        if key in self.meta:
+            return self.meta[key]
+        if self.find(self.category_key(key)) is None:
+            raise KeyError(key)
+        return BinarySnapshotCategory(self, key)
+
+    def __setitem__(self, key, value):
+        # only the metadata can be changed, e.g. when a revalidated snapshot is marked as fetched
+        self.meta[key] = value
+
+    def __bool__(self):
+        return True
+
+    def get(self, key, default=None):
+        return self.meta.get(key, default)
+
+    def records(self):
+        """Yields (key, value) of every record."""
+        for slot in range(self.slot_count):
+            (offset,) = self.SLOT.unpack_from(self.mm, self.slots_offset + slot * self.SLOT.size)
+            if offset == 0:
+                continue
+            _, key_length, value_length = self.RECORD.unpack_from(self.mm, offset)
+            start = offset + self.RECORD.size
+            key = self.mm[start:start + key_length].decode()
+            yield key, self.mm[start + key_length:start + key_length + value_length].decode()
+
+    def to_dict(self):
+        """Materializes the snapshot in the sheet_to_map form, e.g. to export it as JSON."""
+        data = dict(self.meta)
+        for key, value in self.records():
+            if key.startswith("\x1e"):
+                data.setdefault(key[1:], {})
+            else:
+                category, name = key.split("\x1f", 1)
+                data.setdefault(category, {})[name] = value
+        return data
+
+    @classmethod
+    def dump(cls, data, f):
+        """Writes a snapshot produced by sheet_to_map in the binary format."""
+        meta = {}
+        records = []
+        for key, value in data.items():
+            if isinstance(value, dict):
+                records.append((cls.category_key(key), b""))
+                records.extend((cls.value_key(key, name), str(item).encode()) for name, item in value.items())
+            else:
+                meta[key] = value
 
-    # Get the directory part of the path
-    directory = os.path.dirname(configs.CONFIG_FILE)
+        slot_count = 1
+        while slot_count < len(records) * 2:
+            slot_count *= 2
+
+        meta_bytes = json.dumps(meta).encode()
+        meta_offset = cls.HEADER.size
+        slots_offset = meta_offset + len(meta_bytes)
+        offset = slots_offset + slot_count * cls.SLOT.size
+
+        slots = [0] * slot_count
+        body = bytearray()
+        for key, value in records:
+            key_hash = zlib.crc32(key)
+            slot = key_hash & (slot_count - 1)
+            while slots[slot] != 0:
+                slot = (slot + 1) & (slot_count - 1)
+            slots[slot] = offset + len(body)
+            body += cls.RECORD.pack(key_hash, len(key), len(value)) + key + value
+
+        f.write(cls.HEADER.pack(cls.MAGIC, meta_offset, len(meta_bytes), slot_count, slots_offset))
+        f.write(meta_bytes)
+        f.write(struct.pack(f"<{slot_count}Q", *slots))
+        f.write(body)
+
+
+class BinarySnapshotCategory:
+    def __init__(self, snapshot: BinarySnapshot, category: str):
+        self.snapshot = snapshot
+        self.category = category
+
+    def __contains__(self, name):
+        return self.snapshot.find(self.snapshot.value_key(self.category, name)) is not None
+
+    def __getitem__(self, name):
+        value = self.snapshot.find(self.snapshot.value_key(self.category, name))
+        if value is None:
+            raise KeyError(name)
+        return value
+
+
+class SheetIndex:
+    """
+    Every env column of a sheet, built in one pass over the rows.
+
+    The (category, name) keys are interned once and shared by the envs, each env column is an
+    array of value ids into a table of the distinct values (-1 where the row has no value for it),
+    so memory grows with the unique cells rather than envs x keys.
+
+    Layout on disk (little-endian):
+        header   magic, JSON length
+        JSON     metadata, envs, keys and the distinct values
+        columns  one key count x i32 array of value ids per env
+    """
+    MAGIC = b"CENVIDX1"
+    HEADER = struct.Struct("<8sQ")
+
+    def __init__(self, meta: dict, envs: list[str], keys: list[tuple[str, str]], values: list[str],
+                 columns: list[array.array]):
+        self.meta = meta
+        self.envs = envs
+        self.keys = keys
+        self.values = values
+        self.columns = columns
+        self.slots = {key: slot for slot, key in enumerate(keys)}
+        self.categories = {}
+        for slot, (category, _) in enumerate(keys):
+            self.categories.setdefault(category, []).append(slot)
+
+    @classmethod
+    def build(cls, rows, sheet: str, sheet_id: str):
+        """Indexes the rows like sheet_to_map does for each env: the last row of a (category, name) wins."""
+        header = rows[0] if rows else []
+        envs = []
+        positions = []
+        for position, env in enumerate(header[2:], start=2):
+            # sheet_to_map reads the first column of an env
+            if env not in envs:
+                envs.append(env)
+                positions.append(position)
+
+        slots = {}
+        value_ids = {}
+        values = []
+        columns = [array.array("i") for _ in envs]
+        for row in rows[1:]:
+            # a row without any env value, or in no category, is not part of a snapshot
+            if len(row) <= 2 or not row[0]:
+                continue
+            key = (row[0], row[1])
+            slot = slots.get(key)
+            if slot is None:
+                slot = slots[key] = len(slots)
+                for column in columns:
+                    column.append(-1)
+            for column, position in zip(columns, positions):
+                if len(row) <= position:
+                    continue
+                value = row[position]
+                value_id = value_ids.get(value)
+                if value_id is None:
+                    value_id = value_ids[value] = len(values)
+                    values.append(value)
+                column[slot] = value_id
+
+        keys = [(sys.intern(category), sys.intern(name)) for category, name in slots]
+        return cls({"__SHEET_ID__": sheet_id, "__SHEET__": sheet}, envs, keys, values, columns)
+
+    def snapshot(self, env: str):
+        """Returns the env's view, read like a snapshot produced by sheet_to_map, or None for an unknown env."""
+        if env not in self.envs:
+            return None
+        return SheetIndexSnapshot(self, env)
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, 'rb') as f:
+            content = f.read()
+        magic, length = cls.HEADER.unpack_from(content, 0)
+        if magic != cls.MAGIC:
+            raise ValueError(f"'{path}' is not a cenv sheet index.")
+        offset = cls.HEADER.size + length
+        document = json.loads(content[cls.HEADER.size:offset])
+
+        keys = [(sys.intern(category), sys.intern(name)) for category, name in document["keys"]]
+        size = len(keys) * 4
+        columns = []
+        for _ in document["envs"]:
+            column = array.array("i")
+            column.frombytes(content[offset:offset + size])
+            if sys.byteorder == "big":
+                column.byteswap()
+            columns.append(column)
+            offset += size
+        return cls(document["meta"], document["envs"], keys, document["values"], columns)
+
+    def dump(self, f):
+        document = json.dumps({
+            "meta": self.meta,
+            "envs": self.envs,
+            "keys": self.keys,
+            "values": self.values
+        }).encode()
+        f.write(self.HEADER.pack(self.MAGIC, len(document)))
+        f.write(document)
+        for column in self.columns:
+            if sys.byteorder == "big":
+                column = array.array("i", column)
+                column.byteswap()
+            f.write(column.tobytes())
+
+    def to_dict(self):
+        """Materializes the index with every env, e.g. to export it as JSON."""
+        return {
+            **self.meta,
+            "__ENVS__": {env: self.snapshot(env).to_dict() for env in self.envs}
+        }
+
+
+class SheetIndexSnapshot:
+    """An env of a SheetIndex, with the interface of the snapshots produced by sheet_to_map."""
+
+    def __init__(self, index: SheetIndex, env: str):
+        self.index = index
+        self.column = index.columns[index.envs.index(env)]
+        self.meta = {**index.meta, "__ENV__": env}
+
+    def find(self, category: str, name: str) -> str | None:
+        slot = self.index.slots.get((category, name))
+        if slot is None or self.column[slot] < 0:
+            return None
+        return self.index.values[self.column[slot]]
+
+    def __contains__(self, category):
+        if category in self.meta:
+            return True
+        return any(self.column[slot] >= 0 for slot in self.index.categories.get(category, ()))
+
+    def __getitem__(self, key):
+        if key in self.meta:
+            return self.meta[key]
+        if key not in self:
+            raise KeyError(key)
+        return SheetIndexCategory(self, key)
+
+    def __setitem__(self, key, value):
+        # only the metadata can be changed, e.g. when a revalidated snapshot is marked as fetched
+        self.meta[key] = value
+
+    def __bool__(self):
+        return True
+
+    def get(self, key, default=None):
+        return self.meta.get(key, default)
+
+    def to_dict(self):
+        """Materializes the env in the sheet_to_map form, e.g. to store it as a snapshot of its own."""
+        data = dict(self.meta)
+        for (category, name), value_id in zip(self.index.keys, self.column):
+            if value_id >= 0:
+                data.setdefault(category, {})[name] = self.index.values[value_id]
+        return data
+
+
+class SheetIndexCategory:
+    def __init__(self, snapshot: SheetIndexSnapshot, category: str):
+        self.snapshot = snapshot
+        self.category = category
+
+    def __contains__(self, name):
+        return self.snapshot.find(self.category, name) is not None
+
+    def __getitem__(self, name):
+        value = self.snapshot.find(self.category, name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+
+def snapshot_to_dict(data):
+    """Returns a snapshot in the plain sheet_to_map form, whichever store format it was read from."""
+    if isinstance(data, (BinarySnapshot, SheetIndexSnapshot)):
+        return data.to_dict()
+    return data
+
+
+class SnapshotStore:
+    """
+    Keeps sheet snapshots side by side in a directory, one file per (sheet id, sheet, env),
+    the indexes of sheets loaded with all their envs and the sheets' header rows.
+    The least recently used files are evicted once the count or size cap is exceeded.
+    Snapshots are written as JSON or in the memory-mapped binary format.
+    """
+    SUFFIXES = {"json": ".json", "binary": ".snap"}
+    # Indexes of every env of a sheet, written by 'cenv load' without an env
+    INDEX_SUFFIX = ".index"
+    # Header rows of the sheets, to download only the columns of the requested envs
+    HEADER_SUFFIX = ".header"
+    # Keys share a fixed set of lock files, so they don't pile up with every key ever fetched
+    LOCK_STRIPES = 64
+
+    def __init__(self, directory: str, max_entries: int, max_bytes: int, fmt: str = "json"):
+        if fmt not in self.SUFFIXES:
+            raise ValueError(f"Unknown snapshot format '{fmt}', expect one of: {', '.join(self.SUFFIXES)}.")
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.format = fmt
+
+    @staticmethod
+    def entry_name(sheet_id: str, sheet: str, env: str) -> str:
+        key = json.dumps([sheet_id, sheet, env])
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def header_path(self, sheet_id: str, sheet: str) -> str:
+        return os.path.join(self.directory, self.entry_name(sheet_id, sheet, "") + self.HEADER_SUFFIX)
+
+    def read_header(self, sheet_id: str, sheet: str) -> list[str] | None:
+        """Returns the cached header row of the sheet, marking it as recently used."""
+        path = self.header_path(sheet_id, sheet)
+        try:
+            with open(path, 'r') as f:
+                header = json.load(f)
+        except (OSError, ValueError):
+            return None
+        self.touch(path)
+        return header
+
+    def write_header(self, sheet_id: str, sheet: str, header: list[str]):
+        with open_atomic(self.header_path(sheet_id, sheet), text=True) as f:
+            json.dump(header, f)
+
+    def lock_path(self, sheet_id: str, sheet: str, env: str) -> str:
+        stripe = int(self.entry_name(sheet_id, sheet, env), 16) % self.LOCK_STRIPES
+        return os.path.join(self.directory, ".locks", f"{stripe}.lock")
+
+    def lock(self, sheet_id: str, sheet: str, env: str):
+        """
+        Returns the key's lock, held by the process downloading it while the others wait.
+        Keys may share a lock, the locks of several keys are taken once each through their lock_path.
+        """
+        return file_lock(self.lock_path(sheet_id, sheet, env))
+
+    def index_path(self, sheet_id: str, sheet: str) -> str:
+        return os.path.join(self.directory, self.entry_name(sheet_id, sheet, "") + self.INDEX_SUFFIX)
+
+    def read_index(self, sheet_id: str, sheet: str) -> SheetIndex | None:
+        """Returns the stored index of every env of the sheet, marking it as recently used."""
+        path = self.index_path(sheet_id, sheet)
+        with trace_span("store.read_index", sheet=sheet) as span:
+            try:
+                index = SheetIndex.load(path)
+            except (OSError, ValueError, KeyError, struct.error):
+                span.set(hit=False)
+                return None
+            if index.meta.get("__SHEET_ID__") != sheet_id or index.meta.get("__SHEET__") != sheet:
+                span.set(hit=False)
+                return None
+            self.touch(path)
+            span.set(hit=True, bytes=self.size(path))
+            return index
+
+    def write_index(self, index: SheetIndex) -> str:
+        with trace_span("store.write_index", sheet=index.meta["__SHEET__"]) as span:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self.index_path(index.meta["__SHEET_ID__"], index.meta["__SHEET__"])
+            with open_atomic(path) as f:
+                index.dump(f)
+            span.set(bytes=self.size(path))
+
+            # snapshots of the indexed envs are older than the index, which serves them from now on
+            for env in index.envs:
+                for fmt in self.SUFFIXES:
+                    self.remove(self.entry_path(index.meta["__SHEET_ID__"], index.meta["__SHEET__"], env, fmt))
+
+            self.evict(keep=path)
+            return path
+
+    def entry_path(self, sheet_id: str, sheet: str, env: str, fmt: str | None = None) -> str:
+        suffix = self.SUFFIXES[fmt or self.format]
+        return os.path.join(self.directory, self.entry_name(sheet_id, sheet, env) + suffix)
+
+    def read(self, sheet_id: str, sheet: str, env: str):
+        """Returns the snapshot for the key or None, marking it as recently used."""
+        with trace_span("store.read", sheet=sheet, env=env) as span:
+            # snapshots written before the format was switched are still served
+            for fmt in [self.format, *[other for other in self.SUFFIXES if other != self.format]]:
+                path = self.entry_path(sheet_id, sheet, env, fmt)
+                try:
+                    if fmt == "binary":
+                        data = BinarySnapshot(path)
+                    else:
+                        with open(path, 'r') as f:
+                            data = json.load(f)
+                except (FileNotFoundError, ValueError):
+                    continue
+
+                if data.get("__SHEET_ID__") != sheet_id or data.get("__SHEET__") != sheet or data.get("__ENV__") != env:
+                    continue
+
+                self.touch(path)
+                span.set(hit=True, format=fmt, bytes=self.size(path))
+                return data
+            span.set(hit=False)
+            return None
+
+    @staticmethod
+    def size(path: str) -> int | None:
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return None
+
+    def write(self, data) -> str:
+        """Stores a snapshot produced by sheet_to_map and returns its path."""
+        data = snapshot_to_dict(data)
+
+        with trace_span("store.write", sheet=data["__SHEET__"], env=data["__ENV__"], format=self.format) as span:
+            os.makedirs(self.directory, exist_ok=True)
+            key = (data["__SHEET_ID__"], data["__SHEET__"], data["__ENV__"])
+            path = self.entry_path(*key)
+            # the file is replaced instead of rewritten in place, so concurrent readers never see it
+            # half-written and a mapped binary snapshot stays valid
+            if self.format == "binary":
+                with open_atomic(path) as f:
+                    BinarySnapshot.dump(data, f)
+            else:
+                with open_atomic(path, text=True) as f:
+                    json.dump(data, f, indent=4)
+            span.set(bytes=self.size(path))
+
+            for fmt in self.SUFFIXES:
+                if fmt != self.format:
+                    self.remove(self.entry_path(*key, fmt))
+
+            self.evict(keep=path)
+            return path
+
+    @staticmethod
+    def remove(path: str):
+        # another process may remove the same file
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+
+    @staticmethod
+    def touch(path: str):
+        # The access time is the LRU clock, the modification time is left intact
+        try:
+            st = os.stat(path)
+            os.utime(path, ns=(time.time_ns(), st.st_mtime_ns))
+        except OSError:
+            pass
+
+    def entries(self) -> list[tuple[str, int, int]]:
+        """Returns (path, access time, size) of every stored snapshot, index and header, most recently used first."""
+        if not os.path.isdir(self.directory):
+            return []
+        suffixes = (*self.SUFFIXES.values(), self.INDEX_SUFFIX, self.HEADER_SUFFIX)
+        result = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(suffixes):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            result.append((path, st.st_atime_ns, st.st_size))
+        result.sort(key=lambda entry: entry[1], reverse=True)
+        return result
+
+    def evict(self, keep: str | None = None):
+        """Removes the least recently used snapshots until the store fits its caps."""
+        count = 0
+        total = 0
+        for path, _, size in self.entries():
+            count += 1
+            total += size
+            if path != keep and (count > self.max_entries or total > self.max_bytes):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                count -= 1
+                total -= size
+
+    def clear(self) -> bool:
+        if not os.path.isdir(self.directory):
+            return False
+        shutil.rmtree(self.directory, ignore_errors=True)
+        return True
 
-    # Create the directory if it doesn't exist
-    if directory and not os.path.exists(directory):
-        os.makedirs(directory, exist_ok=True)
 
-    # Check if the file already exists
-    # Delete it if it does
-    delete_file()
+def snapshot_store() -> SnapshotStore:
+    return SnapshotStore(configs.CONFIG_FILE + ".d", configs.STORE_MAX_ENTRIES, configs.STORE_MAX_BYTES,
+                         configs.STORE_FORMAT)
 
-    # Write the data to the file
-    with open(configs.CONFIG_FILE, 'w') as f:
-        json.dump(data, f, indent=4)
+
+def save_to_file(data) -> str:
+    """Saves the Google Sheets data to the local snapshot store."""
+    return snapshot_store().write(data)
 
 
 def delete_file() -> bool:
-    """Deletes the local file containing the Google Sheets data."""
-    if os.path.exists(configs.CONFIG_FILE):
+    """Deletes the local snapshot store containing the Google Sheets data."""
+    deleted = snapshot_store().clear()
+
+    # Remove the single snapshot file written by older versions
+    if os.path.isfile(configs.CONFIG_FILE):
         os.remove(configs.CONFIG_FILE)
-        return True
-    else:
-        return False
+        deleted = True
 
+    return deleted
 
-def get_file_content():
-    """Reads the local file containing the Google Sheets data."""
-    if os.path.exists(configs.CONFIG_FILE):
-        with open(configs.CONFIG_FILE, 'r') as f:
-            return json.load(f)
-    else:
-        return None
+
+def get_file_content(sheet: str, env: str, spreadsheet_id: str | None = None):
+    """Reads the locally stored Google Sheets data for the sheet and env, from its index when it has no snapshot."""
+    spreadsheet_id = spreadsheet_id or configs.GOOGLE_SHEET_ID
+    store = snapshot_store()
+    data = store.read(spreadsheet_id, sheet, env)
+    if data is None:
+        index = store.read_index(spreadsheet_id, sheet)
+        data = index.snapshot(env) if index is not None else None
+    return data
 
 
-def sheet_to_map(rows, sheet: str, env: str):
+@traced("sheet_to_map", lambda rows, sheet, env, spreadsheet_id=None: {"sheet": sheet, "env": env, "rows": len(rows)})
+def sheet_to_map(rows, sheet: str, env: str, spreadsheet_id: str | None = None):
     """Converts a Google Sheets worksheet to a dictionary."""
     rows = rows.copy()
     header_row = rows.pop(0)
 
     # Define config by name of the server
+    if env not in header_row:
+        raise CenvNotFoundError(f"Env '{env}' not found in sheet '{sheet}'.")
     server_index = header_row.index(env)
 
     data = {
         "__ENV__": env,
         "__SHEET__": sheet,
-        "__SHEET_ID__": configs.GOOGLE_SHEET_ID
+        "__SHEET_ID__": spreadsheet_id or configs.GOOGLE_SHEET_ID
     }
     # Initialize a variable to track the current category
     current_category = None
@@ -348,12 +1252,70 @@ def sheet_to_map(rows, sheet: str, env: str):
     return data
 
 
-def load_google_sheet(sheet_name: str) -> []:
-    """
-        Downloads the Google Sheets data and saves it locally.
-        Handles the authentication using a service account and returns the credentials.
-        """
-    # get credentials
+GOOGLE_CREDENTIALS_ERROR = "\n".join([
+    "Failed to get Google credentials.",
+    "Use 'cenv login' to authenticate with Google account.",
+    f"Or set service account using the {ENV_CENV_GOOGLE_CREDENTIAL_BASE64} environment variable."
+])
+
+# Credentials are kept for the lifetime of the process, e.g. by the 'cenv serve' daemon
+google_credentials = None
+
+# Cached access tokens are reused until they are this close to their expiry
+ACCESS_TOKEN_MIN_LIFETIME = 300
+
+
+def access_token_cache_key(*identity) -> str:
+    return hashlib.sha256(json.dumps(identity).encode()).hexdigest()
+
+
+def read_access_token_cache() -> dict:
+    try:
+        with open(configs.ACCESS_TOKEN_FILE, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def use_cached_access_token(creds, key: str) -> bool:
+    """Applies the cached access token to the credentials, returns False when there is none still valid."""
+    import datetime
+
+    entry = read_access_token_cache().get(key)
+    if not entry:
+        return False
+    # google-auth compares naive UTC datetimes
+    expiry = datetime.datetime.fromisoformat(entry["expiry"])
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    if (expiry - now).total_seconds() < ACCESS_TOKEN_MIN_LIFETIME:
+        return False
+    creds.token = entry["token"]
+    creds.expiry = expiry
+    return True
+
+
+def save_cached_access_token(creds, key: str):
+    import datetime
+
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    # processes refreshing at the same time would otherwise drop each other's tokens
+    with file_lock(configs.ACCESS_TOKEN_FILE + ".lock"):
+        cache = {
+            cached_key: entry for cached_key, entry in read_access_token_cache().items()
+            if datetime.datetime.fromisoformat(entry["expiry"]) > now
+        }
+        cache[key] = {"token": creds.token, "expiry": creds.expiry.isoformat()}
+        write_file_atomic(configs.ACCESS_TOKEN_FILE, json.dumps(cache).encode(), 0o600)
+
+
+def get_google_credentials():
+    """Handles the authentication using the user token or a service account and returns the credentials."""
+    global google_credentials
+    if google_credentials is not None:
+        return google_credentials
+
+    with trace_span("import", module="google.oauth2"):
+        from google.oauth2.service_account import Credentials
 
     creds = read_google_token_creds()
     if creds is None:
@@ -364,217 +1326,1438 @@ def load_google_sheet(sheet_name: str) -> []:
             credential_str = base64.b64decode(base64str)
             credential_json = json.loads(credential_str)
         except Exception:
-            print("Failed to get Google credentials.")
-            print("Use 'cenv login' to authenticate with Google account.")
-            print(f"Or set service account using the {ENV_CENV_GOOGLE_CREDENTIAL_BASE64} environment variable.")
-            exit(1)
+            raise CenvAuthError(GOOGLE_CREDENTIALS_ERROR)
         creds = Credentials.from_service_account_info(credential_json, scopes=configs.SCOPES)
 
-    if creds is None:
-        print("Failed to get Google credentials.")
-        print("Use 'cenv login' to authenticate with Google account.")
-        print(f"Or set service account using the {ENV_CENV_GOOGLE_CREDENTIAL_BASE64} environment variable.")
-        exit(1)
+        # Reuse the access token of a previous run instead of signing a JWT and calling the token endpoint
+        key = access_token_cache_key(creds.service_account_email, credential_json.get("private_key_id"), configs.SCOPES)
+        if not use_cached_access_token(creds, key):
+            import httplib2
+            from google_auth_httplib2 import Request
 
-    # get service
-    service = build("sheets", "v4", credentials=creds)
+            with trace_span("credentials.refresh", kind="service_account"):
+                creds.refresh(Request(httplib2.Http()))
+            save_cached_access_token(creds, key)
 
-    rows = None
-    try:
-        sheet = service.spreadsheets()
-        result = (
-            sheet.values()
-            .get(spreadsheetId=configs.GOOGLE_SHEET_ID, range=sheet_name)
-            .execute()
-        )
-        rows = result.get("values", [])
-    except HttpError as err:
-        print(err)
-        exit(1)
-    return rows
+    if creds is None:
+        raise CenvAuthError(GOOGLE_CREDENTIALS_ERROR)
 
+    google_credentials = creds
+    return creds
 
-def load_file_and_save(sheet_name: str, env: str):
-    rows = load_google_sheet(sheet_name)
-    data = sheet_to_map(rows, sheet_name, env)
-    save_to_file(data)
 
+# Thread-local authorized HTTP clients, their connections are kept alive across requests
+http_local = threading.local()
 
-def get_value(sheet_data, category: str, name: str):
-    """Gets the value in the sheet based on environment, category, and name."""
-    if not sheet_data:
-        return "No data found."
-    if not category or not name:
-        return "Category and name are required."
+# Process-wide Sheets client
+sheets_service = None
 
-    if category not in sheet_data:
-        print(f"Category '{category}' not found.")
-        exit(1)
-    if name not in sheet_data[category]:
-        print(f"Name '{name}' not found in category '{category}'.")
-        exit(1)
 
-    return sheet_data[category][name]
+def authorized_http():
+    """Returns this thread's authorized HTTP client, httplib2 clients can't be shared between threads."""
+    http = getattr(http_local, "http", None)
+    if http is None:
+        with trace_span("import", module="google_auth_httplib2"):
+            import httplib2
+            from google_auth_httplib2 import AuthorizedHttp
 
+        http = AuthorizedHttp(get_google_credentials(), http=httplib2.Http())
+        http_local.http = http
+    return http
 
-def load_value(sheet: str, env: str, category: str, name: str) -> str:
-    """Loads sheet and finds and return a value from the local file based on the specified parameters."""
-    need_load = True
-    try_count = 2
-    data = None
-    while need_load and try_count > 0:
-        try_count -= 1
-        need_load = False
-        if not os.path.exists(configs.CONFIG_FILE):
-            load_file_and_save(sheet_name=sheet, env=env)
-
-        data = get_file_content()
-        env_valid = "__ENV__" in data and data["__ENV__"] == env
-        sheet_valid = "__SHEET__" in data and data["__SHEET__"] == sheet
-        sheet_id_valid = "__SHEET_ID__" in data and data["__SHEET_ID__"] == configs.GOOGLE_SHEET_ID
-        if not env_valid or not sheet_valid or not sheet_id_valid:
-            need_load = True
-            delete_file()
 
-    if not data:
-        print("No data found.")
-        exit(1)
+def get_sheets_service():
+    """Returns the Sheets client, built once per process from the bundled discovery document."""
+    global sheets_service
+    if sheets_service is None:
+        http = authorized_http()
+        with trace_span("import", module="googleapiclient"):
+            from googleapiclient.discovery import build_from_document
 
-    result = get_value(data, category, name)
-    return result
+        with trace_span("sheets.build"):
+            sheets_service = build_from_document(load_embedded_file("discovery/sheets.v4.json"), http=http)
+    return sheets_service
 
 
-def read_cenv_url(url: str) -> str:
-    """Parses the cenv URL and retrieves the corresponding value."""
-    if not url.startswith("cenv://"):
-        raise ValueError("Invalid cenv URL. Must start with 'cenv://'.")
+# Responses worth retrying, the quota errors and the transient server errors
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 32.0
 
-    # Split the URL after the "cenv://" part
-    parts = url[7:].split("/", 3)
 
-    if len(parts) != 4:
-        raise ValueError(f"Invalid cenv URL format. Expect: 'cenv://SHEET/ENV/CATEGORY/NAME', got: {url}")
+@contextlib.contextmanager
+def request_budget():
+    """
+    Yields the token bucket shared by the local processes through the rate limit file, refilled
+    at CENV_RATE_LIMIT tokens per minute up to a minute's worth, and stores it back after the block.
+    """
+    capacity = configs.RATE_LIMIT
+    with file_lock(configs.RATE_LIMIT_FILE + ".lock"):
+        try:
+            with open(configs.RATE_LIMIT_FILE, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+        now = time.time()
+        elapsed = max(0.0, now - state.get("updated", now))
+        budget = {"tokens": min(capacity, state.get("tokens", capacity) + elapsed * capacity / 60)}
+        yield budget
+        write_file_atomic(configs.RATE_LIMIT_FILE, json.dumps({"tokens": budget["tokens"], "updated": now}).encode())
+
+
+def wait_for_request_budget():
+    """Takes a token of the shared budget, waiting until it's refilled when the token is borrowed."""
+    if configs.RATE_LIMIT <= 0:
+        return
+    with request_budget() as budget:
+        budget["tokens"] -= 1
+        wait = max(0.0, -budget["tokens"]) * 60 / configs.RATE_LIMIT
+    if wait > 0:
+        with trace_span("sheets.throttle", wait=wait):
+            time.sleep(wait)
 
-    sheet, env, category, name = parts
 
-    return load_value(
-        sheet=sheet,
-        env=env,
-        category=category,
-        name=name
-    )
+def hold_request_budget(seconds: float):
+    """
+    Empties the shared budget for the seconds, so every local process backs off after a quota error.
+    The token left once they passed is the retried request's.
+    """
+    if configs.RATE_LIMIT <= 0:
+        return
+    with request_budget() as budget:
+        budget["tokens"] = min(budget["tokens"], 1 - seconds * configs.RATE_LIMIT / 60)
 
 
-# ------------------------------------------------------------
-# ENV RESOLVER
-# ------------------------------------------------------------
+def parse_retry_after(value: str | None) -> float | None:
+    """Returns the seconds of a Retry-After header, given in seconds or as an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
 
-# Define patterns for matching different parts of the .env syntax
-pattern_basic = re.compile(r'\$(\w+)')
-pattern_braced = re.compile(r'\${(\w+)(?::-([^}]+))?(?::\?([^}]+))?}')
-pattern_quoted = re.compile(r'^"(.*)"$')  # Pattern for detecting quoted strings
-pattern_comment = re.compile(r'(?<!\\) #.*$')  # Pattern to match unescaped `#` for comments
 
+def retry_delay(attempt: int, retry_after: float | None = None) -> float:
+    """The server's Retry-After when it sent one, otherwise an exponential backoff with full jitter."""
+    if retry_after is not None:
+        return retry_after
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
 
-def resolve_value(env_vars, value):
-    # Check if the original value was quoted
-    is_quoted = pattern_quoted.match(value)
 
-    # Remove surrounding quotes if the value is quoted for internal processing
-    if is_quoted:
-        value = pattern_quoted.sub(r'\1', value)
+class ResponseSizeRecorder:
+    """Wraps an HTTP client to record the size of the responses on the span, before they're parsed."""
 
-    # Resolve patterns like $USER_NAME or ${USER_NAME}
-    def replace_var(match):
-        var_name = match.group(1)
-        tmp_val = env_vars.get(var_name, None)
-        if tmp_val:
-            if tmp_val.startswith(('"', "'")):
-                tmp_val = tmp_val[1:]
-            if tmp_val.endswith(('"', "'")):
-                tmp_val = tmp_val[:-1]
-            return tmp_val
-        return os.getenv(var_name, '')
-
-    def replace_braced_var(match):
-        var_name = match.group(1)
-        default_value = match.group(2)
-        error_message = match.group(3)
-
-        # Check if the variable exists in our env_vars or system environment
-        if var_name in env_vars:
-            tmp_val = env_vars[var_name]
-            if tmp_val.startswith('"'):
-                tmp_val = tmp_val[1:]
-            if tmp_val.endswith('"'):
-                tmp_val = tmp_val[:-1]
-            return tmp_val
-        elif var_name in os.environ:
-            return os.getenv(var_name)
-        elif default_value is not None:
-            return default_value
-        elif error_message is not None:
-            raise ValueError(error_message)
-        else:
-            return ''
+    def __init__(self, http, span):
+        self.http = http
+        self.span = span
 
-    # Resolve basic $VAR and braced ${VAR} patterns within the string
-    value = pattern_basic.sub(replace_var, value)
-    value = pattern_braced.sub(replace_braced_var, value)
+    def request(self, *args, **kwargs):
+        response, content = self.http.request(*args, **kwargs)
+        self.span.set(bytes=len(content))
+        return response, content
 
-    # If the initial value was quoted, apply quotes to the entire final resolved value
-    if is_quoted:
-        value = f'"{value}"'
+    def __getattr__(self, name):
+        return getattr(self.http, name)
 
-    return value
 
+def execute_sheets_request(request):
+    """
+    Executes a Sheets API request on this thread's connection, within the shared request budget.
+    Quota and transient server errors are retried up to CENV_MAX_RETRIES times.
+    """
+    import httplib2
+    from googleapiclient.errors import HttpError
+
+    with trace_span("sheets.fetch", method=getattr(request, "methodId", None)) as span:
+        http = ResponseSizeRecorder(authorized_http(), span)
+        attempt = 0
+        while True:
+            wait_for_request_budget()
+            try:
+                return request.execute(http=http)
+            except HttpError as err:
+                if err.resp.status not in RETRY_STATUSES or attempt >= configs.MAX_RETRIES:
+                    raise CenvFetchError(str(err)) from err
+                delay = retry_delay(attempt, parse_retry_after(err.resp.get("retry-after")))
+                if err.resp.status == 429:
+                    hold_request_budget(delay)
+            except (httplib2.HttpLib2Error, OSError) as err:
+                # e.g. ServerNotFoundError, a reset connection or a timeout
+                if attempt >= configs.MAX_RETRIES:
+                    raise CenvFetchError(str(err)) from err
+                delay = retry_delay(attempt)
+            attempt += 1
+            span.set(retries=attempt)
+            time.sleep(delay)
+
+
+def load_google_sheet(sheet_name: str, envs: list[str] | None = None, spreadsheet_id: str | None = None) -> []:
+    """Downloads the Google Sheets data of a single sheet, only its env columns when they are given."""
+    spreadsheet_id = spreadsheet_id or configs.GOOGLE_SHEET_ID
+    if envs:
+        return load_google_sheets([sheet_name], spreadsheet_id, envs={sheet_name: set(envs)})[sheet_name]
+
+    result = execute_sheets_request(
+        get_sheets_service().spreadsheets().values().get(spreadsheetId=spreadsheet_id, range=sheet_name)
+    )
+    return result.get("values", [])
 
-# ------------------------------------------------------------
-# COMMANDS
-# ------------------------------------------------------------
-def read_google_token_creds():
-    creds = None
-    if os.path.exists(configs.USER_TOKEN_FILE):
-        with open(configs.USER_TOKEN_FILE, 'rb') as token:
-            creds = pickle.load(token)
-            if not creds or not creds.valid:
-                if creds and creds.expired and creds.refresh_token:
-                    creds.refresh(Request(httplib2.Http()))
-                else:
-                    creds = None
-    return creds
 
+def quote_sheet_name(sheet_name: str) -> str:
+    return "'" + sheet_name.replace("'", "''") + "'"
 
-def google_logout_command():
-    if os.path.exists(configs.USER_TOKEN_FILE):
-        os.remove(configs.USER_TOKEN_FILE)
 
+def column_letter(index: int) -> str:
+    """Converts a zero based column index to its A1 notation letter."""
+    letter = ""
+    index += 1
+    while index > 0:
+        index, remainder = divmod(index - 1, 26)
+        letter = chr(ord("A") + remainder) + letter
+    return letter
 
-def google_login_command():
-    creds = read_google_token_creds()
 
-    # If no valid credentials, go through OAuth flow
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request(httplib2.Http()))
+def load_sheet_headers(sheet_envs: dict[str, set], spreadsheet_id: str) -> dict[str, list]:
+    """
+    Returns the header rows of the sheets from the store, the headers that aren't cached
+    or miss one of the envs are downloaded with a single batchGet request.
+    """
+    store = snapshot_store()
+    headers = {}
+    missing = []
+    for sheet, envs in sheet_envs.items():
+        header = store.read_header(spreadsheet_id, sheet)
+        if header is None or not envs.issubset(header):
+            missing.append(sheet)
+        else:
+            headers[sheet] = header
+
+    if missing:
+        result = execute_sheets_request(
+            get_sheets_service().spreadsheets().values().batchGet(
+                spreadsheetId=spreadsheet_id,
+                ranges=[f"{quote_sheet_name(sheet)}!1:1" for sheet in missing]
+            )
+        )
+        for sheet, value_range in zip(missing, result.get("valueRanges", [])):
+            header = (value_range.get("values") or [[]])[0]
+            store.write_header(spreadsheet_id, sheet, header)
+            headers[sheet] = header
+
+    return headers
+
+
+def join_projected_columns(name_rows: list, env_columns: list[list]) -> list:
+    """
+    Joins the Category/Name rows and the env columns into sheet rows.
+    Like in a whole sheet download, empty trailing cells of a row are left out.
+    """
+    rows = []
+    height = max(len(name_rows), *(len(column) for column in env_columns))
+    for i in range(height):
+        names = name_rows[i] if i < len(name_rows) else []
+        values = [column[i][0] if i < len(column) and column[i] else None for column in env_columns]
+        while values and values[-1] is None:
+            values.pop()
+        row = [names[0] if len(names) > 0 else "", names[1] if len(names) > 1 else ""]
+        row += ["" if value is None else value for value in values]
+        rows.append(row)
+    return rows
+
+
+@traced("sheets.load", lambda sheet_names, *args, **kwargs: {"sheets": list(sheet_names)})
+def load_google_sheets(sheet_names: list[str], spreadsheet_id: str | None = None,
+                       envs: dict[str, set] | None = None, retry_moved: bool = True) -> dict[str, list]:
+    """
+    Downloads several sheets of one spreadsheet with a single batchGet request.
+    For the sheets with envs, only the Category, Name and env columns are downloaded,
+    located through the header rows cached in the snapshot store.
+    """
+    spreadsheet_id = spreadsheet_id or configs.GOOGLE_SHEET_ID
+    envs = {sheet: set(sheet_envs) for sheet, sheet_envs in (envs or {}).items() if sheet_envs}
+    if not sheet_names:
+        return {}
+
+    headers = load_sheet_headers({sheet: envs[sheet] for sheet in sheet_names if sheet in envs}, spreadsheet_id)
+
+    ranges = []
+    layout = {}
+    for sheet in sheet_names:
+        header = headers.get(sheet)
+        if header is not None and envs[sheet].issubset(header):
+            columns = [header.index(env) for env in sorted(envs[sheet])]
+            layout[sheet] = (len(ranges), columns)
+            ranges.append(f"{quote_sheet_name(sheet)}!A:B")
+            ranges.extend(f"{quote_sheet_name(sheet)}!{column_letter(column)}:{column_letter(column)}"
+                          for column in columns)
+        else:
+            # an unknown env is reported by sheet_to_map like for the whole sheet
+            layout[sheet] = (len(ranges), None)
+            ranges.append(sheet)
+
+    result = execute_sheets_request(
+        get_sheets_service().spreadsheets().values().batchGet(spreadsheetId=spreadsheet_id, ranges=ranges)
+    )
+
+    # value ranges are returned in the order of the requested ranges
+    values = [value_range.get("values", []) for value_range in result.get("valueRanges", [])]
+    rows_by_sheet = {}
+    moved = []
+    for sheet, (start, columns) in layout.items():
+        if columns is None:
+            rows_by_sheet[sheet] = values[start]
+            continue
+        rows = join_projected_columns(values[start], values[start + 1:start + 1 + len(columns)])
+        if rows and rows[0][2:] == [headers[sheet][column] for column in columns]:
+            rows_by_sheet[sheet] = rows
+        else:
+            # the columns moved since the header was cached
+            moved.append(sheet)
+
+    if moved and retry_moved:
+        store = snapshot_store()
+        for sheet in moved:
+            store.write_header(spreadsheet_id, sheet, [])
+        rows_by_sheet.update(
+            load_google_sheets(moved, spreadsheet_id, {sheet: envs[sheet] for sheet in moved}, retry_moved=False)
+        )
+    elif moved:
+        rows_by_sheet.update(load_google_sheets(moved, spreadsheet_id))
+
+    return rows_by_sheet
+
+
+@traced("drive.modified_time")
+def fetch_spreadsheet_modified_time(spreadsheet_id: str | None = None) -> str | None:
+    """
+    Returns the spreadsheet's Drive modifiedTime, or None when it can't be read,
+    e.g. when the credentials have no Drive metadata scope.
+    """
+    import httplib2
+
+    spreadsheet_id = spreadsheet_id or configs.GOOGLE_SHEET_ID
+    url = f"https://www.googleapis.com/drive/v3/files/{spreadsheet_id}?fields=modifiedTime&supportsAllDrives=true"
+    try:
+        response, content = authorized_http().request(url)
+    except (httplib2.HttpLib2Error, OSError) as err:
+        raise CenvFetchError(f"Can't read the modifiedTime of the spreadsheet: {err}") from err
+    if response.status != 200:
+        return None
+    return json.loads(content).get("modifiedTime")
+
+
+def rows_content_hash(rows) -> str:
+    return hashlib.sha256(json.dumps(rows).encode()).hexdigest()
+
+
+def stamp_snapshot(data, rows, modified_time: str | None = None):
+    """Records when and from which content the snapshot was built."""
+    data["__FETCHED_AT__"] = time.time()
+    data["__CONTENT_HASH__"] = rows_content_hash(rows)
+    data["__MODIFIED_TIME__"] = modified_time
+    return data
+
+
+def snapshot_freshness(data, max_age: int | None, stale_while_revalidate: int) -> str:
+    """Returns 'fresh', 'stale' (served while it's revalidated in the background) or 'expired'."""
+    if max_age is None:
+        return "fresh"
+    age = time.time() - data.get("__FETCHED_AT__", 0)
+    if age <= max_age:
+        return "fresh"
+    if age <= max_age + stale_while_revalidate:
+        return "stale"
+    return "expired"
+
+
+def load_file_and_save(sheet_name: str, env: str, modified_time: str | None = None, spreadsheet_id: str | None = None):
+    rows = load_google_sheet(sheet_name, [env], spreadsheet_id)
+    data = stamp_snapshot(sheet_to_map(rows, sheet_name, env, spreadsheet_id), rows, modified_time)
+    save_to_file(data)
+    return data
+
+
+def load_sheet_index_and_save(sheet_name: str, modified_time: str | None = None) -> tuple[SheetIndex, str]:
+    """Downloads every env column of the sheet at once and stores them as an index."""
+    rows = load_google_sheet(sheet_name)
+    with trace_span("index.build", sheet=sheet_name, rows=len(rows)):
+        index = SheetIndex.build(rows, sheet_name, configs.GOOGLE_SHEET_ID)
+    stamp_snapshot(index.meta, rows, modified_time)
+    return index, snapshot_store().write_index(index)
+
+
+def revalidate_snapshot(sheet: str, env: str, data, spreadsheet_id: str | None = None):
+    """
+    Brings a stored snapshot up to date. The sheet is only downloaded when the spreadsheet's
+    modifiedTime changed, and only parsed again when its content changed.
+    """
+    modified_time = fetch_spreadsheet_modified_time(spreadsheet_id)
+    if modified_time is None or modified_time != data.get("__MODIFIED_TIME__"):
+        rows = load_google_sheet(sheet, [env], spreadsheet_id)
+        if rows_content_hash(rows) != data.get("__CONTENT_HASH__"):
+            data = stamp_snapshot(sheet_to_map(rows, sheet, env, spreadsheet_id), rows, modified_time)
+            save_to_file(data)
+            return data
+
+    data["__FETCHED_AT__"] = time.time()
+    data["__MODIFIED_TIME__"] = modified_time
+    save_to_file(data)
+    return data
+
+
+def refresh_snapshot(sheet: str, env: str, max_age: int | None = None, stale_while_revalidate: int = 0,
+                     spreadsheet_id: str | None = None):
+    """
+    Downloads or revalidates a missing or expired snapshot under the key's lock. Processes missing
+    the same key at the same time wait for the first one and are served the snapshot it stored.
+    """
+    with snapshot_store().lock(spreadsheet_id or configs.GOOGLE_SHEET_ID, sheet, env):
+        data = get_file_content(sheet, env, spreadsheet_id)
+        if data is None:
+            return load_file_and_save(sheet_name=sheet, env=env, spreadsheet_id=spreadsheet_id)
+        if snapshot_freshness(data, max_age, stale_while_revalidate) == "expired":
+            return revalidate_snapshot(sheet, env, data, spreadsheet_id)
+        return data
+
+
+def self_command() -> list[str]:
+    """Returns the command line running this cenv."""
+    if getattr(sys, 'frozen', False):
+        return [sys.executable]
+    return [sys.executable, os.path.abspath(__file__)]
+
+
+# Keys revalidated in the background by this process
+background_revalidations = set()
+
+
+def revalidate_in_background(sheet: str, env: str, spreadsheet_id: str | None = None):
+    """Revalidates a stale snapshot without making the caller wait for it."""
+    spreadsheet_id = spreadsheet_id or configs.GOOGLE_SHEET_ID
+    key = (spreadsheet_id, sheet, env)
+    if is_offline() or key in background_revalidations:
+        return
+    background_revalidations.add(key)
+
+    if not daemon_client_enabled:
+        # the daemon stays alive, a thread is enough
+        def revalidate():
+            try:
+                data = get_file_content(sheet, env, spreadsheet_id)
+                if data is not None:
+                    revalidate_snapshot(sheet, env, data, spreadsheet_id)
+            except Exception:
+                pass
+            finally:
+                background_revalidations.discard(key)
+
+        threading.Thread(target=revalidate, daemon=True).start()
+        return
+
+    child_env = dict(os.environ)
+    for name, value in [
+        (ENV_CENV_GOOGLE_CREDENTIAL_BASE64, configs.GOOGLE_CREDENTIAL_BASE64),
+        (ENV_CENV_GOOGLE_SHEET_ID, spreadsheet_id),
+        (ENV_CENV_STORE_CONFIG_FILE, os.path.abspath(configs.CONFIG_FILE)),
+    ]:
+        if value is not None:
+            child_env[name] = value
+
+    options = {}
+    if platform.system() == "Windows":
+        options["creationflags"] = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        options["start_new_session"] = True
+    subprocess.Popen(
+        [*self_command(), "load", "--sheet", sheet, "--env", env, "--revalidate"],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        env=child_env,
+        **options
+    )
+
+
+def get_value(sheet_data, category: str, name: str):
+    """Gets the value in the sheet based on environment, category, and name."""
+    if not sheet_data:
+        return "No data found."
+    if not category or not name:
+        return "Category and name are required."
+
+    if category not in sheet_data:
+        raise CenvNotFoundError(f"Category '{category}' not found.")
+    if name not in sheet_data[category]:
+        raise CenvNotFoundError(f"Name '{name}' not found in category '{category}'.")
+
+    return sheet_data[category][name]
+
+
+def load_snapshot(sheet: str, env: str, max_age: int | None = None, stale_while_revalidate: int = 0,
+                  spreadsheet_id: str | None = None):
+    """Returns the stored snapshot of the sheet and env, downloading it when it isn't stored yet or expired."""
+    if configs.BUNDLE:
+        return bundle_snapshot(sheet, env, spreadsheet_id)
+
+    data = get_file_content(sheet, env, spreadsheet_id)
+    if is_offline():
+        # stored snapshots are served whatever their age
+        if data is None:
+            raise CenvNotFoundError(f"Sheet '{sheet}' env '{env}' is not stored and cenv is offline.")
+        return data
+
+    freshness = snapshot_freshness(data, max_age, stale_while_revalidate) if data is not None else "expired"
+    if freshness == "stale":
+        revalidate_in_background(sheet, env, spreadsheet_id)
+    elif freshness == "expired":
+        data = refresh_snapshot(sheet, env, max_age, stale_while_revalidate, spreadsheet_id)
+
+    if not data:
+        raise CenvNotFoundError("No data found.")
+
+    return data
+
+
+def load_value(sheet: str, env: str, category: str, name: str, memo=None, spreadsheet_id: str | None = None) -> str:
+    """
+    Loads sheet and finds and return a value from the local file based on the specified parameters.
+    Snapshots are served from the given memo, e.g. shared by the jobs of a multi-template inject,
+    or from the process memo. The sheet is in the configured spreadsheet unless another spreadsheet id is given.
+    """
+    with trace_span("lookup", sheet=sheet, env=env) as span:
+        response = daemon_request({
+            "op": "get",
+            "spreadsheet_id": spreadsheet_id,
+            "sheet": sheet,
+            "env": env,
+            "category": category,
+            "name": name,
+            "max_age": configs.MAX_AGE,
+            "stale_while_revalidate": configs.STALE_WHILE_REVALIDATE
+        })
+        if response is not None:
+            span.set(source="daemon")
+            return response["value"]
+
+        span.set(source="memo")
+        memo = process_memo if memo is None else memo
+        data = memo.get(sheet, env, configs.MAX_AGE, configs.STALE_WHILE_REVALIDATE, spreadsheet_id)
+        result = get_value(data, category, name)
+        return result
+
+
+def resolve_spreadsheet(spreadsheet: str | None) -> str | None:
+    """Returns the id of a spreadsheet alias or id, the configured spreadsheet when none is given."""
+    if not spreadsheet:
+        return configs.GOOGLE_SHEET_ID
+    return configs.SPREADSHEETS.get(spreadsheet, spreadsheet)
+
+
+# Google spreadsheet ids are long URL-safe base64 strings
+pattern_spreadsheet_id = re.compile(r'[\w-]{25,}')
+
+
+def split_spreadsheet(ref: str) -> tuple[str | None, str]:
+    """
+    Splits '[SPREADSHEET@]SHEET' into the spreadsheet id and the sheet name. Only a configured alias or a well-formed
+    id is taken as a spreadsheet, so sheet names containing '@' still work; '@SHEET' is the configured spreadsheet.
+    """
+    spreadsheet, separator, sheet = ref.partition("@")
+    if separator and (not spreadsheet or spreadsheet in configs.SPREADSHEETS
+                      or pattern_spreadsheet_id.fullmatch(spreadsheet)):
+        return resolve_spreadsheet(spreadsheet), sheet
+    return resolve_spreadsheet(None), ref
+
+
+def parse_cenv_url(url: str) -> tuple[str, str, str, str, str]:
+    """
+    Splits the cenv URL into spreadsheet id, sheet, env, category and name.
+    The spreadsheet is the configured one, unless the sheet is prefixed by a spreadsheet id or alias and '@'.
+    """
+    if not url.startswith("cenv://"):
+        raise CenvURLError("Invalid cenv URL. Must start with 'cenv://'.")
+
+    # Split the URL after the "cenv://" part
+    parts = url[7:].split("/", 3)
+
+    if len(parts) != 4:
+        raise CenvURLError(f"Invalid cenv URL format. Expect: 'cenv://[SPREADSHEET@]SHEET/ENV/CATEGORY/NAME', got: {url}")
+
+    spreadsheet_id, sheet = split_spreadsheet(parts[0])
+    _, env, category, name = parts
+    return spreadsheet_id, sheet, env, category, name
+
+
+def read_cenv_url(url: str, memo=None) -> str:
+    """Parses the cenv URL and retrieves the corresponding value."""
+    spreadsheet_id, sheet, env, category, name = parse_cenv_url(url)
+
+    return load_value(
+        sheet=sheet,
+        env=env,
+        category=category,
+        name=name,
+        memo=memo,
+        spreadsheet_id=spreadsheet_id
+    )
+
+
+def prefetch_cenv_urls(urls: list[str]):
+    """Downloads every (sheet, env) pair referenced by the URLs that is not stored yet, in one request per spreadsheet."""
+    if is_offline():
+        return
+    if daemon_request({"op": "prefetch", "urls": urls}) is not None:
+        return
+    prefetch_spreadsheets(cenv_url_keys(urls))
+
+
+def cenv_url_keys(urls: list[str]) -> list[tuple[str, str, str]]:
+    """Returns the (spreadsheet id, sheet, env) of every URL."""
+    keys = []
+    for url in urls:
+        try:
+            spreadsheet_id, sheet, env, _, _ = parse_cenv_url(url)
+        except ValueError:
+            # invalid URLs are reported when the value is resolved
+            continue
+        keys.append((spreadsheet_id, sheet, env))
+    return keys
+
+
+def group_by_spreadsheet(keys) -> dict[str, list[tuple[str, str]]]:
+    """Groups (spreadsheet id, sheet, env) keys into the (sheet, env) pairs of each spreadsheet."""
+    pairs = {}
+    for spreadsheet_id, sheet, env in keys:
+        pairs.setdefault(spreadsheet_id, []).append((sheet, env))
+    return pairs
+
+
+def prefetch_spreadsheets(keys: list[tuple[str, str, str]]):
+    """
+    Prefetches the (spreadsheet id, sheet, env) keys, the spreadsheets concurrently,
+    so the wait is the slowest spreadsheet's rather than the sum of them.
+    """
+    pairs = group_by_spreadsheet(keys)
+    if len(pairs) <= 1:
+        for spreadsheet_id, spreadsheet_pairs in pairs.items():
+            prefetch_snapshots(spreadsheet_pairs, spreadsheet_id)
+        return
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=len(pairs)) as pool:
+        futures = [pool.submit(prefetch_snapshots, spreadsheet_pairs, spreadsheet_id)
+                   for spreadsheet_id, spreadsheet_pairs in pairs.items()]
+    for future in futures:
+        future.result()
+
+
+@traced("prefetch", lambda pairs, spreadsheet_id=None: {"pairs": len(pairs), "spreadsheet": spreadsheet_id})
+def prefetch_snapshots(pairs: list[tuple[str, str]], spreadsheet_id: str | None = None):
+    """
+    Downloads every (sheet, env) pair of the spreadsheet that is not stored yet or expired, in one request.
+    The pairs' locks are held meanwhile, so concurrent processes download them once.
+    """
+    spreadsheet_id = spreadsheet_id or configs.GOOGLE_SHEET_ID
+
+    def outdated(sheet: str, env: str) -> bool:
+        data = get_file_content(sheet, env, spreadsheet_id)
+        return data is None or snapshot_freshness(data, configs.MAX_AGE, configs.STALE_WHILE_REVALIDATE) == "expired"
+
+    pending = sorted({(sheet, env) for sheet, env in pairs if outdated(sheet, env)})
+    if not pending:
+        return
+
+    store = snapshot_store()
+    with contextlib.ExitStack() as locks:
+        # Always taken in the same order and once each, so processes prefetching overlapping pairs can't deadlock
+        for path in sorted({store.lock_path(spreadsheet_id, sheet, env) for sheet, env in pending}):
+            locks.enter_context(file_lock(path))
+
+        # Read again, another process may have downloaded them while this one waited
+        missing = {}
+        expired = {}
+        for sheet, env in pending:
+            data = get_file_content(sheet, env, spreadsheet_id)
+            if data is None:
+                missing.setdefault(sheet, set()).add(env)
+            elif snapshot_freshness(data, configs.MAX_AGE, configs.STALE_WHILE_REVALIDATE) == "expired":
+                expired[(sheet, env)] = data
+
+        # One modifiedTime check covers every expired snapshot of the spreadsheet
+        modified_time = None
+        if expired:
+            modified_time = fetch_spreadsheet_modified_time(spreadsheet_id)
+            for (sheet, env), data in expired.items():
+                if modified_time is not None and modified_time == data.get("__MODIFIED_TIME__"):
+                    data["__FETCHED_AT__"] = time.time()
+                    store.write(data)
+                else:
+                    missing.setdefault(sheet, set()).add(env)
+
+        if missing:
+            download_snapshots(missing, modified_time, spreadsheet_id)
+
+
+def download_snapshots(sheet_envs: dict[str, set], modified_time: str | None = None,
+                       spreadsheet_id: str | None = None) -> dict[tuple, str]:
+    """Downloads the envs of every sheet in one request and stores them, returns their content hash by (sheet, env)."""
+    store = snapshot_store()
+    hashes = {}
+    rows_by_sheet = load_google_sheets(sorted(sheet_envs), spreadsheet_id, envs=sheet_envs)
+    for sheet, envs in sheet_envs.items():
+        rows = rows_by_sheet.get(sheet)
+        if not rows:
+            continue
+        for env in sorted(envs):
+            try:
+                data = sheet_to_map(rows, sheet, env, spreadsheet_id)
+            except CenvNotFoundError:
+                # unknown env, the lookup reports it when the value is resolved
+                continue
+            store.write(stamp_snapshot(data, rows, modified_time))
+            hashes[(sheet, env)] = data["__CONTENT_HASH__"]
+    return hashes
+
+
+# ------------------------------------------------------------
+# ENV RESOLVER
+# ------------------------------------------------------------
+
+# Define patterns for matching different parts of the .env syntax
+pattern_basic = re.compile(r'\$(\w+)')
+pattern_braced = re.compile(r'\${(\w+)(?::-([^}]+))?(?::\?([^}]+))?}')
+pattern_quoted = re.compile(r'^"(.*)"$')  # Pattern for detecting quoted strings
+pattern_comment = re.compile(r'(?<!\\) #.*$')  # Pattern to match unescaped `#` for comments
+
+
+def lookup_basic_var(env_vars, var_name: str) -> str:
+    """Value of $VAR, an empty template variable falls back to the environment."""
+    tmp_val = env_vars.get(var_name, None)
+    if tmp_val:
+        if tmp_val.startswith(('"', "'")):
+            tmp_val = tmp_val[1:]
+        if tmp_val.endswith(('"', "'")):
+            tmp_val = tmp_val[:-1]
+        return tmp_val
+    return os.getenv(var_name, '')
+
+
+def lookup_braced_var(env_vars, var_name: str, default_value: str | None, error_message: str | None) -> str:
+    """Value of ${VAR}, ${VAR:-default} or ${VAR:?error}."""
+    # Check if the variable exists in our env_vars or system environment
+    if var_name in env_vars:
+        tmp_val = env_vars[var_name]
+        if tmp_val.startswith('"'):
+            tmp_val = tmp_val[1:]
+        if tmp_val.endswith('"'):
+            tmp_val = tmp_val[:-1]
+        return tmp_val
+    elif var_name in os.environ:
+        return os.getenv(var_name)
+    elif default_value is not None:
+        return default_value
+    elif error_message is not None:
+        raise ValueError(error_message)
+    else:
+        return ''
+
+
+def resolve_value(env_vars, value):
+    # Check if the original value was quoted
+    is_quoted = pattern_quoted.match(value)
+
+    # Remove surrounding quotes if the value is quoted for internal processing
+    if is_quoted:
+        value = pattern_quoted.sub(r'\1', value)
+
+    # Resolve basic $VAR and braced ${VAR} patterns within the string
+    value = pattern_basic.sub(lambda match: lookup_basic_var(env_vars, match.group(1)), value)
+    value = pattern_braced.sub(lambda match: lookup_braced_var(env_vars, *match.groups()), value)
+
+    # If the initial value was quoted, apply quotes to the entire final resolved value
+    if is_quoted:
+        value = f'"{value}"'
+
+    return value
+
+
+# ------------------------------------------------------------
+# TEMPLATE ENGINE
+# ------------------------------------------------------------
+
+pattern_name = re.compile(r'\w+')
+pattern_quote = re.compile(r'["\']')
+
+# Comment lines, they are dropped with --skip-comments
+COMMENT_PREFIXES = ("#", "//", ";", '"', "'", "/*", "=")
+
+# Substituted $VAR values containing these characters can form new ${VAR} patterns
+BRACED_CHARACTERS = frozenset("${}")
+
+
+def strip_inline_comment(line: str) -> str:
+    """
+    Removes an inline comment, a " #" that is neither escaped nor inside quotes, in a single pass.
+    Same result as substituting (?<!\\)(["\'].*?["\']|[^"\']*?)(?<!\\) #.*$ with its group, without backtracking.
+    """
+    starts = []
+    index = line.find(" #")
+    while index != -1:
+        if index == 0 or line[index - 1] != "\\":
+            starts.append(index)
+        index = line.find(" #", index + 1)
+    if not starts:
+        return line.strip()
+
+    # Closing quotes directly followed by a comment
+    quoted_ends = [start - 1 for start in starts if start > 0 and line[start - 1] in "\"'"]
+
+    # The leftmost unescaped position where a comment can be matched wins, it's either
+    # the first quote-free run containing a comment or an opening quote with a quoted end after it
+    next_start = next_quoted_end = 0
+    run_start = 0
+    for quote in [match.start() for match in pattern_quote.finditer(line)] + [len(line)]:
+        while next_start < len(starts) and starts[next_start] < run_start:
+            next_start += 1
+        if next_start < len(starts) and starts[next_start] < quote:
+            return line[:starts[next_start]].strip()
+        if quote == len(line):
+            break
+
+        if quote == 0 or line[quote - 1] != "\\":
+            while next_quoted_end < len(quoted_ends) and quoted_ends[next_quoted_end] <= quote:
+                next_quoted_end += 1
+            if next_quoted_end < len(quoted_ends):
+                return line[:quoted_ends[next_quoted_end] + 1].strip()
+        run_start = quote + 1
+
+    return line.strip()
+
+
+def parse_braced_var(inner: str) -> tuple | None:
+    """Splits the inside of ${...} into name, default and error, None when it isn't a variable."""
+    match = pattern_name.match(inner)
+    if match is None:
+        return None
+    rest = inner[match.end():]
+    if not rest:
+        return match.group(), None, None
+    if len(rest) > 2 and rest.startswith(":-"):
+        return match.group(), rest[2:], None
+    if len(rest) > 2 and rest.startswith(":?"):
+        return match.group(), None, rest[2:]
+    return None
+
+
+class CompiledValue:
+    """
+    A template value split once into literals, $VAR and ${VAR} parts, resolved like resolve_value.
+    Values where substituting $VAR can form a new ${...} are resolved by resolve_value instead.
+    """
+
+    __slots__ = ("source", "quoted", "parts")
+
+    def __init__(self, source: str):
+        self.source = source
+        self.quoted = len(source) >= 2 and source[0] == '"' and source[-1] == '"'
+        self.parts = self.compile(source[1:-1] if self.quoted else source)
+
+    @staticmethod
+    def compile(text: str) -> list | None:
+        parts = []
+        literal_start = index = 0
+        while (index := text.find("$", index)) != -1:
+            if text.startswith("{", index + 1):
+                close = text.find("}", index + 2)
+                if text.find("$", index + 2, len(text) if close == -1 else close) != -1:
+                    return None
+                braced = parse_braced_var(text[index + 2:close]) if close != -1 else None
+                if braced is not None:
+                    parts.append(text[literal_start:index])
+                    parts.append(("braced", *braced))
+                    literal_start = index = close + 1
+                    continue
+            else:
+                match = pattern_name.match(text, index + 1)
+                if match is not None:
+                    # a $ before $VAR turns into ${ when the substituted value is empty
+                    if index > 0 and text[index - 1] == "$":
+                        return None
+                    parts.append(text[literal_start:index])
+                    parts.append(("var", match.group()))
+                    literal_start = index = match.end()
+                    continue
+            index += 1
+        parts.append(text[literal_start:])
+        return [part for part in parts if part != ""]
+
+    def resolve(self, env_vars) -> str:
+        if self.parts is None:
+            return resolve_value(env_vars, self.source)
+
+        # Every $VAR is substituted before any ${VAR}, like resolve_value
+        resolved = []
+        for part in self.parts:
+            if isinstance(part, tuple) and part[0] == "var":
+                part = lookup_basic_var(env_vars, part[1])
+                if not BRACED_CHARACTERS.isdisjoint(part):
+                    return resolve_value(env_vars, self.source)
+            resolved.append(part)
+        value = "".join(
+            lookup_braced_var(env_vars, *part[1:]) if isinstance(part, tuple) else part for part in resolved
+        )
+
+        if self.quoted:
+            value = f'"{value}"'
+        return value
+
+
+def compile_template_text(text: str, skip_comments: bool) -> tuple:
+    """
+    Compiles the lines of a template into (key, CompiledValue) for every assignment,
+    (None, line) for the lines retained as is and (CenvTemplateError, message) for a broken assignment.
+    """
+    lines = text.split("\n")
+    if lines[-1] == "":
+        lines.pop()
+
+    compiled = []
+    for line_number, line in enumerate(lines, 1):
+        stripped_line = line.strip()
+        is_comment = stripped_line.startswith(COMMENT_PREFIXES)
+
+        if skip_comments:
+            # Remove inline comments if they're outside of quotes
+            stripped_line = strip_inline_comment(stripped_line)
+
+        if skip_comments and is_comment:
+            continue
+        if not is_comment and "=" in stripped_line:
+            # Remove inline comments only if they are outside of quotes
+            line_no_comment = strip_inline_comment(stripped_line)
+            if "=" not in line_no_comment:
+                compiled.append((
+                    CenvTemplateError, f"line {line_number}: the '=' of '{stripped_line}' is in a comment, expect KEY=VALUE"
+                ))
+                continue
+
+            # Process key-value pairs
+            first, second = line_no_comment.split("=", 1)
+            compiled.append((first.strip(), CompiledValue(second.strip())))
+        else:
+            # Retain full line if it’s a comment or doesn’t contain '='
+            compiled.append((None, stripped_line))
+    return tuple(compiled)
+
+
+# Compiled templates by content hash, repeated renders of a template skip parsing
+compiled_templates = {}
+
+
+def compile_template(template_path: str, skip_comments: bool) -> tuple:
+    """Returns the compiled lines of the template file, see compile_template_text."""
+    if not os.path.exists(template_path):
+        raise FileNotFoundError(f"Template file '{template_path}' does not exist.")
+
+    with open(template_path, 'r') as file:
+        text = file.read()
+
+    key = (hashlib.sha256(text.encode()).hexdigest(), skip_comments)
+    compiled = compiled_templates.get(key)
+    if compiled is None:
+        with trace_span("template.compile", template=template_path, bytes=len(text)):
+            compiled = compile_template_text(text, skip_comments)
+        compiled_templates[key] = compiled
+    return compiled
+
+
+# ------------------------------------------------------------
+# OFFLINE BUNDLES
+# ------------------------------------------------------------
+
+# A bundle is the magic and the sha256 of the payload on the first line, then the zlib compressed JSON snapshots
+BUNDLE_MAGIC = b"CENVBDL1"
+
+# Bundles read by this process, by path
+loaded_bundles = {}
+
+
+def write_bundle(path: str, snapshots: list[dict]) -> str:
+    """Writes the snapshots to a bundle file and returns its sha256."""
+    payload = zlib.compress(json.dumps({
+        "version": project_version,
+        "created_at": time.time(),
+        "snapshots": snapshots
+    }).encode(), 9)
+    digest = hashlib.sha256(payload).hexdigest()
+    write_file_atomic(path, BUNDLE_MAGIC + digest.encode() + b"\n" + payload)
+    return digest
+
+
+def read_bundle(path: str) -> dict[tuple, dict]:
+    """Reads and verifies a bundle file, returns its snapshots by (spreadsheet id, sheet, env)."""
+    try:
+        with open(path, "rb") as f:
+            content = f.read()
+    except OSError as err:
+        raise CenvError(f"Can't read the bundle '{path}': {err.strerror}.")
+
+    header, _, payload = content.partition(b"\n")
+    if not header.startswith(BUNDLE_MAGIC):
+        raise CenvError(f"'{path}' is not a cenv bundle.")
+    if hashlib.sha256(payload).hexdigest().encode() != header[len(BUNDLE_MAGIC):]:
+        raise CenvError(f"The bundle '{path}' is corrupted, its checksum doesn't match.")
+
+    snapshots = json.loads(zlib.decompress(payload))["snapshots"]
+    return {(data["__SHEET_ID__"], data["__SHEET__"], data["__ENV__"]): data for data in snapshots}
+
+
+def bundle_snapshot(sheet: str, env: str, spreadsheet_id: str | None = None):
+    """Returns the snapshot of the sheet and env from the configured bundle."""
+    snapshots = loaded_bundles.get(configs.BUNDLE)
+    if snapshots is None:
+        snapshots = loaded_bundles[configs.BUNDLE] = read_bundle(configs.BUNDLE)
+
+    spreadsheet_id = spreadsheet_id or configs.GOOGLE_SHEET_ID
+    data = snapshots.get((spreadsheet_id, sheet, env))
+    if data is None and spreadsheet_id is None:
+        # the bundle tells the spreadsheet when none is configured
+        data = next((data for key, data in snapshots.items() if key[1:] == (sheet, env)), None)
+    if data is None:
+        raise CenvNotFoundError(f"Sheet '{sheet}' env '{env}' is not in the bundle '{configs.BUNDLE}'.")
+    return data
+
+
+# ------------------------------------------------------------
+# DAEMON
+# ------------------------------------------------------------
+
+DAEMON_TIMEOUT = 60
+
+# Disabled inside the daemon itself, so it never sends requests to itself
+daemon_client_enabled = True
+
+# Errors the daemon reports by name, so the client raises the same type
+CENV_ERRORS = {
+    error.__name__: error
+    for error in (CenvError, CenvURLError, CenvTemplateError, CenvNotFoundError, CenvAuthError, CenvFetchError)
+}
+
+
+class DaemonFallback(Exception):
+    """Raised by the daemon when the request has to be served by the client process itself."""
+    pass
+
+
+def daemon_client_config() -> dict:
+    """The configuration a client shares with the daemon answering it: spreadsheet, snapshot store and credentials."""
+    credential = f"{configs.GOOGLE_CREDENTIAL_BASE64 or ''}\0{os.path.abspath(configs.USER_TOKEN_FILE)}"
+    return {
+        "sheet_id": configs.GOOGLE_SHEET_ID,
+        "store": os.path.abspath(configs.CONFIG_FILE),
+        "credential": hashlib.sha256(credential.encode()).hexdigest()
+    }
+
+
+def daemon_request(payload: dict) -> dict | None:
+    """
+    Sends a request to the 'cenv serve' daemon, along with the client's configuration.
+    Returns None when the daemon isn't running or can't serve the request, so the caller falls back to in-process.
+    """
+    if not daemon_client_enabled or is_offline() or not configs.SOCKET_FILE or not hasattr(socket, "AF_UNIX"):
+        return None
+    if not os.path.exists(configs.SOCKET_FILE):
+        return None
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(DAEMON_TIMEOUT)
+            client.connect(configs.SOCKET_FILE)
+            client.sendall(json.dumps({**daemon_client_config(), **payload}).encode() + b"\n")
+            with client.makefile("rb") as reader:
+                line = reader.readline()
+        response = json.loads(line)
+    except (OSError, ValueError):
+        return None
+
+    if response.get("fallback"):
+        return None
+    if not response.get("ok"):
+        error_class = CENV_ERRORS.get(response.get("error_type"), CenvError)
+        raise error_class(response.get("error"))
+    return response
+
+
+class SnapshotMemo:
+    """
+    Keeps parsed snapshots in memory, revalidated against the store files' inode, modification time and size,
+    so a snapshot is parsed once per process and a rewrite by another process is still noticed.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def stamp(path: str):
+        try:
+            st = os.stat(path)
+            return st.st_ino, st.st_mtime_ns, st.st_size
+        except OSError:
+            return None
+
+    def stamps(self, paths) -> tuple:
+        return tuple(self.stamp(path) for path in paths)
+
+    def key_lock(self, key) -> threading.Lock:
+        with self.lock:
+            return self.locks.setdefault(key, threading.Lock())
+
+    def cached(self, key, paths, sheet: str, env: str, max_age: int | None, stale_while_revalidate: int,
+               spreadsheet_id: str):
+        """Returns the snapshot in memory, unless the store files changed since or it expired."""
+        cached = self.entries.get(key)
+        if cached is None or cached[0] != self.stamps(paths):
+            return None
+        freshness = snapshot_freshness(cached[1], max_age, stale_while_revalidate)
+        if freshness == "stale":
+            revalidate_in_background(sheet, env, spreadsheet_id)
+        return cached[1] if freshness != "expired" else None
+
+    def get(self, sheet: str, env: str, max_age: int | None = None, stale_while_revalidate: int = 0,
+            spreadsheet_id: str | None = None):
+        if configs.BUNDLE:
+            # bundles are kept in memory once read
+            return load_snapshot(sheet, env, max_age, stale_while_revalidate, spreadsheet_id)
+
+        spreadsheet_id = spreadsheet_id or configs.GOOGLE_SHEET_ID
+        store = snapshot_store()
+        key = (store.directory, spreadsheet_id, sheet, env)
+        paths = (store.entry_path(spreadsheet_id, sheet, env), store.index_path(spreadsheet_id, sheet))
+
+        data = self.cached(key, paths, sheet, env, max_age, stale_while_revalidate, spreadsheet_id)
+        if data is not None:
+            return data
+
+        # Misses of a key are serialized and the first one is served to the others,
+        # so concurrent clients don't download or parse the same snapshot twice
+        with self.key_lock(key):
+            data = self.cached(key, paths, sheet, env, max_age, stale_while_revalidate, spreadsheet_id)
+            if data is None:
+                data = load_snapshot(sheet, env, max_age, stale_while_revalidate, spreadsheet_id)
+                self.entries[key] = (self.stamps(paths), data)
+            return data
+
+
+# Serves the lookups of this process that aren't given a memo of their own
+process_memo = SnapshotMemo()
+
+
+def daemon_handle_request(memo: SnapshotMemo, request: dict) -> dict:
+    op = request.get("op")
+    if op == "ping":
+        return {"version": project_version, "pid": os.getpid()}
+
+    # The daemon serves the clients configured like itself, with the same store and credentials,
+    # they may refer to other spreadsheets
+    if any(request.get(name) != value for name, value in daemon_client_config().items()):
+        raise DaemonFallback()
+
+    if op == "get":
+        data = memo.get(request["sheet"], request["env"], request.get("max_age"),
+                        request.get("stale_while_revalidate") or 0, request.get("spreadsheet_id"))
+        return {"value": get_value(data, request["category"], request["name"])}
+    elif op == "prefetch":
+        prefetch_cenv_urls(request.get("urls", []))
+        return {}
+
+    raise DaemonFallback()
+
+
+def create_daemon_server(socket_path: str):
+    """Creates the Unix socket server answering the lookups of get, read and inject."""
+    import socketserver
+
+    memo = SnapshotMemo()
+
+    class DaemonRequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                try:
+                    response = {"ok": True, **daemon_handle_request(memo, json.loads(line))}
+                except CenvError as err:
+                    response = {"ok": False, "error": str(err), "error_type": type(err).__name__}
+                except (Exception, SystemExit) as err:
+                    # let the client reproduce the failure in-process
+                    response = {"ok": False, "fallback": True, "error": repr(err)}
+                self.wfile.write(json.dumps(response).encode() + b"\n")
+                self.wfile.flush()
+
+    class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    # The socket is only accessible to the current user
+    old_umask = os.umask(0o177)
+    try:
+        return DaemonServer(socket_path, DaemonRequestHandler)
+    finally:
+        os.umask(old_umask)
+
+
+# ------------------------------------------------------------
+# CLIENT
+# ------------------------------------------------------------
+
+class CenvClient:
+    """
+    Resolves cenv:// URLs from Python code, failures are raised as CenvError subclasses instead of exiting.
+    The snapshots are kept in memory and shared by every call of the client.
+
+        client = CenvClient()
+        values = await client.resolve_many(["cenv://Env/Staging/Database/Url", "cenv://Env/Staging/Redis/Url"])
+    """
+
+    def __init__(self):
+        self.memo = SnapshotMemo()
+
+    @staticmethod
+    def parse(url: str) -> tuple[str, str, str, str, str]:
+        parsed = parse_cenv_url(url)
+        if not all(parsed[1:]):
+            raise CenvURLError(f"Sheet, env, category and name are required, got: {url}")
+        return parsed
+
+    @staticmethod
+    def value(data, category: str, name: str) -> str:
+        # get_value answers the command line with a message instead of raising for an empty snapshot
+        if not data:
+            raise CenvNotFoundError("No data found.")
+        return get_value(data, category, name)
+
+    def resolve(self, url: str) -> str:
+        """Resolves a single URL, blocking."""
+        spreadsheet_id, sheet, env, category, name = self.parse(url)
+        data = self.memo.get(sheet, env, configs.MAX_AGE, configs.STALE_WHILE_REVALIDATE, spreadsheet_id)
+        return self.value(data, category, name)
+
+    async def resolve_many(self, urls: list[str]) -> dict[str, str]:
+        """
+        Resolves the URLs without blocking the event loop, returns the values by URL.
+        The missing sheets are downloaded together, one request per spreadsheet and the spreadsheets concurrently,
+        then the snapshots are read concurrently.
+        """
+        import asyncio
+
+        parsed = {url: self.parse(url) for url in urls}
+        await asyncio.to_thread(prefetch_cenv_urls, list(parsed))
+
+        keys = list(dict.fromkeys((spreadsheet_id, sheet, env) for spreadsheet_id, sheet, env, _, _ in parsed.values()))
+        snapshots = await asyncio.gather(*(
+            asyncio.to_thread(self.memo.get, sheet, env, configs.MAX_AGE, configs.STALE_WHILE_REVALIDATE, spreadsheet_id)
+            for spreadsheet_id, sheet, env in keys
+        ))
+        snapshots = dict(zip(keys, snapshots))
+
+        return {
+            url: self.value(snapshots[(spreadsheet_id, sheet, env)], category, name)
+            for url, (spreadsheet_id, sheet, env, category, name) in parsed.items()
+        }
+
+
+# ------------------------------------------------------------
+# COMMANDS
+# ------------------------------------------------------------
+def read_google_token_creds(warn_missing_scopes: bool = True):
+    creds = None
+    if os.path.exists(configs.USER_TOKEN_FILE):
+        import httplib2
+        from google_auth_httplib2 import Request
+
+        with open(configs.USER_TOKEN_FILE, 'rb') as token:
+            with trace_span("credentials.unpickle", kind="user"):
+                creds = pickle.load(token)
+            if not creds or not creds.valid:
+                if creds and creds.expired and creds.refresh_token:
+                    with trace_span("credentials.refresh", kind="user"):
+                        creds.refresh(Request(httplib2.Http()))
+                    # Save the refreshed access token, so the next runs don't refresh it again
+                    save_google_token_creds(creds)
+                else:
+                    creds = None
+    if creds and warn_missing_scopes and not creds.has_scopes(configs.SCOPES):
+        # without the Drive metadata scope, every revalidation downloads the whole sheet again
+        print("Warning: the Google login lacks a scope cenv needs to revalidate snapshots cheaply, "
+              "run 'cenv login' to renew it.", file=sys.stderr)
+    return creds
+
+
+def save_google_token_creds(creds):
+    write_file_atomic(configs.USER_TOKEN_FILE, pickle.dumps(creds), 0o600)
+
+
+def google_logout_command():
+    if os.path.exists(configs.USER_TOKEN_FILE):
+        os.remove(configs.USER_TOKEN_FILE)
+
+
+def google_login_command():
+    import httplib2
+    from google_auth_httplib2 import Request
+    from google_auth_oauthlib.flow import InstalledAppFlow
+
+    creds = read_google_token_creds(warn_missing_scopes=False)
+    # tokens granted before a scope was added, e.g. the Drive metadata one, need a fresh login
+    if creds and not creds.has_scopes(configs.SCOPES):
+        creds = None
+
+    # If no valid credentials, go through OAuth flow
+    if not creds or not creds.valid:
+        if creds and creds.expired and creds.refresh_token:
+            creds.refresh(Request(httplib2.Http()))
         else:
             flow = InstalledAppFlow.from_client_config(
                 json.loads(load_embedded_file('client_secret.json')),
-                scopes=["https://www.googleapis.com/auth/spreadsheets.readonly"]
+                scopes=configs.SCOPES
             )
             creds = flow.run_local_server(port=0)
 
         # Save the credentials for future runs
-        with open(configs.USER_TOKEN_FILE, 'wb') as token:
-            pickle.dump(creds, token)
+        ensure_directory_exists(os.path.dirname(configs.USER_TOKEN_FILE))
+        save_google_token_creds(creds)
 
     return creds
 
 
-def load_command(sheet: str, env: str):
-    """Downloads the Google Sheets data and saves it locally."""
-    load_file_and_save(sheet_name=sheet, env=env)
-    print(f"Data loaded and saved to {configs.CONFIG_FILE}.")
+def load_command(sheet: str, env: str | None = None, revalidate: bool = False, output: str | None = None):
+    """Downloads the Google Sheets data and saves it locally, every env of the sheet when no env is given."""
+    if env is None:
+        load_index_command(sheet, revalidate, output)
+        return
+
+    with snapshot_store().lock(configs.GOOGLE_SHEET_ID, sheet, env):
+        data = get_file_content(sheet, env) if revalidate else None
+        if data is not None:
+            data = revalidate_snapshot(sheet, env, data)
+        else:
+            data = load_file_and_save(sheet_name=sheet, env=env)
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(snapshot_to_dict(data), f, indent=4)
+    path = snapshot_store().entry_path(configs.GOOGLE_SHEET_ID, sheet, env)
+    print(f"Data loaded and saved to {path}.")
+
+
+def load_index_command(sheet: str, revalidate: bool = False, output: str | None = None):
+    store = snapshot_store()
+    with store.lock(configs.GOOGLE_SHEET_ID, sheet, ""):
+        index = store.read_index(configs.GOOGLE_SHEET_ID, sheet) if revalidate else None
+        modified_time = fetch_spreadsheet_modified_time() if index is not None else None
+        if modified_time is not None and modified_time == index.meta.get("__MODIFIED_TIME__"):
+            index.meta["__FETCHED_AT__"] = time.time()
+            path = store.write_index(index)
+        else:
+            index, path = load_sheet_index_and_save(sheet, modified_time)
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(index.to_dict(), f, indent=4)
+    print(f"Data of {len(index.envs)} envs loaded and saved to {path}.")
+
+
+EXPORT_FORMATS = ("json", "env", "yaml")
+DEFAULT_EXPORT_PATTERN = "{sheet}.{env}.{ext}"
+
+
+def env_var_name(category: str, name: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_]", "_", f"{category}_{name}").upper()
+
+
+def quote_env_value(value: str) -> str:
+    """Quotes the value for a .env file when it isn't a plain word."""
+    if re.fullmatch(r"[A-Za-z0-9_./:@%+,=-]*", value):
+        return value
+    if "'" not in value and "\n" not in value:
+        return f"'{value}'"
+    escaped = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'"{escaped}"'
+
+
+def format_export(values: dict, fmt: str) -> str:
+    """Formats the {category: {name: value}} of an env as JSON, a .env file (CATEGORY_NAME=value) or YAML."""
+    if fmt == "json":
+        return json.dumps(values, indent=4, ensure_ascii=False) + "\n"
+    if fmt == "env":
+        return "".join(f"{env_var_name(category, name)}={quote_env_value(value)}\n"
+                       for category, names in values.items() for name, value in names.items())
+    import yaml
+    return yaml.safe_dump(values, default_flow_style=False, sort_keys=False, allow_unicode=True)
+
+
+def export_command(sheet: str, envs: list[str] | None, fmt: str, output_pattern: str | None = None):
+    """
+    Writes a file per env of the sheet, every env or the given ones, from a single download and a single pass
+    over the rows. Outputs are named by the pattern, with {sheet}, {env} and {ext} (the format).
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise CenvError(f"Unknown export format '{fmt}', expect one of: {', '.join(EXPORT_FORMATS)}.")
+    if is_offline():
+        raise CenvError("export downloads the sheet, it can't run offline.")
+
+    if envs:
+        rows = load_google_sheet(sheet, envs)
+        with trace_span("index.build", sheet=sheet, rows=len(rows)):
+            index = SheetIndex.build(rows, sheet, configs.GOOGLE_SHEET_ID)
+        unknown = [env for env in envs if env not in index.envs]
+        if unknown:
+            raise CenvNotFoundError(f"Env '{unknown[0]}' not found in sheet '{sheet}'.")
+    else:
+        # the whole sheet is downloaded anyway, so its index is stored for the lookups
+        with snapshot_store().lock(configs.GOOGLE_SHEET_ID, sheet, ""):
+            index, _ = load_sheet_index_and_save(sheet)
+        envs = index.envs
+
+    for env in envs:
+        data = index.snapshot(env).to_dict()
+        values = {category: names for category, names in data.items() if isinstance(names, dict)}
+        output = (output_pattern or DEFAULT_EXPORT_PATTERN).format(sheet=sheet, env=env, ext=fmt)
+        with open_atomic(output, text=True) as f:
+            f.write(format_export(values, fmt))
+        print(f"{env} exported to {output}.")
+
+
+def export_bundle_command(pairs: list[str], templates: list[str], output: str):
+    """Downloads the (sheet, env) pairs and those referenced by the templates once, into an offline bundle."""
+    wanted = {}
+    for pair in pairs:
+        parts = pair.split("/")
+        if len(parts) != 2 or not all(parts):
+            raise CenvError(f"Invalid pair '{pair}', expect: [SPREADSHEET@]SHEET/ENV.")
+        spreadsheet_id, sheet = split_spreadsheet(parts[0])
+        wanted[(spreadsheet_id, sheet, parts[1])] = True
+    for template in templates:
+        wanted.update(dict.fromkeys(cenv_url_keys(collect_template_cenv_urls(template, False)), True))
+    if not wanted:
+        raise CenvError("Nothing to bundle, give SHEET/ENV pairs or --template.")
+
+    if not is_offline():
+        prefetch_spreadsheets(list(wanted))
+
+    snapshots = []
+    for spreadsheet_id, sheet, env in wanted:
+        data = load_snapshot(sheet, env, spreadsheet_id=spreadsheet_id)
+        snapshots.append(snapshot_to_dict(data))
+
+    digest = write_bundle(output, snapshots)
+    print(f"{len(snapshots)} snapshots bundled to {output} (sha256 {digest}).")
 
 
 def delete_command():
@@ -594,6 +2777,38 @@ def read_command(cenv_url: str):
     print(read_cenv_url(cenv_url))
 
 
+def serve_command(socket_path: str):
+    """Runs the daemon answering get, read and inject lookups over a Unix socket until it's terminated."""
+    global daemon_client_enabled
+
+    if not hasattr(socket, "AF_UNIX"):
+        raise CenvError("'cenv serve' requires Unix domain sockets, which are not supported on this platform.")
+
+    configs.SOCKET_FILE = socket_path
+    if daemon_request({"op": "ping"}) is not None:
+        raise CenvError(f"cenv is already serving on {socket_path}.")
+    daemon_client_enabled = False
+
+    ensure_directory_exists(os.path.dirname(socket_path))
+    if os.path.exists(socket_path):
+        # left behind by a daemon that didn't shut down cleanly
+        os.remove(socket_path)
+
+    import signal
+    signal.signal(signal.SIGTERM, lambda signum, frame: exit(0))
+
+    server = create_daemon_server(socket_path)
+    print(f"Serving on {socket_path}.", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
 def status_command(fmt: str):
     def status_msg(ok: bool):
         return f"{'ok' if ok else 'error'}"
@@ -627,82 +2842,359 @@ def status_command(fmt: str):
         "google_sheet_id": f"{configs.GOOGLE_SHEET_ID}",
         "google_sheet_name": f"{configs.GOOGLE_SHEET_NAME}",
         "storage_config_file": f"{configs.CONFIG_FILE}",
+        "storage_format": f"{configs.STORE_FORMAT}",
+        "storage_snapshots": f"{len(snapshot_store().entries())}",
         "token_file": f"{status_msg(check_google_token_file())}",
         "credentials": f"{creds_status()}"
     }
     if fmt == "json":
         print(json.dumps(status, indent=4))
     else:
+        import yaml
         yaml.dump(status, sys.stdout, default_flow_style=False)
 
 
-def inject_command(template_path: str, skip_comments: bool):
-    """Processes a template file, replacing placeholders with actual data."""
+def read_template(template_path: str, skip_comments: bool):
+    """
+    Reads a template file and yields (key, CompiledValue) for every assignment
+    and (None, line) for the lines retained as is.
+    """
+    for key, value in compile_template(template_path, skip_comments):
+        if key is CenvTemplateError:
+            raise CenvTemplateError(f"Invalid template '{template_path}', {value}.")
+        yield key, value
+
+
+def unquote_cenv_value(value: str) -> tuple[str, bool]:
+    """Returns the cenv URL without surrounding quotes and whether it was quoted."""
+    if value.startswith(("\"", "'")):
+        return value[1:-1], True
+    return value, False
+
+
+def is_cenv_value(value: str) -> bool:
+    return value.startswith(("cenv://", "\"cenv://", "'cenv://"))
+
+
+def collect_template_cenv_urls(template_path: str, skip_comments: bool) -> list[str]:
+    """
+    Resolves the template variables without downloading anything and returns the cenv URLs it refers to.
+    URLs depending on values that are themselves read from a sheet can't be known upfront and are skipped.
+    """
+    unresolved = "\0cenv\0"
+    env_vars = {}
+    urls = []
+    for key, compiled_value in read_template(template_path, skip_comments):
+        if key is None:
+            continue
+        try:
+            value = compiled_value.resolve(env_vars)
+        except ValueError:
+            # the error is raised again when the template is rendered
+            break
+        if is_cenv_value(value):
+            url, _ = unquote_cenv_value(value)
+            if unresolved not in url:
+                urls.append(url)
+            value = unresolved
+        env_vars[key] = value
+    return urls
+
+
+def render_template(template_path: str, skip_comments: bool, env_vars: dict | None = None, memo=None):
+    """Yields the output lines of the template as soon as each of them is resolved."""
+    env_vars = {} if env_vars is None else env_vars
+
+    for key, compiled_value in read_template(template_path, skip_comments):
+        if key is None:
+            yield compiled_value
+            continue
+
+        # Resolve the value with your custom logic
+        value = compiled_value.resolve(env_vars)
+        if is_cenv_value(value):
+            value, has_q = unquote_cenv_value(value)
+            value = read_cenv_url(value, memo)
+            if has_q:
+                value = f'"{value}"'
+        env_vars[key] = value
+
+        # Add resolved key-value to output
+        yield f"{key}={value}"
+
+
+def write_rendered_template(template_path: str, skip_comments: bool, output: str, memo=None):
+    """Renders the template into a temp file renamed to the output once the whole template is rendered."""
+    # an existing output keeps its permissions
+    mode = stat.S_IMODE(os.stat(output).st_mode) if os.path.exists(output) else None
+    with trace_span("template.render", template=template_path, output=output), \
+            open_atomic(output, mode, text=True) as f:
+        for line in render_template(template_path, skip_comments, memo=memo):
+            f.write(line + "\n")
+
+
+def inject_command(template_path: str, skip_comments: bool, output: str | None = None):
+    """
+    Processes a template file, replacing placeholders with actual data.
+    The lines are streamed to stdout, or to a temp file renamed to the output once the whole template is rendered.
+    """
     if not os.path.exists(template_path):
         raise FileNotFoundError(f"Template file '{template_path}' does not exist.")
 
-    env_vars = {}
+    # Download every referenced sheet before anything is resolved
+    prefetch_cenv_urls(collect_template_cenv_urls(template_path, skip_comments))
 
-    output_lines = []
+    if output is None:
+        with trace_span("template.render", template=template_path):
+            for line in render_template(template_path, skip_comments):
+                sys.stdout.write(line + "\n")
+                sys.stdout.flush()
+    else:
+        write_rendered_template(template_path, skip_comments, output)
 
-    # Regular expression to strip comments that are outside of quoted strings
-    comment_pattern = re.compile(r'(?<!\\)(?:"[^"]*"|\'[^\']*\'|[^\'"#])*?#.*$')
-    pattern_comment = re.compile(r'(?<!\\)(["\'].*?["\']|[^"\']*?)(?<!\\) #.*$')
 
-    def remove_comment(line_to_clean):
-        """
-        Remove any inline comment that starts with # outside of quoted strings.
-        """
-        # Remove the comment if it's outside of quotes
-        cleaned_line = pattern_comment.sub(r'\1', line_to_clean).strip()
-        return cleaned_line
+TEMPLATE_SUFFIX = ".template"
+DEFAULT_OUTPUT_PATTERN = "{dir}/{stem}"
+DEFAULT_RUN_TEMPLATE = ".env" + TEMPLATE_SUFFIX
 
-    with open(template_path, 'r') as file:
-        for line in file:
-            stripped_line = line.strip()
-            is_comment = stripped_line.startswith(("#", "//", ";", '"', "'", "/*", "="))
 
-            if skip_comments:
-                # Remove inline comments if they're outside of quotes
-                stripped_line = remove_comment(stripped_line)
+def find_templates(paths: list[str]) -> list[str]:
+    """Returns the template files, directories are searched recursively for *.template files."""
+    templates = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                templates.extend(os.path.join(root, name) for name in sorted(files) if name.endswith(TEMPLATE_SUFFIX))
+        elif not os.path.exists(path):
+            raise FileNotFoundError(f"Template file '{path}' does not exist.")
+        else:
+            templates.append(path)
+    return templates
 
-            if skip_comments and is_comment:
-                continue
-            if not is_comment and "=" in stripped_line:
-                # Remove inline comments only if they are outside of quotes
-                line_no_comment = remove_comment(stripped_line)
-
-                # Process key-value pairs
-                first, second = line_no_comment.split("=", 1)
-                key = first.strip()
-                source_value = second.strip()
-
-                # Resolve the value with your custom logic
-                value = resolve_value(env_vars, source_value)
-                if value.startswith(("cenv://", "\"cenv://", "'cenv://")):
-                    has_q = False
-                    if value.startswith(("\"", "'")):
-                        value = value[1:-1]
-                        has_q = True
-                    value = read_cenv_url(value)
-                    if has_q:
-                        value = f'"{value}"'
-                env_vars[key] = value
-
-                # Add resolved key-value to output
-                output_lines.append(f"{key}={value}")
-            else:
-                # Retain full line if it’s a comment or doesn’t contain '='
-                output_lines.append(stripped_line)
 
-    print("\n".join(output_lines))
+def template_output_path(template_path: str, output_pattern: str) -> str:
+    """
+    Formats the output pattern of a template: {dir} is the template's directory, {name} its file name
+    and {stem} its file name without the .template suffix.
+    """
+    directory, name = os.path.split(template_path)
+    stem = name[:-len(TEMPLATE_SUFFIX)] if name.endswith(TEMPLATE_SUFFIX) and name != TEMPLATE_SUFFIX else name
+    output = output_pattern.format(dir=directory or ".", name=name, stem=stem)
+    if os.path.abspath(output) == os.path.abspath(template_path):
+        raise CenvError(f"The output of '{template_path}' would overwrite the template, use --output-pattern.")
+    return output
+
+
+def inject_templates_command(paths: list[str], skip_comments: bool, output: str | None = None,
+                             output_pattern: str | None = None, jobs: int = 4):
+    """
+    Renders many templates concurrently. Every sheet they refer to is downloaded once upfront,
+    then the jobs share the authenticated client and an in-memory snapshot cache.
+    """
+    if len(paths) == 1 and os.path.isfile(paths[0]) and output_pattern is None:
+        inject_command(paths[0], skip_comments, output)
+        return
+    if output is not None:
+        raise CenvError("--output takes a single template, use --output-pattern for many templates.")
+
+    templates = find_templates(paths)
+    if not templates:
+        raise CenvError(f"No {TEMPLATE_SUFFIX} files found.")
+    outputs = [template_output_path(template, output_pattern or DEFAULT_OUTPUT_PATTERN) for template in templates]
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    memo = SnapshotMemo()
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        url_lists = pool.map(lambda template: collect_template_cenv_urls(template, skip_comments), templates)
+        prefetch_cenv_urls([url for urls in url_lists for url in urls])
+
+        futures = [
+            pool.submit(write_rendered_template, template, skip_comments, output, memo)
+            for template, output in zip(templates, outputs)
+        ]
+
+    failed = 0
+    for template, output, future in zip(templates, outputs, futures):
+        error = future.exception()
+        if error is None:
+            print(f"{template} injected to {output}.")
+        else:
+            failed += 1
+            print(f"{template}: {error}", file=sys.stderr)
+    if failed:
+        raise CenvError(f"{failed} of {len(templates)} templates failed.")
+
+
+class TemplateWatcher:
+    """
+    Renders templates again when the sheets they refer to or the templates themselves changed.
+    Each spreadsheet's modifiedTime is the change signal, its sheets are only downloaded once it moved
+    (every poll when it can't be read, then their content hash tells whether they changed).
+    An output is only rewritten when its rendered content differs from the file.
+    """
+
+    def __init__(self, templates: list[str], outputs: list[str], skip_comments: bool):
+        self.templates = templates
+        self.outputs = outputs
+        self.skip_comments = skip_comments
+        self.modified_times = {}
+        self.content_hashes = {}
+        self.template_stamps = None
+
+    def poll_spreadsheet(self, spreadsheet_id: str, pairs: list[tuple[str, str]], force: bool) -> bool:
+        """Downloads the spreadsheet's sheets when it was modified, returns whether their content changed."""
+        modified_time = fetch_spreadsheet_modified_time(spreadsheet_id)
+        if not force and modified_time is not None and modified_time == self.modified_times.get(spreadsheet_id):
+            return False
+
+        sheet_envs = {}
+        for sheet, env in pairs:
+            sheet_envs.setdefault(sheet, set()).add(env)
+        content_hashes = download_snapshots(sheet_envs, modified_time, spreadsheet_id)
+        changed = content_hashes != self.content_hashes.get(spreadsheet_id)
+        self.modified_times[spreadsheet_id] = modified_time
+        self.content_hashes[spreadsheet_id] = content_hashes
+        return changed
+
+    def poll(self) -> bool:
+        """Brings the outputs up to date, returns whether anything changed since the last poll."""
+        template_stamps = [SnapshotMemo.stamp(template) for template in self.templates]
+        templates_changed = template_stamps != self.template_stamps
+
+        keys = []
+        for template in self.templates:
+            keys.extend(cenv_url_keys(collect_template_cenv_urls(template, self.skip_comments)))
+        pairs = group_by_spreadsheet(dict.fromkeys(keys))
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        # the spreadsheets are polled concurrently
+        with ThreadPoolExecutor(max_workers=max(1, len(pairs))) as pool:
+            changes = list(pool.map(
+                lambda item: self.poll_spreadsheet(item[0], item[1], templates_changed), pairs.items()
+            ))
+
+        self.template_stamps = template_stamps
+        if not any(changes) and not templates_changed:
+            return False
+
+        memo = SnapshotMemo()
+        for template, output in zip(self.templates, self.outputs):
+            try:
+                self.write_if_changed(template, output, memo)
+            except (CenvError, OSError) as err:
+                print(f"{template}: {err}", file=sys.stderr)
+        return True
+
+    def write_if_changed(self, template: str, output: str, memo) -> bool:
+        with trace_span("template.render", template=template, output=output):
+            content = "".join(line + "\n" for line in render_template(template, self.skip_comments, memo=memo))
+        try:
+            with open(output, 'r') as f:
+                if f.read() == content:
+                    return False
+        except OSError:
+            pass
+
+        # an existing output keeps its permissions
+        mode = stat.S_IMODE(os.stat(output).st_mode) if os.path.exists(output) else None
+        with open_atomic(output, mode, text=True) as f:
+            f.write(content)
+        print(f"{template} injected to {output}.")
+        return True
+
+
+def watch_command(paths: list[str], skip_comments: bool, output_pattern: str | None = None,
+                  interval: float = 5, max_interval: float = 300):
+    """
+    Keeps the outputs of the templates up to date. The poll interval doubles while nothing changes,
+    up to the max interval, and is back to the interval after a change.
+    """
+    if is_offline():
+        raise CenvError("watch downloads the sheets, it can't run offline.")
+    templates = find_templates(paths)
+    if not templates:
+        raise CenvError(f"No {TEMPLATE_SUFFIX} files found.")
+    outputs = [template_output_path(template, output_pattern or DEFAULT_OUTPUT_PATTERN) for template in templates]
+
+    watcher = TemplateWatcher(templates, outputs, skip_comments)
+    delay = interval
+    while True:
+        try:
+            changed = watcher.poll()
+        except CenvError as err:
+            # e.g. the network is down, the outputs are kept until the next poll
+            print(err, file=sys.stderr)
+            changed = False
+        delay = interval if changed else min(max_interval, delay * 2)
+        time.sleep(delay)
+
+
+def unquote_env_value(value: str) -> str:
+    """Removes the quotes around a rendered value, like a .env parser would."""
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in "\"'":
+        return value[1:-1]
+    return value
+
+
+def resolve_template_env(template_paths: list[str], skip_comments: bool) -> dict[str, str]:
+    """
+    Renders the templates like inject does, in memory, and returns their variables.
+    The templates share their variables, a template can refer to the ones of the templates before it.
+    """
+    for template_path in template_paths:
+        if not os.path.exists(template_path):
+            raise FileNotFoundError(f"Template file '{template_path}' does not exist.")
+
+    # Download every referenced sheet before anything is resolved
+    prefetch_cenv_urls([url for template_path in template_paths
+                        for url in collect_template_cenv_urls(template_path, skip_comments)])
+
+    env_vars = {}
+    for template_path in template_paths:
+        with trace_span("template.render", template=template_path):
+            for _ in render_template(template_path, skip_comments, env_vars):
+                pass
+    return {key: unquote_env_value(value) for key, value in env_vars.items()}
+
+
+def run_with_env_command(template_paths: list[str], skip_comments: bool, command: list[str]):
+    """
+    Runs the command with the variables of the templates added to its environment,
+    nothing is written to disk. The command replaces the cenv process.
+    """
+    if command and command[0] == "--":
+        command = command[1:]
+    if not command:
+        raise CenvError("No command to run, expect: cenv run [-t TEMPLATE] -- COMMAND [ARGS...]")
+
+    env = {**os.environ, **resolve_template_env(template_paths, skip_comments)}
+
+    # exec skips the exit handlers
+    sys.stdout.flush()
+    sys.stderr.flush()
+    if tracer is not None and tracer.format == "chrome":
+        tracer.flush()
+
+    if platform.system() == "Windows":
+        # exec doesn't replace the process on Windows, the command's exit code is passed on instead
+        exit(subprocess.call(command, env=env))
+    try:
+        os.execvpe(command[0], command, env)
+    except OSError as err:
+        raise CenvError(f"Can't run '{command[0]}': {err.strerror}.")
 
 
 def check_requirements():
-    if configs.GOOGLE_CREDENTIAL_BASE64 is None and read_google_token_creds() is None:
+    # Only the presence of the user token is checked, it is loaded (and refreshed) when a sheet is downloaded
+    if is_offline():
+        pass
+    elif configs.GOOGLE_CREDENTIAL_BASE64 is None and not os.path.exists(configs.USER_TOKEN_FILE):
         raise ValueError(
             f"No auth. Use 'cenv login' or set {ENV_CENV_GOOGLE_CREDENTIAL_BASE64} environment variable or --google_credential_base64 parameter to use service account. Please, see help.")
-    if configs.GOOGLE_SHEET_ID is None:
+    if configs.GOOGLE_SHEET_ID is None and configs.BUNDLE is None:
         raise ValueError(
             f"{ENV_CENV_GOOGLE_SHEET_ID} environment variable or --google_sheet_id parameter is not set. Please, see help.")
     if configs.GOOGLE_SHEET_NAME is None:
@@ -725,6 +3217,13 @@ def token_generate_command():
     print(str_to_encode)
 
 
+def add_cache_arguments(parser):
+    parser.add_argument("--max-age", "--max_age", type=int, required=False,
+                        help=f"Seconds a stored snapshot stays fresh or use {ENV_CENV_MAX_AGE} environment variable, never expires by default")
+    parser.add_argument("--stale-while-revalidate", "--stale_while_revalidate", type=int, required=False,
+                        help=f"Seconds an expired snapshot is still served while it's revalidated in the background or use {ENV_CENV_STALE_WHILE_REVALIDATE} environment variable")
+
+
 def main():
     parser = argparse.ArgumentParser(
         description=f"""Manage and search Google Sheets data.
@@ -750,6 +3249,14 @@ def main():
                         help=f"Google Sheet name or use {ENV_CENV_GOOGLE_SHEET_NAME} environment variable, override {ENV_CENV_TOKEN}")
     parser.add_argument("--config_file", "--config-file", required=False,
                         help=f"Local file to save the Google Sheets data or use {ENV_CENV_STORE_CONFIG_FILE} environment variable, override {ENV_CENV_TOKEN}")
+    parser.add_argument("--bundle", required=False,
+                        help=f"Resolve values only from this bundle written by export-bundle or use {ENV_CENV_BUNDLE} environment variable")
+    parser.add_argument("--trace", required=False,
+                        help=f"Write timed spans of every phase to this file or use {ENV_CENV_TRACE} environment variable, in Chrome trace format for *.json files and as JSON lines otherwise")
+    parser.add_argument("--trace-format", "--trace_format", required=False, choices=TRACE_FORMATS,
+                        help=f"Format of the trace file or use {ENV_CENV_TRACE_FORMAT} environment variable")
+    parser.add_argument("--offline", action="store_true", required=False, default=False,
+                        help=f"Never download, resolve values from the stored snapshots or the bundle or use {ENV_CENV_OFFLINE}=1")
 
     subparsers = parser.add_subparsers(dest="command")
 
@@ -763,6 +3270,8 @@ def main():
 
     # Update command
     update_parser = subparsers.add_parser("update", help=f"Update {project_name} to the latest version")
+    update_parser.add_argument("--force", action='store_true', required=False, default=False,
+                               help="Download the latest version even when it's the installed one")
 
     # Login command
     login_parser = subparsers.add_parser("login", help="Authenticate with Google account")
@@ -772,8 +3281,13 @@ def main():
 
     # Load command
     load_parser = subparsers.add_parser("load", aliases=["l"], help="Load data from Google Sheets and save it locally")
-    load_parser.add_argument("--env", "-e", type=str, required=True, help="Environment to download")
+    load_parser.add_argument("--env", "-e", type=str, required=False,
+                             help="Environment to download, every env of the sheet when omitted")
     load_parser.add_argument("--sheet", "-s", type=str, required=True, help="Sheet name")
+    load_parser.add_argument("--revalidate", action='store_true', required=False, default=False,
+                             help="Only download the sheet when it changed since the stored snapshot")
+    load_parser.add_argument("--output", "-o", type=str, required=False,
+                             help="Also export the snapshot as JSON to this file")
 
     # Delete command
     delete_parser = subparsers.add_parser("delete", aliases=["d"], help="Delete the locally saved data")
@@ -784,17 +3298,74 @@ def main():
     find_parser.add_argument("--env", "-e", type=str, required=True, help="Environment column")
     find_parser.add_argument("--category", "-c", type=str, required=True, help="Category")
     find_parser.add_argument("--name", "-n", type=str, required=True, help="Name")
+    add_cache_arguments(find_parser)
 
     # Read command
     read_parser = subparsers.add_parser("read", aliases=["r"], help="Read value from Google Sheets using cenv URL")
     read_parser.add_argument("cenv_url", type=str, help="cenv URL in the format cenv://SHEET/ENV/CATEGORY/NAME")
+    add_cache_arguments(read_parser)
 
     # Inject command
     inject_parser = subparsers.add_parser("inject", aliases=["i"],
                                           help="Inject data from Google Sheets into a template file")
-    inject_parser.add_argument("template_path", type=str, help="Path to the template file")
+    inject_parser.add_argument("template_path", type=str, nargs="+",
+                               help=f"Path to the template file, or many templates and directories of *{TEMPLATE_SUFFIX} files")
     inject_parser.add_argument("--skip-comments", "-sc", action='store_true', required=False, default=False,
                                help="skip comments")
+    inject_parser.add_argument("--output", "-o", type=str, required=False,
+                               help="Write to this file, replaced atomically once the whole template is rendered, instead of stdout")
+    inject_parser.add_argument("--output-pattern", "--output_pattern", type=str, required=False,
+                               help=f"Output of each template of many, with {{dir}}, {{name}} and {{stem}} (name without {TEMPLATE_SUFFIX}), default: {DEFAULT_OUTPUT_PATTERN}")
+    inject_parser.add_argument("--jobs", "-j", type=int, required=False, default=4,
+                               help="Number of templates rendered concurrently")
+    add_cache_arguments(inject_parser)
+
+    # Watch command
+    watch_parser = subparsers.add_parser("watch",
+                                         help="Inject templates again whenever the sheets they refer to change")
+    watch_parser.add_argument("template_path", type=str, nargs="+",
+                              help=f"Templates and directories of *{TEMPLATE_SUFFIX} files")
+    watch_parser.add_argument("--skip-comments", "-sc", action='store_true', required=False, default=False,
+                              help="skip comments")
+    watch_parser.add_argument("--output-pattern", "--output_pattern", type=str, required=False,
+                              help=f"Output of each template, with {{dir}}, {{name}} and {{stem}} (name without {TEMPLATE_SUFFIX}), default: {DEFAULT_OUTPUT_PATTERN}")
+    watch_parser.add_argument("--interval", type=float, required=False, default=5,
+                              help="Seconds between polls after a change")
+    watch_parser.add_argument("--max-interval", "--max_interval", type=float, required=False, default=300,
+                              help="Seconds between polls once nothing changed for a while")
+
+    # Run command
+    run_parser = subparsers.add_parser("run", help="Run a command with the variables of a template in its environment")
+    run_parser.add_argument("--template", "-t", type=str, action="append", required=False,
+                            help=f"Template to resolve, can be repeated, default: {DEFAULT_RUN_TEMPLATE}")
+    run_parser.add_argument("--skip-comments", "-sc", action='store_true', required=False, default=False,
+                            help="skip comments")
+    run_parser.add_argument("--cache-only", "--cache_only", action='store_true', required=False, default=False,
+                            help="Resolve from the stored snapshots only, without any network access, like --offline")
+    run_parser.add_argument("cmd", nargs=argparse.REMAINDER, help="Command to run, after --")
+    add_cache_arguments(run_parser)
+
+    # Export command
+    export_parser = subparsers.add_parser("export", help="Write a file per env of a sheet from a single download")
+    export_parser.add_argument("--sheet", "-s", type=str, required=True, help="Sheet name")
+    export_parser.add_argument("--env", "-e", type=str, action="append", required=False,
+                               help="Env to export, can be repeated, every env of the sheet by default")
+    export_parser.add_argument("--format", "-f", type=str, required=False, choices=EXPORT_FORMATS, default="json",
+                               help="Format of the files, env writes CATEGORY_NAME=value lines")
+    export_parser.add_argument("--output-pattern", "--output_pattern", type=str, required=False,
+                               help=f"Output of each env, with {{sheet}}, {{env}} and {{ext}}, default: {DEFAULT_EXPORT_PATTERN}")
+
+    # Export bundle command
+    bundle_parser = subparsers.add_parser("export-bundle", help="Download sheets once into a bundle file for offline use")
+    bundle_parser.add_argument("pairs", type=str, nargs="*", help="SHEET/ENV pairs to bundle")
+    bundle_parser.add_argument("--template", "-t", type=str, action="append", default=[],
+                               help="Also bundle the sheets referenced by this template, can be repeated")
+    bundle_parser.add_argument("--output", "-o", type=str, required=True, help="Bundle file")
+
+    # Serve command
+    serve_parser = subparsers.add_parser("serve", help="Run a daemon answering get, read and inject lookups from memory")
+    serve_parser.add_argument("--socket", type=str, required=False,
+                              help=f"Unix socket path or use {ENV_CENV_SOCKET} environment variable")
 
     service_token_parser = subparsers.add_parser("token", help="Token commands")
     service_token_commands = service_token_parser.add_subparsers(dest="token_command", title="commands")
@@ -816,6 +3387,30 @@ def main():
 
     configs.CONFIG_FILE = normalize_path(configs.CONFIG_FILE)
 
+    if args.bundle:
+        configs.BUNDLE = normalize_path(args.bundle)
+    if args.command == "export-bundle":
+        # the bundle is written, not read
+        configs.BUNDLE = None
+    configs.OFFLINE = configs.OFFLINE or args.offline or getattr(args, "cache_only", False)
+
+    if getattr(args, "max_age", None) is not None:
+        configs.MAX_AGE = args.max_age
+    if getattr(args, "stale_while_revalidate", None) is not None:
+        configs.STALE_WHILE_REVALIDATE = args.stale_while_revalidate
+
+    configs.TRACE = args.trace or configs.TRACE
+    configs.TRACE_FORMAT = args.trace_format or configs.TRACE_FORMAT
+
+    try:
+        with trace_span("command", command=args.command):
+            run_command(args)
+    except CenvError as err:
+        print(err)
+        exit(1)
+
+
+def run_command(args):
     if args.command == "delete":
         delete_command()
     elif args.command == "status":
@@ -827,18 +3422,30 @@ def main():
     elif args.command == "logout":
         google_logout_command()
     elif args.command == "update":
-        update_cenv_command()
+        update_cenv_command(args.force)
     else:
         check_requirements()
 
         if args.command == "load":
-            load_command(sheet=args.sheet, env=args.env)
+            load_command(sheet=args.sheet, env=args.env, revalidate=args.revalidate, output=args.output)
         elif args.command == "get":
             get_command(sheet=args.sheet, env=args.env, category=args.category, name=args.name)
         elif args.command == "read":
             read_command(args.cenv_url)
         elif args.command == "inject":
-            inject_command(args.template_path, args.skip_comments)
+            inject_templates_command(args.template_path, args.skip_comments, args.output, args.output_pattern,
+                                     args.jobs)
+        elif args.command == "watch":
+            watch_command(args.template_path, args.skip_comments, args.output_pattern, args.interval,
+                          args.max_interval)
+        elif args.command == "run":
+            run_with_env_command(args.template or [DEFAULT_RUN_TEMPLATE], args.skip_comments, args.cmd)
+        elif args.command == "export":
+            export_command(args.sheet, args.env, args.format, args.output_pattern)
+        elif args.command == "export-bundle":
+            export_bundle_command(args.pairs, args.template, normalize_path(args.output))
+        elif args.command == "serve":
+            serve_command(normalize_path(args.socket or configs.SOCKET_FILE))
         elif args.command == "token":
             if args.token_command == "generate":
                 token_generate_command()
@@ -5,7 +5,7 @@ a = Analysis(
     ['cenv.py'],
     pathex=[],
     binaries=[],
-    datas=[('project.properties', '.'), ('client_secret.json', '.')],
+    datas=[('project.properties', '.'), ('client_secret.json', '.'), ('discovery/sheets.v4.json', 'discovery')],
     hiddenimports=[],
     hookspath=[],
     hooksconfig={},
@@ -0,0 +1,54 @@
+"""
+Writes the Sheets discovery document bundled with cenv (discovery/sheets.v4.json).
+
+The document shipped with google-api-python-client is trimmed to the methods cenv calls,
+so building the client involves neither a discovery request nor parsing the whole API.
+
+Usage: python scripts/discovery.py
+"""
+import json
+import os
+
+import googleapiclient
+
+METHODS = ["get", "batchGet"]
+SCHEMAS = ["ValueRange", "BatchGetValuesResponse"]
+
+
+def strip_descriptions(node):
+    if isinstance(node, dict):
+        return {key: strip_descriptions(value) for key, value in node.items()
+                if key not in ("description", "enumDescriptions")}
+    if isinstance(node, list):
+        return [strip_descriptions(item) for item in node]
+    return node
+
+
+def main():
+    source = os.path.join(os.path.dirname(googleapiclient.__file__), "discovery_cache", "documents", "sheets.v4.json")
+    with open(source, "r") as f:
+        document = json.load(f)
+
+    values_methods = document["resources"]["spreadsheets"]["resources"]["values"]["methods"]
+    document["resources"] = {
+        "spreadsheets": {
+            "resources": {
+                "values": {
+                    "methods": {name: values_methods[name] for name in METHODS}
+                }
+            }
+        }
+    }
+    document["schemas"] = {name: document["schemas"][name] for name in SCHEMAS}
+    document.pop("icons", None)
+    document = strip_descriptions(document)
+
+    target = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "discovery", "sheets.v4.json")
+    with open(target, "w") as f:
+        json.dump(document, f, indent=2, sort_keys=True)
+        f.write("\n")
+    print(f"{target} written, revision {document['revision']}.")
+
+
+if __name__ == "__main__":
+    main()
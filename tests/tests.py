@@ -1,7 +1,18 @@
 import unittest
 from io import StringIO
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
+import base64
+import datetime
+import hashlib
+import json
 import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import cenv
 from cenv import Token, configs
 
@@ -15,6 +26,39 @@ SAMPLE_SHEET_DATA = [
     ["Category", "Name", SAMPLE_ENV],
     [SAMPLE_CATEGORY, SAMPLE_NAME, SAMPLE_VALUE]
 ]
+SAMPLE_MULTI_ENV_SHEET_DATA = [
+    ["Category", "Name", SAMPLE_ENV, "Staging", "Production"],
+    [SAMPLE_CATEGORY, SAMPLE_NAME, SAMPLE_VALUE, "staging_value", "production_value"]
+]
+
+
+def load_sheets(sheet_data):
+    """Side effect for the mocked load_google_sheets returning the same data for every sheet."""
+    return lambda sheet_names, *args, **kwargs: {name: sheet_data for name in sheet_names}
+
+
+class RecordingHttp:
+    """Mocked HTTP client answering the requests with the responses in order and recording the requested ranges."""
+
+    def __init__(self, responses):
+        from googleapiclient.http import HttpMockSequence
+        self.http = HttpMockSequence([({"status": "200"}, json.dumps(response)) for response in responses])
+        self.ranges = []
+
+    def request(self, uri, *args, **kwargs):
+        from urllib.parse import parse_qs, urlparse
+        self.ranges.append(parse_qs(urlparse(uri).query).get("ranges"))
+        return self.http.request(uri, *args, **kwargs)
+
+
+class PatchedTestCase(unittest.TestCase):
+    """Test case patching cenv attributes, given by their dotted name, for the duration of each test."""
+
+    def patch_cenv(self, targets: dict):
+        for name, value in targets.items():
+            patcher = patch(f"cenv.{name}", value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
 
 
 class TestGoogleSheetProcessing(unittest.TestCase):
@@ -25,8 +69,9 @@ class TestGoogleSheetProcessing(unittest.TestCase):
         cenv.delete_file()
 
     @patch('sys.stdout', new_callable=StringIO)
+    @patch('cenv.load_google_sheets', side_effect=load_sheets(SAMPLE_SHEET_DATA))
     @patch('cenv.load_google_sheet', return_value=SAMPLE_SHEET_DATA)
-    def test_inject_command(self, mock_load_google_sheet, mock_stdout):
+    def test_inject_command(self, mock_load_google_sheet, mock_load_google_sheets, mock_stdout):
         file_path = "./tests/inject.template"
         if not os.path.exists(file_path):
             file_path = "./inject.template"
@@ -49,7 +94,8 @@ ENV_3=test_value""".strip())
     def test_load_command(self, mock_load_google_sheet, mock_stdout):
         cenv.load_command("SHEET_NAME", SAMPLE_ENV)
         printed_output = mock_stdout.getvalue().strip()
-        self.assertEqual(printed_output, f"Data loaded and saved to {cenv.configs.CONFIG_FILE}.")
+        path = cenv.snapshot_store().entry_path(configs.GOOGLE_SHEET_ID, "SHEET_NAME", SAMPLE_ENV)
+        self.assertEqual(printed_output, f"Data loaded and saved to {path}.")
         cenv.delete_file()
 
     @patch('sys.stdout', new_callable=StringIO)
@@ -76,6 +122,235 @@ ENV_3=test_value""".strip())
         self.assertEqual(printed_output, SAMPLE_VALUE)
         cenv.delete_file()
 
+    @patch('cenv.load_google_sheet', return_value=SAMPLE_MULTI_ENV_SHEET_DATA)
+    def test_snapshot_store_keeps_envs_side_by_side(self, mock_load_google_sheet):
+        self.assertEqual(cenv.load_value("SHEET_NAME", "Staging", SAMPLE_CATEGORY, SAMPLE_NAME), "staging_value")
+        self.assertEqual(cenv.load_value("SHEET_NAME", "Production", SAMPLE_CATEGORY, SAMPLE_NAME), "production_value")
+        self.assertEqual(cenv.load_value("SHEET_NAME", "Staging", SAMPLE_CATEGORY, SAMPLE_NAME), "staging_value")
+        self.assertEqual(cenv.load_value("SHEET_NAME", "Production", SAMPLE_CATEGORY, SAMPLE_NAME), "production_value")
+        self.assertEqual(mock_load_google_sheet.call_count, 2)
+        cenv.delete_file()
+
+    @patch('cenv.load_google_sheet', return_value=SAMPLE_MULTI_ENV_SHEET_DATA)
+    def test_snapshot_store_evicts_least_recently_used(self, mock_load_google_sheet):
+        store = cenv.SnapshotStore(configs.CONFIG_FILE + ".d", 2, configs.STORE_MAX_BYTES)
+        with patch('cenv.snapshot_store', return_value=store):
+            cenv.load_file_and_save("SHEET_NAME", "Staging")
+            cenv.load_file_and_save("SHEET_NAME", "Production")
+            os.utime(store.entry_path(configs.GOOGLE_SHEET_ID, "SHEET_NAME", "Staging"), ns=(0, 0))
+            cenv.load_file_and_save("SHEET_NAME", SAMPLE_ENV)
+
+            self.assertIsNone(store.read(configs.GOOGLE_SHEET_ID, "SHEET_NAME", "Staging"))
+            self.assertIsNotNone(store.read(configs.GOOGLE_SHEET_ID, "SHEET_NAME", "Production"))
+            self.assertIsNotNone(store.read(configs.GOOGLE_SHEET_ID, "SHEET_NAME", SAMPLE_ENV))
+        cenv.delete_file()
+
+    def test_snapshot_store_evicts_header_rows(self):
+        store = cenv.SnapshotStore(tempfile.mkdtemp(), 2, configs.STORE_MAX_BYTES)
+        store.write_header(configs.GOOGLE_SHEET_ID, "OTHER_SHEET", ["Category", "Name", "Staging"])
+        self.assertEqual(store.read_header(configs.GOOGLE_SHEET_ID, "OTHER_SHEET"), ["Category", "Name", "Staging"])
+        os.utime(store.header_path(configs.GOOGLE_SHEET_ID, "OTHER_SHEET"), ns=(0, 0))
+
+        store.write(cenv.sheet_to_map(SAMPLE_MULTI_ENV_SHEET_DATA, "SHEET_NAME", "Staging"))
+        store.write(cenv.sheet_to_map(SAMPLE_MULTI_ENV_SHEET_DATA, "SHEET_NAME", "Production"))
+        self.assertIsNone(store.read_header(configs.GOOGLE_SHEET_ID, "OTHER_SHEET"))
+
+    @patch('sys.stdout', new_callable=StringIO)
+    @patch('cenv.load_google_sheets', side_effect=load_sheets(SAMPLE_MULTI_ENV_SHEET_DATA))
+    @patch('cenv.load_google_sheet', return_value=SAMPLE_MULTI_ENV_SHEET_DATA)
+    def test_inject_prefetches_in_one_batch(self, mock_load_google_sheet, mock_load_google_sheets, mock_stdout):
+        template_path = os.path.join(tempfile.mkdtemp(), "batch.template")
+        with open(template_path, "w") as f:
+            f.write(f"""SHEET=SHEET_NAME
+STAGING=cenv://$SHEET/Staging/{SAMPLE_CATEGORY}/{SAMPLE_NAME}
+PRODUCTION=cenv://${{SHEET}}/Production/{SAMPLE_CATEGORY}/{SAMPLE_NAME}
+OTHER=cenv://OTHER_SHEET/Staging/{SAMPLE_CATEGORY}/{SAMPLE_NAME}
+""")
+        cenv.inject_command(template_path, False)
+        self.assertEqual(mock_stdout.getvalue().strip(), """SHEET=SHEET_NAME
+STAGING=staging_value
+PRODUCTION=production_value
+OTHER=staging_value""")
+        mock_load_google_sheets.assert_called_once_with(
+            ["OTHER_SHEET", "SHEET_NAME"], configs.GOOGLE_SHEET_ID,
+            envs={"OTHER_SHEET": {"Staging"}, "SHEET_NAME": {"Staging", "Production"}}
+        )
+        mock_load_google_sheet.assert_not_called()
+        cenv.delete_file()
+
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_inject_from_many_spreadsheets(self, mock_stdout):
+        cenv.delete_file()
+        self.addCleanup(cenv.delete_file)
+        infra_sheet_data = [["Category", "Name", "Staging"], [SAMPLE_CATEGORY, SAMPLE_NAME, "infra_value"]]
+        # both spreadsheets have to be downloaded at the same time to get through the barrier
+        barrier = threading.Barrier(2, timeout=5)
+
+        def load_google_sheets(sheet_names, spreadsheet_id=None, envs=None):
+            barrier.wait()
+            data = infra_sheet_data if spreadsheet_id == "infra_sheet_id" else SAMPLE_MULTI_ENV_SHEET_DATA
+            return {name: data for name in sheet_names}
+
+        template_path = os.path.join(tempfile.mkdtemp(), "spreadsheets.template")
+        with open(template_path, "w") as f:
+            f.write(f"""APP=cenv://SHEET_NAME/Staging/{SAMPLE_CATEGORY}/{SAMPLE_NAME}
+INFRA=cenv://infra@SHEET_NAME/Staging/{SAMPLE_CATEGORY}/{SAMPLE_NAME}
+""")
+        with patch.object(configs, "SPREADSHEETS", {"infra": "infra_sheet_id"}), \
+                patch('cenv.load_google_sheets', side_effect=load_google_sheets) as mock_load_google_sheets:
+            self.assertEqual(cenv.parse_cenv_url("cenv://infra@Env/Staging/Database/Url"),
+                             ("infra_sheet_id", "Env", "Staging", "Database", "Url"))
+            other_id = "1AbCdEfGhIjKlMnOpQrStUvWxYz0123456789_-AbCdE"
+            self.assertEqual(cenv.parse_cenv_url(f"cenv://{other_id}@Env/Staging/Database/Url")[0], other_id)
+            # sheet names containing '@' are kept, '@' escapes the ones looking like a spreadsheet
+            self.assertEqual(cenv.parse_cenv_url("cenv://team@prod/Staging/Database/Url")[:2],
+                             (configs.GOOGLE_SHEET_ID, "team@prod"))
+            self.assertEqual(cenv.parse_cenv_url("cenv://@infra@prod/Staging/Database/Url")[:2],
+                             (configs.GOOGLE_SHEET_ID, "infra@prod"))
+            cenv.inject_command(template_path, False)
+
+        self.assertEqual(mock_stdout.getvalue(), "APP=staging_value\nINFRA=infra_value\n")
+        self.assertEqual(mock_load_google_sheets.call_count, 2)
+
+    @patch('sys.stderr', new_callable=StringIO)
+    def test_login_missing_a_scope_is_reported(self, mock_stderr):
+        import httplib2
+        import pickle
+        from google.oauth2.credentials import Credentials
+
+        with patch.object(configs, "USER_TOKEN_FILE", os.path.join(tempfile.mkdtemp(), ".token")):
+            with open(configs.USER_TOKEN_FILE, "wb") as token:
+                pickle.dump(Credentials(token="token", scopes=configs.SCOPES), token)
+            cenv.read_google_token_creds()
+            self.assertEqual(mock_stderr.getvalue(), "")
+
+            with open(configs.USER_TOKEN_FILE, "wb") as token:
+                pickle.dump(Credentials(token="token", scopes=configs.SCOPES[:1]), token)
+            cenv.read_google_token_creds()
+            self.assertIn("cenv login", mock_stderr.getvalue())
+
+        # a missing scope is answered by a 403, transport errors aren't hidden
+        http = MagicMock()
+        http.request.return_value = (httplib2.Response({"status": "403"}), b"{}")
+        with patch('cenv.authorized_http', return_value=http):
+            self.assertIsNone(cenv.fetch_spreadsheet_modified_time())
+            http.request.side_effect = httplib2.ServerNotFoundError("no network")
+            with self.assertRaises(cenv.CenvFetchError):
+                cenv.fetch_spreadsheet_modified_time()
+
+    @patch('cenv.fetch_spreadsheet_modified_time', return_value="2024-01-01T00:00:00.000Z")
+    @patch('cenv.load_google_sheet', return_value=SAMPLE_SHEET_DATA)
+    def test_expired_snapshot_is_revalidated(self, mock_load_google_sheet, mock_modified_time):
+        def expire():
+            data = cenv.get_file_content("SHEET_NAME", SAMPLE_ENV)
+            cenv.save_to_file({**data, "__FETCHED_AT__": 0})
+
+        with patch.object(configs, "MAX_AGE", 60):
+            cenv.load_value("SHEET_NAME", SAMPLE_ENV, SAMPLE_CATEGORY, SAMPLE_NAME)
+            cenv.load_value("SHEET_NAME", SAMPLE_ENV, SAMPLE_CATEGORY, SAMPLE_NAME)
+            self.assertEqual(mock_load_google_sheet.call_count, 1)
+
+            # no modifiedTime is known yet, the content hash shows nothing changed
+            expire()
+            with patch('cenv.sheet_to_map', wraps=cenv.sheet_to_map) as mock_sheet_to_map:
+                self.assertEqual(cenv.load_value("SHEET_NAME", SAMPLE_ENV, SAMPLE_CATEGORY, SAMPLE_NAME), SAMPLE_VALUE)
+                mock_sheet_to_map.assert_not_called()
+            self.assertEqual(mock_load_google_sheet.call_count, 2)
+
+            # the unchanged modifiedTime spares the download
+            expire()
+            self.assertEqual(cenv.load_value("SHEET_NAME", SAMPLE_ENV, SAMPLE_CATEGORY, SAMPLE_NAME), SAMPLE_VALUE)
+            self.assertEqual(mock_load_google_sheet.call_count, 2)
+
+            # a changed modifiedTime downloads the sheet again
+            expire()
+            mock_modified_time.return_value = "2024-01-02T00:00:00.000Z"
+            mock_load_google_sheet.return_value = [SAMPLE_SHEET_DATA[0], [SAMPLE_CATEGORY, SAMPLE_NAME, "new_value"]]
+            self.assertEqual(cenv.load_value("SHEET_NAME", SAMPLE_ENV, SAMPLE_CATEGORY, SAMPLE_NAME), "new_value")
+            self.assertEqual(mock_load_google_sheet.call_count, 3)
+        cenv.delete_file()
+
+    @patch('cenv.revalidate_in_background')
+    @patch('cenv.load_google_sheet', return_value=SAMPLE_SHEET_DATA)
+    def test_stale_snapshot_is_served_while_revalidated(self, mock_load_google_sheet, mock_revalidate):
+        cenv.load_file_and_save("SHEET_NAME", SAMPLE_ENV)
+        data = cenv.get_file_content("SHEET_NAME", SAMPLE_ENV)
+        cenv.save_to_file({**data, "__FETCHED_AT__": data["__FETCHED_AT__"] - 90})
+
+        with patch.object(configs, "MAX_AGE", 60), patch.object(configs, "STALE_WHILE_REVALIDATE", 60):
+            self.assertEqual(cenv.load_value("SHEET_NAME", SAMPLE_ENV, SAMPLE_CATEGORY, SAMPLE_NAME), SAMPLE_VALUE)
+        mock_revalidate.assert_called_once_with("SHEET_NAME", SAMPLE_ENV, configs.GOOGLE_SHEET_ID)
+        self.assertEqual(mock_load_google_sheet.call_count, 1)
+        cenv.delete_file()
+
+    @patch('sys.stdout', new_callable=StringIO)
+    @patch('cenv.load_google_sheets', side_effect=load_sheets(SAMPLE_SHEET_DATA))
+    def test_inject_streams_lines(self, mock_load_google_sheets, mock_stdout):
+        template_path = os.path.join(tempfile.mkdtemp(), "stream.template")
+        with open(template_path, "w") as f:
+            f.write(f"FIRST=first\nSECOND=cenv://SHEET_NAME/{SAMPLE_ENV}/{SAMPLE_CATEGORY}/{SAMPLE_NAME}\n")
+
+        def read_cenv_url(url, memo=None):
+            # the previous lines are already written when a value is resolved
+            self.assertEqual(mock_stdout.getvalue(), "FIRST=first\n")
+            return SAMPLE_VALUE
+
+        with patch('cenv.read_cenv_url', side_effect=read_cenv_url):
+            cenv.inject_command(template_path, False)
+        self.assertEqual(mock_stdout.getvalue(), f"FIRST=first\nSECOND={SAMPLE_VALUE}\n")
+        cenv.delete_file()
+
+    @patch('cenv.load_google_sheets', side_effect=load_sheets(SAMPLE_SHEET_DATA))
+    def test_inject_output_is_replaced_atomically(self, mock_load_google_sheets):
+        directory = tempfile.mkdtemp()
+        template_path = os.path.join(directory, "output.template")
+        output = os.path.join(directory, ".env")
+        with open(output, "w") as f:
+            f.write("PREVIOUS=1\n")
+        os.chmod(output, 0o600)
+
+        with open(template_path, "w") as f:
+            f.write(f"VALUE=cenv://SHEET_NAME/{SAMPLE_ENV}/{SAMPLE_CATEGORY}/{SAMPLE_NAME}\nFAIL=${{MISSING:?missing}}\n")
+        with self.assertRaises(ValueError):
+            cenv.inject_command(template_path, False, output)
+        with open(output) as f:
+            self.assertEqual(f.read(), "PREVIOUS=1\n")
+
+        with open(template_path, "w") as f:
+            f.write(f"VALUE=cenv://SHEET_NAME/{SAMPLE_ENV}/{SAMPLE_CATEGORY}/{SAMPLE_NAME}\n")
+        cenv.inject_command(template_path, False, output)
+        with open(output) as f:
+            self.assertEqual(f.read(), f"VALUE={SAMPLE_VALUE}\n")
+        self.assertEqual(os.stat(output).st_mode & 0o777, 0o600)
+        self.assertEqual(sorted(os.listdir(directory)), [".env", "output.template"])
+        cenv.delete_file()
+
+    @patch('sys.stdout', new_callable=StringIO)
+    @patch('cenv.load_google_sheets', side_effect=load_sheets(SAMPLE_MULTI_ENV_SHEET_DATA))
+    def test_inject_many_templates(self, mock_load_google_sheets, mock_stdout):
+        cenv.delete_file()
+        directory = tempfile.mkdtemp()
+        for service, env in [("api", "Staging"), ("web", "Production"), ("worker", "Staging")]:
+            os.makedirs(os.path.join(directory, service))
+            with open(os.path.join(directory, service, ".env.template"), "w") as f:
+                f.write(f"SERVICE={service}\nVALUE=cenv://SHEET_NAME/{env}/{SAMPLE_CATEGORY}/{SAMPLE_NAME}\n")
+
+        with patch('cenv.load_snapshot', wraps=cenv.load_snapshot) as mock_load_snapshot:
+            cenv.inject_templates_command([directory], False, jobs=3)
+        # every sheet is downloaded in one batch and each snapshot is read once
+        mock_load_google_sheets.assert_called_once_with(["SHEET_NAME"], configs.GOOGLE_SHEET_ID,
+                                                        envs={"SHEET_NAME": {"Staging", "Production"}})
+        self.assertEqual(mock_load_snapshot.call_count, 2)
+
+        for service, value in [("api", "staging_value"), ("web", "production_value"), ("worker", "staging_value")]:
+            with open(os.path.join(directory, service, ".env")) as f:
+                self.assertEqual(f.read(), f"SERVICE={service}\nVALUE={value}\n")
+
+        cenv.inject_templates_command([os.path.join(directory, "api", ".env.template")], False,
+                                      output_pattern="{dir}/{stem}.local", jobs=1)
+        self.assertTrue(os.path.exists(os.path.join(directory, "api", ".env.local")))
+        cenv.delete_file()
+
     @patch('sys.stdout', new_callable=StringIO)
     def test_token_encode_decode(self, mock_stdout):
         token = Token(
@@ -97,5 +372,970 @@ ENV_3=test_value""".strip())
         self.assertEqual(printed_output, encoded)
 
 
+class TestSheetsClient(PatchedTestCase):
+
+    def setUp(self):
+        self.patch_cenv({
+            "sheets_service": None,
+            "configs.GOOGLE_SHEET_ID": SAMPLE_GOOGLE_SHEET_ID,
+            "configs.RATE_LIMIT_FILE": os.path.join(tempfile.mkdtemp(), "rate_limit.json"),
+        })
+
+    def mock_http(self, *responses):
+        from googleapiclient.http import HttpMockSequence
+        http = HttpMockSequence([({"status": "200"}, json.dumps(response)) for response in responses])
+        patcher = patch('cenv.authorized_http', return_value=http)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return http
+
+    def test_client_is_built_once_from_bundled_discovery(self):
+        self.mock_http()
+        with patch('googleapiclient.discovery.build') as mock_build:
+            service = cenv.get_sheets_service()
+            self.assertIs(cenv.get_sheets_service(), service)
+            mock_build.assert_not_called()
+
+    def test_requests_share_the_client(self):
+        http = self.mock_http(
+            {"range": "SHEET_NAME!A1:C2", "values": SAMPLE_SHEET_DATA},
+            {"valueRanges": [{"values": SAMPLE_SHEET_DATA}, {"values": SAMPLE_MULTI_ENV_SHEET_DATA}]},
+        )
+        self.assertEqual(cenv.load_google_sheet("SHEET_NAME"), SAMPLE_SHEET_DATA)
+        self.assertEqual(cenv.load_google_sheets(["SHEET_NAME", "OTHER_SHEET"]), {
+            "SHEET_NAME": SAMPLE_SHEET_DATA,
+            "OTHER_SHEET": SAMPLE_MULTI_ENV_SHEET_DATA
+        })
+        # both requests went through the same connection
+        self.assertEqual(http._iterable, [])
+
+    def test_columns_are_projected(self):
+        headers = {"valueRanges": [{"values": [SAMPLE_MULTI_ENV_SHEET_DATA[0]]}]}
+        projected = {"valueRanges": [
+            {"values": [["Category", "Name"], [SAMPLE_CATEGORY, SAMPLE_NAME], [SAMPLE_CATEGORY, "empty"]]},
+            {"values": [["Production"], ["production_value"]]},
+        ]}
+        http = RecordingHttp([headers, projected, projected])
+        with patch('cenv.authorized_http', return_value=http):
+            rows = cenv.load_google_sheet("SHEET_NAME", ["Production"])
+            self.assertEqual(cenv.load_google_sheet("SHEET_NAME", ["Production"]), rows)
+        self.addCleanup(cenv.delete_file)
+
+        self.assertEqual(rows, [
+            ["Category", "Name", "Production"],
+            [SAMPLE_CATEGORY, SAMPLE_NAME, "production_value"],
+            [SAMPLE_CATEGORY, "empty"],
+        ])
+        self.assertEqual(cenv.sheet_to_map(rows, "SHEET_NAME", "Production")[SAMPLE_CATEGORY],
+                         {SAMPLE_NAME: "production_value"})
+        # the header is downloaded once, then only the columns A:B and E (Production)
+        self.assertEqual(http.ranges, [
+            ["'SHEET_NAME'!1:1"],
+            ["'SHEET_NAME'!A:B", "'SHEET_NAME'!E:E"],
+            ["'SHEET_NAME'!A:B", "'SHEET_NAME'!E:E"],
+        ])
+
+    def test_moved_columns_are_located_again(self):
+        snapshot_store = cenv.snapshot_store()
+        snapshot_store.write_header(configs.GOOGLE_SHEET_ID, "SHEET_NAME", ["Category", "Name", "Production"])
+        self.addCleanup(cenv.delete_file)
+        http = RecordingHttp([
+            {"valueRanges": [{"values": [["Category", "Name"]]}, {"values": [["Staging"]]}]},
+            {"valueRanges": [{"values": [SAMPLE_MULTI_ENV_SHEET_DATA[0]]}]},
+            {"valueRanges": [{"values": [["Category", "Name"]]}, {"values": [["Production"]]}]},
+        ])
+        with patch('cenv.authorized_http', return_value=http):
+            self.assertEqual(cenv.load_google_sheet("SHEET_NAME", ["Production"]), [["Category", "Name", "Production"]])
+        self.assertEqual(http.ranges[-1], ["'SHEET_NAME'!A:B", "'SHEET_NAME'!E:E"])
+
+
+class TestRequestScheduler(PatchedTestCase):
+
+    def setUp(self):
+        self.patch_cenv({
+            "sheets_service": None,
+            "configs.GOOGLE_SHEET_ID": SAMPLE_GOOGLE_SHEET_ID,
+            "configs.RATE_LIMIT_FILE": os.path.join(tempfile.mkdtemp(), "rate_limit.json"),
+            "configs.RATE_LIMIT": 60,
+            "configs.MAX_RETRIES": 2,
+        })
+
+    def execute(self, *responses):
+        from googleapiclient.http import HttpMockSequence
+        http = HttpMockSequence(list(responses))
+        with patch('cenv.authorized_http', return_value=http):
+            return cenv.load_google_sheet("SHEET_NAME")
+
+    @patch('time.sleep')
+    def test_retries_with_retry_after(self, mock_sleep):
+        rows = self.execute(
+            ({"status": "429", "retry-after": "7"}, "{}"),
+            ({"status": "503"}, "{}"),
+            ({"status": "200"}, json.dumps({"values": SAMPLE_SHEET_DATA})),
+        )
+        self.assertEqual(rows, SAMPLE_SHEET_DATA)
+        # Retry-After is honored, and the shared budget is held empty for those seconds
+        self.assertEqual(mock_sleep.call_args_list[0].args[0], 7)
+        with open(configs.RATE_LIMIT_FILE) as f:
+            self.assertLess(json.load(f)["tokens"], -5)
+
+    @patch('time.sleep')
+    def test_gives_up(self, mock_sleep):
+        with self.assertRaises(cenv.CenvFetchError):
+            self.execute(*[({"status": "500"}, "{}")] * 3)
+        with self.assertRaises(cenv.CenvFetchError):
+            self.execute(({"status": "404"}, "{}"), ({"status": "200"}, "{}"))
+
+    @patch('time.sleep')
+    def test_transport_errors_are_retried(self, mock_sleep):
+        import httplib2
+        from googleapiclient.http import HttpMockSequence
+
+        def flaky_http(*failures):
+            http = HttpMockSequence([({"status": "200"}, json.dumps({"values": SAMPLE_SHEET_DATA}))])
+            failures = list(failures)
+            request = http.request
+
+            def flaky_request(*args, **kwargs):
+                if failures:
+                    raise failures.pop(0)
+                return request(*args, **kwargs)
+            http.request = flaky_request
+            return http
+
+        http = flaky_http(httplib2.ServerNotFoundError("no network"), ConnectionResetError())
+        with patch('cenv.authorized_http', return_value=http):
+            self.assertEqual(cenv.load_google_sheet("SHEET_NAME"), SAMPLE_SHEET_DATA)
+
+        http = flaky_http(*[httplib2.ServerNotFoundError("no network")] * 3)
+        with patch('cenv.authorized_http', return_value=http):
+            with self.assertRaises(cenv.CenvFetchError) as context:
+                cenv.load_google_sheet("SHEET_NAME")
+        self.assertIsInstance(context.exception.__cause__, httplib2.ServerNotFoundError)
+
+    @patch('time.sleep')
+    def test_budget_is_shared(self, mock_sleep):
+        with patch.object(configs, "RATE_LIMIT", 2):
+            cenv.wait_for_request_budget()
+            cenv.wait_for_request_budget()
+            mock_sleep.assert_not_called()
+            # the bucket is stored in the rate limit file, so the next process borrows the third token too
+            cenv.wait_for_request_budget()
+        self.assertAlmostEqual(mock_sleep.call_args.args[0], 30, delta=1)
+        with open(configs.RATE_LIMIT_FILE) as f:
+            self.assertLess(json.load(f)["tokens"], 0)
+
+        # without CENV_RATE_LIMIT the requests don't touch the rate limit file
+        os.remove(configs.RATE_LIMIT_FILE)
+        with patch.object(configs, "RATE_LIMIT", 0):
+            cenv.wait_for_request_budget()
+        self.assertFalse(os.path.exists(configs.RATE_LIMIT_FILE))
+
+    def test_retry_after_date(self):
+        date = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=30)
+        self.assertAlmostEqual(cenv.parse_retry_after(date.strftime("%a, %d %b %Y %H:%M:%S GMT")), 30, delta=2)
+        self.assertIsNone(cenv.parse_retry_after("soon"))
+
+
+class TestAccessTokenCache(PatchedTestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.patch_cenv({
+            "google_credentials": None,
+            "configs.USER_TOKEN_FILE": os.path.join(directory, ".token"),
+            "configs.ACCESS_TOKEN_FILE": os.path.join(directory, "access_tokens.json"),
+        })
+
+    @staticmethod
+    def refresh(creds, request):
+        creds.token = f"token-{time.monotonic_ns()}"
+        creds.expiry = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None) + datetime.timedelta(hours=1)
+
+    def test_service_account_token_is_reused(self):
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048).private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+        service_account = {
+            "type": "service_account",
+            "client_email": "cenv@test.iam.gserviceaccount.com",
+            "private_key_id": "key_id",
+            "private_key": private_key.decode(),
+            "token_uri": "https://oauth2.googleapis.com/token",
+        }
+        credential_base64 = base64.b64encode(json.dumps(service_account).encode()).decode()
+
+        with patch.object(configs, "GOOGLE_CREDENTIAL_BASE64", credential_base64), \
+                patch('google.oauth2.service_account.Credentials.refresh', autospec=True,
+                      side_effect=self.refresh) as mock_refresh:
+            token = cenv.get_google_credentials().token
+            cenv.google_credentials = None
+            self.assertEqual(cenv.get_google_credentials().token, token)
+            mock_refresh.assert_called_once()
+
+            # another scope gets another token
+            cenv.google_credentials = None
+            with patch.object(configs, "SCOPES", configs.SCOPES[:1]):
+                self.assertNotEqual(cenv.get_google_credentials().token, token)
+            self.assertEqual(mock_refresh.call_count, 2)
+
+    def test_concurrent_saves_keep_every_token(self):
+        expiry = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None) + datetime.timedelta(hours=1)
+        threads = [
+            threading.Thread(target=cenv.save_cached_access_token, args=(MagicMock(token=f"token-{i}", expiry=expiry),
+                                                                          f"key-{i}"))
+            for i in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(set(cenv.read_access_token_cache()), {f"key-{i}" for i in range(8)})
+
+    def test_refreshed_user_token_is_saved(self):
+        from google.oauth2.credentials import Credentials
+
+        creds = Credentials(token="expired", refresh_token="refresh", expiry=datetime.datetime(2000, 1, 1))
+        cenv.save_google_token_creds(creds)
+
+        with patch('google.oauth2.credentials.Credentials.refresh', autospec=True,
+                   side_effect=self.refresh) as mock_refresh:
+            token = cenv.read_google_token_creds().token
+            self.assertEqual(cenv.read_google_token_creds().token, token)
+            mock_refresh.assert_called_once()
+
+
+class TestBinarySnapshot(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch.object(configs, "STORE_FORMAT", "binary")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(cenv.delete_file)
+
+    @patch('cenv.load_google_sheet', return_value=SAMPLE_MULTI_ENV_SHEET_DATA)
+    def test_lookups(self, mock_load_google_sheet):
+        self.assertEqual(cenv.load_value("SHEET_NAME", "Staging", SAMPLE_CATEGORY, SAMPLE_NAME), "staging_value")
+        self.assertEqual(cenv.load_value("SHEET_NAME", "Staging", SAMPLE_CATEGORY, SAMPLE_NAME), "staging_value")
+        mock_load_google_sheet.assert_called_once()
+
+        data = cenv.get_file_content("SHEET_NAME", "Staging")
+        self.assertIsInstance(data, cenv.BinarySnapshot)
+        self.assertEqual(data["__ENV__"], "Staging")
+        with self.assertRaises(cenv.CenvError):
+            cenv.get_value(data, "unknown_category", SAMPLE_NAME)
+        with self.assertRaises(cenv.CenvError):
+            cenv.get_value(data, SAMPLE_CATEGORY, "unknown_name")
+
+    def test_round_trip(self):
+        rows = [["Category", "Name", "Env"]]
+        rows += [[f"Category{i % 37}", f"Name{i}", f"value {i} ✓"] for i in range(2000)]
+        rows += [["Category1", "", ""], ["Category1", "Empty", ""]]
+        data = cenv.sheet_to_map(rows, "SHEET_NAME", "Env")
+
+        path = cenv.save_to_file(data)
+        self.assertTrue(path.endswith(".snap"))
+        snapshot = cenv.get_file_content("SHEET_NAME", "Env")
+        self.assertEqual(snapshot.to_dict(), data)
+        for category, values in data.items():
+            if isinstance(values, dict):
+                for name, value in values.items():
+                    self.assertEqual(snapshot[category][name], value)
+
+    @patch('cenv.load_google_sheet', return_value=SAMPLE_SHEET_DATA)
+    def test_export_as_json(self, mock_load_google_sheet):
+        output = os.path.join(tempfile.mkdtemp(), "snapshot.json")
+        with patch('sys.stdout', new_callable=StringIO):
+            cenv.load_command("SHEET_NAME", SAMPLE_ENV, output=output)
+        with open(output) as f:
+            self.assertEqual(json.load(f)[SAMPLE_CATEGORY], {SAMPLE_NAME: SAMPLE_VALUE})
+
+
+class TestSheetIndex(unittest.TestCase):
+
+    def setUp(self):
+        cenv.delete_file()
+        self.addCleanup(cenv.delete_file)
+
+    def test_matches_sheet_to_map(self):
+        rows = [["Category", "Name", "Dev", "Staging", "Production", "Dev"]]
+        rows += [[f"Category{i % 7}", f"Name{i % 50}", f"dev {i}", "shared", f"prod {i % 3}", "ignored"][:3 + i % 4]
+                 for i in range(300)]
+        rows += [["", "Orphan", "x", "y", "z"], ["Category1"], ["Category8", "Short", "dev only"]]
+        index = cenv.SheetIndex.build(rows, "SHEET_NAME", configs.GOOGLE_SHEET_ID)
+
+        self.assertEqual(index.envs, ["Dev", "Staging", "Production"])
+        for env in index.envs:
+            self.assertEqual(index.snapshot(env).to_dict(), cenv.sheet_to_map(rows, "SHEET_NAME", env))
+        self.assertNotIn("Category8", index.snapshot("Staging"))
+        self.assertIsNone(index.snapshot("Unknown"))
+        # values shared by the envs are stored once
+        self.assertEqual(index.values.count("shared"), 1)
+
+    @patch('cenv.load_google_sheet', return_value=SAMPLE_MULTI_ENV_SHEET_DATA)
+    def test_load_every_env(self, mock_load_google_sheet):
+        output = os.path.join(tempfile.mkdtemp(), "index.json")
+        with patch('sys.stdout', new_callable=StringIO):
+            cenv.load_command("SHEET_NAME", output=output)
+        mock_load_google_sheet.assert_called_once_with("SHEET_NAME")
+
+        self.assertEqual(cenv.load_value("SHEET_NAME", "Staging", SAMPLE_CATEGORY, SAMPLE_NAME), "staging_value")
+        self.assertEqual(cenv.load_value("SHEET_NAME", "Production", SAMPLE_CATEGORY, SAMPLE_NAME),
+                         "production_value")
+        mock_load_google_sheet.assert_called_once()
+        with self.assertRaises(cenv.CenvNotFoundError):
+            cenv.load_value("SHEET_NAME", "Staging", SAMPLE_CATEGORY, "unknown_name")
+
+        with open(output) as f:
+            exported = json.load(f)
+        self.assertEqual(exported["__ENVS__"]["Production"][SAMPLE_CATEGORY], {SAMPLE_NAME: "production_value"})
+
+    @patch('sys.stdout', new_callable=StringIO)
+    @patch('cenv.fetch_spreadsheet_modified_time', return_value=None)
+    @patch('cenv.load_google_sheet', return_value=SAMPLE_MULTI_ENV_SHEET_DATA)
+    def test_index_views_are_written_as_json(self, mock_load_google_sheet, mock_modified_time, mock_stdout):
+        cenv.load_command("SHEET_NAME")
+        directory = tempfile.mkdtemp()
+
+        bundle = os.path.join(directory, "bundle.cenv")
+        cenv.export_bundle_command(["SHEET_NAME/Staging"], [], bundle)
+        snapshot, = cenv.read_bundle(bundle).values()
+        self.assertEqual(snapshot[SAMPLE_CATEGORY], {SAMPLE_NAME: "staging_value"})
+
+        output = os.path.join(directory, "production.json")
+        cenv.load_command("SHEET_NAME", "Production", revalidate=True, output=output)
+        with open(output) as f:
+            self.assertEqual(json.load(f)[SAMPLE_CATEGORY], {SAMPLE_NAME: "production_value"})
+
+    def test_round_trip(self):
+        rows = [["Category", "Name", "A", "B"]]
+        rows += [[f"Category{i % 11}", f"Name{i}", f"a {i} ✓", f"b {i % 5}"] for i in range(1000)]
+        index = cenv.SheetIndex.build(rows, "SHEET_NAME", configs.GOOGLE_SHEET_ID)
+        cenv.stamp_snapshot(index.meta, rows)
+
+        store = cenv.snapshot_store()
+        store.write_index(index)
+        stored = store.read_index(configs.GOOGLE_SHEET_ID, "SHEET_NAME")
+        self.assertEqual(stored.to_dict(), index.to_dict())
+        self.assertIsNone(store.read_index(configs.GOOGLE_SHEET_ID, "OTHER_SHEET"))
+
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_export_every_env(self, mock_stdout):
+        rows = [
+            ["Category", "Name", "Dev", "Staging", "Production"],
+            ["Database", "Url", "postgres://dev", "postgres://staging", "postgres://production"],
+            ["Database", "Password", "it's \"quoted\"", "with spaces", "line\nbreak"],
+            ["Cache", "Ttl", "60"],
+        ]
+        directory = tempfile.mkdtemp()
+        pattern = os.path.join(directory, "{sheet}.{env}.{ext}")
+        with patch('cenv.load_google_sheet', return_value=rows) as mock_load_google_sheet:
+            cenv.export_command("SHEET_NAME", None, "env", pattern)
+            mock_load_google_sheet.assert_called_once_with("SHEET_NAME")
+
+            from dotenv import dotenv_values
+            self.assertEqual(dict(dotenv_values(os.path.join(directory, "SHEET_NAME.Dev.env"))), {
+                "DATABASE_URL": "postgres://dev",
+                "DATABASE_PASSWORD": "it's \"quoted\"",
+                "CACHE_TTL": "60"
+            })
+            self.assertEqual(dotenv_values(os.path.join(directory, "SHEET_NAME.Production.env"))["DATABASE_PASSWORD"],
+                             "line\nbreak")
+            # the whole sheet was downloaded, its index serves the lookups
+            self.assertEqual(cenv.load_value("SHEET_NAME", "Staging", "Database", "Password"), "with spaces")
+            mock_load_google_sheet.assert_called_once()
+
+        with patch('cenv.load_google_sheet', return_value=[[*row[:2], *row[4:]] for row in rows]):
+            cenv.export_command("SHEET_NAME", ["Production"], "yaml", pattern)
+            import yaml
+            with open(os.path.join(directory, "SHEET_NAME.Production.yaml")) as f:
+                self.assertEqual(yaml.safe_load(f), {"Database": {"Url": "postgres://production",
+                                                                  "Password": "line\nbreak"}})
+            with self.assertRaises(cenv.CenvNotFoundError):
+                cenv.export_command("SHEET_NAME", ["Unknown"], "json", pattern)
+
+
+class TestConcurrency(unittest.TestCase):
+
+    def setUp(self):
+        cenv.delete_file()
+        self.addCleanup(cenv.delete_file)
+
+    def test_single_flight(self):
+        def slow_load_google_sheet(sheet_name, envs=None, spreadsheet_id=None):
+            time.sleep(0.2)
+            return SAMPLE_SHEET_DATA
+
+        results = []
+        with patch('cenv.load_google_sheet', side_effect=slow_load_google_sheet) as mock_load_google_sheet:
+            threads = [
+                threading.Thread(target=lambda: results.append(
+                    cenv.load_value("SHEET_NAME", SAMPLE_ENV, SAMPLE_CATEGORY, SAMPLE_NAME)))
+                for _ in range(8)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        mock_load_google_sheet.assert_called_once()
+        self.assertEqual(results, [SAMPLE_VALUE] * 8)
+
+    @patch('cenv.load_google_sheets', side_effect=load_sheets(SAMPLE_SHEET_DATA))
+    def test_lock_files_are_bounded(self, mock_load_google_sheets):
+        # more keys than lock files, the keys sharing one take it once
+        cenv.prefetch_snapshots([(f"SHEET_{i}", SAMPLE_ENV) for i in range(200)])
+        mock_load_google_sheets.assert_called_once()
+        locks = os.path.join(cenv.snapshot_store().directory, ".locks")
+        self.assertLessEqual(len(os.listdir(locks)), cenv.SnapshotStore.LOCK_STRIPES)
+
+    @patch('cenv.load_google_sheet', return_value=SAMPLE_SHEET_DATA)
+    def test_snapshot_is_parsed_once_per_process(self, mock_load_google_sheet):
+        cenv.load_value("SHEET_NAME", SAMPLE_ENV, SAMPLE_CATEGORY, SAMPLE_NAME)
+        with patch('cenv.get_file_content', wraps=cenv.get_file_content) as mock_get_file_content:
+            for _ in range(5):
+                self.assertEqual(cenv.load_value("SHEET_NAME", SAMPLE_ENV, SAMPLE_CATEGORY, SAMPLE_NAME), SAMPLE_VALUE)
+            mock_get_file_content.assert_not_called()
+
+            # another process rewrites the snapshot
+            data = cenv.sheet_to_map(SAMPLE_SHEET_DATA, "SHEET_NAME", SAMPLE_ENV)
+            cenv.save_to_file({**data, SAMPLE_CATEGORY: {SAMPLE_NAME: "new_value"}})
+            self.assertEqual(cenv.load_value("SHEET_NAME", SAMPLE_ENV, SAMPLE_CATEGORY, SAMPLE_NAME), "new_value")
+            self.assertEqual(mock_get_file_content.call_count, 1)
+
+    def test_failed_write_keeps_snapshot(self):
+        data = cenv.sheet_to_map(SAMPLE_SHEET_DATA, "SHEET_NAME", SAMPLE_ENV)
+        path = cenv.save_to_file(data)
+        with patch('json.dump', side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                cenv.save_to_file({**data, SAMPLE_CATEGORY: {SAMPLE_NAME: "new_value"}})
+
+        self.assertEqual(cenv.get_file_content("SHEET_NAME", SAMPLE_ENV)[SAMPLE_CATEGORY][SAMPLE_NAME], SAMPLE_VALUE)
+        self.assertEqual([name for name in os.listdir(os.path.dirname(path)) if name.endswith(".tmp")], [])
+
+
+@unittest.skipUnless(hasattr(socket, "AF_UNIX"), "Unix domain sockets are not supported")
+class TestDaemon(unittest.TestCase):
+
+    def setUp(self):
+        socket_path = os.path.join(tempfile.mkdtemp(), "cenv.sock")
+        patcher = patch.object(configs, "SOCKET_FILE", socket_path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.server = cenv.create_daemon_server(socket_path)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.addCleanup(cenv.delete_file)
+
+    def test_ping(self):
+        self.assertEqual(cenv.daemon_request({"op": "ping"})["version"], cenv.project_version)
+
+    @patch('cenv.load_google_sheet', return_value=SAMPLE_SHEET_DATA)
+    def test_lookups_are_served_from_memory(self, mock_load_google_sheet):
+        url = f"cenv://SHEET_NAME/{SAMPLE_ENV}/{SAMPLE_CATEGORY}/{SAMPLE_NAME}"
+        with patch('cenv.get_file_content', wraps=cenv.get_file_content) as mock_get_file_content:
+            self.assertEqual(cenv.read_cenv_url(url), SAMPLE_VALUE)
+            reads = mock_get_file_content.call_count
+            self.assertEqual(cenv.read_cenv_url(url), SAMPLE_VALUE)
+            self.assertEqual(mock_get_file_content.call_count, reads)
+        mock_load_google_sheet.assert_called_once()
+
+        with self.assertRaises(cenv.CenvNotFoundError):
+            cenv.load_value("SHEET_NAME", SAMPLE_ENV, SAMPLE_CATEGORY, "unknown_name")
+
+    def test_concurrent_misses_load_once(self):
+        data = cenv.sheet_to_map(SAMPLE_SHEET_DATA, "SHEET_NAME", SAMPLE_ENV)
+
+        def slow_load_snapshot(*args):
+            time.sleep(0.1)
+            return data
+
+        memo = cenv.SnapshotMemo()
+        with patch('cenv.load_snapshot', side_effect=slow_load_snapshot) as mock_load_snapshot:
+            threads = [threading.Thread(target=memo.get, args=("SHEET_NAME", SAMPLE_ENV)) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        mock_load_snapshot.assert_called_once()
+
+    @patch('cenv.load_google_sheet', return_value=SAMPLE_SHEET_DATA)
+    def test_falls_back_without_daemon(self, mock_load_google_sheet):
+        with patch.object(configs, "SOCKET_FILE", configs.SOCKET_FILE + ".missing"):
+            self.assertEqual(cenv.load_value("SHEET_NAME", SAMPLE_ENV, SAMPLE_CATEGORY, SAMPLE_NAME), SAMPLE_VALUE)
+
+        # clients configured with another store or other credentials are served in-process
+        request = {"op": "get", "sheet": "SHEET_NAME", "env": SAMPLE_ENV, "category": SAMPLE_CATEGORY,
+                   "name": SAMPLE_NAME}
+        self.assertEqual(cenv.daemon_request(request)["value"], SAMPLE_VALUE)
+        for name in ["sheet_id", "store", "credential"]:
+            self.assertIsNone(cenv.daemon_request({**request, name: "other"}), name)
+
+
+class TestClient(unittest.TestCase):
+
+    def setUp(self):
+        cenv.delete_file()
+        self.addCleanup(cenv.delete_file)
+
+    @patch('cenv.load_google_sheets', side_effect=load_sheets(SAMPLE_MULTI_ENV_SHEET_DATA))
+    def test_resolve_many(self, mock_load_google_sheets):
+        import asyncio
+
+        client = cenv.CenvClient()
+        urls = [
+            f"cenv://SHEET_NAME/Staging/{SAMPLE_CATEGORY}/{SAMPLE_NAME}",
+            f"cenv://SHEET_NAME/Production/{SAMPLE_CATEGORY}/{SAMPLE_NAME}",
+            f"cenv://OTHER_SHEET/Staging/{SAMPLE_CATEGORY}/{SAMPLE_NAME}",
+        ]
+        values = asyncio.run(client.resolve_many(urls))
+        self.assertEqual(values, dict(zip(urls, ["staging_value", "production_value", "staging_value"])))
+        mock_load_google_sheets.assert_called_once()
+
+        # the snapshots are shared by the following calls
+        with patch('cenv.load_snapshot') as mock_load_snapshot:
+            self.assertEqual(asyncio.run(client.resolve_many(urls[:1])), {urls[0]: "staging_value"})
+            self.assertEqual(client.resolve(urls[1]), "production_value")
+            mock_load_snapshot.assert_not_called()
+
+        with self.assertRaises(cenv.CenvNotFoundError):
+            asyncio.run(client.resolve_many([f"cenv://SHEET_NAME/Staging/{SAMPLE_CATEGORY}/unknown_name"]))
+        with self.assertRaises(cenv.CenvURLError):
+            asyncio.run(client.resolve_many(["cenv://SHEET_NAME/Staging"]))
+
+    @patch('cenv.load_google_sheets', side_effect=load_sheets(SAMPLE_MULTI_ENV_SHEET_DATA))
+    def test_errors_are_raised(self, mock_load_google_sheets):
+        import asyncio
+
+        client = cenv.CenvClient()
+        with self.assertRaises(cenv.CenvNotFoundError):
+            client.resolve(f"cenv://SHEET_NAME/Unknown/{SAMPLE_CATEGORY}/{SAMPLE_NAME}")
+        with self.assertRaises(cenv.CenvNotFoundError):
+            asyncio.run(client.resolve_many([f"cenv://SHEET_NAME/Unknown/{SAMPLE_CATEGORY}/{SAMPLE_NAME}"]))
+
+        for url in [f"cenv://SHEET_NAME/Staging//{SAMPLE_NAME}", f"cenv://SHEET_NAME/Staging/{SAMPLE_CATEGORY}/"]:
+            with self.assertRaises(cenv.CenvURLError):
+                client.resolve(url)
+            with self.assertRaises(cenv.CenvURLError):
+                asyncio.run(client.resolve_many([url]))
+
+
+class TestWatch(unittest.TestCase):
+
+    def setUp(self):
+        cenv.delete_file()
+        self.addCleanup(cenv.delete_file)
+        self.directory = tempfile.mkdtemp()
+        self.template = os.path.join(self.directory, ".env.template")
+        self.output = os.path.join(self.directory, ".env")
+        with open(self.template, "w") as f:
+            f.write(f"VALUE=cenv://SHEET_NAME/Staging/{SAMPLE_CATEGORY}/{SAMPLE_NAME}\n")
+
+    @patch('sys.stdout', new_callable=StringIO)
+    @patch('cenv.load_google_sheets', side_effect=load_sheets(SAMPLE_MULTI_ENV_SHEET_DATA))
+    @patch('cenv.fetch_spreadsheet_modified_time', return_value="2024-01-01T00:00:00Z")
+    def test_outputs_follow_changes(self, mock_modified_time, mock_load_google_sheets, mock_stdout):
+        watcher = cenv.TemplateWatcher([self.template], [self.output], False)
+        self.assertTrue(watcher.poll())
+        with open(self.output) as f:
+            self.assertEqual(f.read(), "VALUE=staging_value\n")
+
+        # nothing is downloaded while the modifiedTime stays the same
+        self.assertFalse(watcher.poll())
+        mock_load_google_sheets.assert_called_once()
+
+        # a change elsewhere in the spreadsheet is downloaded, but the output isn't rewritten
+        mock_modified_time.return_value = "2024-01-02T00:00:00Z"
+        inode = os.stat(self.output).st_ino
+        watcher.poll()
+        self.assertEqual(os.stat(self.output).st_ino, inode)
+        self.assertEqual(mock_load_google_sheets.call_count, 2)
+
+        changed = [row.copy() for row in SAMPLE_MULTI_ENV_SHEET_DATA]
+        changed[1][3] = "new_staging_value"
+        mock_load_google_sheets.side_effect = load_sheets(changed)
+        mock_modified_time.return_value = "2024-01-03T00:00:00Z"
+        self.assertTrue(watcher.poll())
+        with open(self.output) as f:
+            self.assertEqual(f.read(), "VALUE=new_staging_value\n")
+
+
+class FakeResponse:
+    """Stand-in for a requests response."""
+
+    def __init__(self, status_code, payload=None, content=b"", headers=None):
+        self.status_code = status_code
+        self.payload = payload
+        self.content = content
+        self.headers = headers or {}
+
+    def json(self):
+        return self.payload
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(f"HTTP {self.status_code}")
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class TestUpdate(PatchedTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.patch_cenv({
+            "update_install_dir": self.directory,
+            "configs.RELEASE_CACHE_FILE": os.path.join(self.directory, "latest_release.json"),
+        })
+
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_current_version_is_not_downloaded(self, mock_stdout):
+        release = {"tag_name": f"v{cenv.project_version}", "assets": [
+            {"name": cenv.update_filename, "browser_download_url": "https://example.com/cenv"}
+        ]}
+        with patch('requests.get', return_value=FakeResponse(200, release, headers={"ETag": '"v1"'})) as mock_get:
+            cenv.update_cenv_command()
+        mock_get.assert_called_once()
+
+        # the unchanged release is answered by a 304 and read from the cache
+        with patch('requests.get', return_value=FakeResponse(304)) as mock_get:
+            cenv.update_cenv_command()
+        self.assertEqual(mock_get.call_args.kwargs["headers"]["If-None-Match"], '"v1"')
+        self.assertIn("is already the latest version", mock_stdout.getvalue())
+        self.assertTrue(cenv.parse_version("v1.10.0") > cenv.parse_version("1.9.3"))
+
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_download_is_resumed_and_verified(self, mock_stdout):
+        binary = os.urandom(3 * cenv.UPDATE_CHUNK_SIZE + 123)
+        digest = hashlib.sha256(binary).hexdigest()
+        path = os.path.join(self.directory, "cenv.new")
+        with open(path, "wb") as f:
+            f.write(binary[:cenv.UPDATE_CHUNK_SIZE])
+
+        with patch('requests.get', return_value=FakeResponse(206, content=binary[cenv.UPDATE_CHUNK_SIZE:])) as mock_get:
+            cenv.update_download_binary("https://example.com/cenv", path, digest)
+        self.assertEqual(mock_get.call_args.kwargs["headers"], {"Range": f"bytes={cenv.UPDATE_CHUNK_SIZE}-"})
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), binary)
+
+        os.remove(path)
+        with patch('requests.get', return_value=FakeResponse(200, content=binary[1:])):
+            with self.assertRaises(cenv.CenvError):
+                cenv.update_download_binary("https://example.com/cenv", path, digest)
+        self.assertFalse(os.path.exists(path))
+
+        # a partial file can't be verified without a sha256, so it isn't resumed
+        with open(path, "wb") as f:
+            f.write(os.urandom(cenv.UPDATE_CHUNK_SIZE))
+        with patch('requests.get', return_value=FakeResponse(200, content=binary)) as mock_get:
+            cenv.update_download_binary("https://example.com/cenv", path)
+        self.assertEqual(mock_get.call_args.kwargs["headers"], {})
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), binary)
+
+
+class TestBundle(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.bundle = os.path.join(self.directory, "sheets.cenvbundle")
+        cenv.delete_file()
+        self.addCleanup(cenv.delete_file)
+        self.addCleanup(cenv.loaded_bundles.clear)
+
+    @patch('sys.stdout', new_callable=StringIO)
+    @patch('cenv.load_google_sheets', side_effect=load_sheets(SAMPLE_MULTI_ENV_SHEET_DATA))
+    def test_export_and_resolve_offline(self, mock_load_google_sheets, mock_stdout):
+        template_path = os.path.join(self.directory, "bundle.template")
+        with open(template_path, "w") as f:
+            f.write(f"VALUE=cenv://OTHER_SHEET/Production/{SAMPLE_CATEGORY}/{SAMPLE_NAME}\n")
+
+        cenv.export_bundle_command(["SHEET_NAME/Staging", "SHEET_NAME/Production"], [template_path], self.bundle)
+        mock_load_google_sheets.assert_called_once()
+        cenv.delete_file()
+
+        with patch.object(configs, "BUNDLE", self.bundle), patch.object(configs, "GOOGLE_SHEET_ID", None):
+            self.assertEqual(cenv.read_cenv_url(f"cenv://SHEET_NAME/Staging/{SAMPLE_CATEGORY}/{SAMPLE_NAME}"),
+                             "staging_value")
+            self.assertEqual(cenv.load_value("OTHER_SHEET", "Production", SAMPLE_CATEGORY, SAMPLE_NAME),
+                             "production_value")
+            with self.assertRaises(cenv.CenvNotFoundError):
+                cenv.load_value("SHEET_NAME", SAMPLE_ENV, SAMPLE_CATEGORY, SAMPLE_NAME)
+        mock_load_google_sheets.assert_called_once()
+        self.assertEqual(sorted(os.listdir(self.directory)), ["bundle.template", "sheets.cenvbundle"])
+
+    def test_corrupted_bundle_is_rejected(self):
+        snapshot = cenv.sheet_to_map(SAMPLE_SHEET_DATA, "SHEET_NAME", SAMPLE_ENV)
+        cenv.write_bundle(self.bundle, [snapshot])
+        with open(self.bundle, "r+b") as f:
+            f.seek(-1, os.SEEK_END)
+            last = f.read(1)
+            f.seek(-1, os.SEEK_END)
+            f.write(bytes([last[0] ^ 1]))
+
+        with self.assertRaisesRegex(cenv.CenvError, "corrupted"):
+            cenv.read_bundle(self.bundle)
+
+    def test_offline_read_does_not_import_network_stacks(self):
+        snapshot = cenv.sheet_to_map(SAMPLE_SHEET_DATA, "SHEET_NAME", SAMPLE_ENV)
+        cenv.write_bundle(self.bundle, [snapshot])
+
+        code = f"""
+import sys
+sys.argv = ["cenv", "read", "cenv://SHEET_NAME/{SAMPLE_ENV}/{SAMPLE_CATEGORY}/{SAMPLE_NAME}"]
+import cenv
+cenv.main()
+print(",".join(sorted({{name.split(".")[0] for name in sys.modules}} & set({TestStartup.HEAVY_MODULES!r}))))
+"""
+        env = {key: value for key, value in os.environ.items() if not key.startswith("CENV_")}
+        env.update({"CENV_BUNDLE": self.bundle, "HOME": self.directory})
+        result = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(cenv.__file__)))
+        self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+        self.assertEqual(result.stdout.splitlines(), [SAMPLE_VALUE, ""])
+
+
+class TestTracing(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        patcher = patch.object(cenv, "tracer", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        cenv.delete_file()
+        self.addCleanup(cenv.delete_file)
+
+    @patch('cenv.load_google_sheet', return_value=SAMPLE_SHEET_DATA)
+    def test_json_lines(self, mock_load_google_sheet):
+        trace = os.path.join(self.directory, "trace.jsonl")
+        with patch.object(configs, "TRACE", trace):
+            cenv.load_value("SHEET_NAME", SAMPLE_ENV, SAMPLE_CATEGORY, SAMPLE_NAME)
+            with self.assertRaises(cenv.CenvNotFoundError):
+                cenv.load_value("SHEET_NAME", SAMPLE_ENV, SAMPLE_CATEGORY, "unknown_name")
+
+        with open(trace) as f:
+            spans = [json.loads(line) for line in f]
+        self.assertEqual([span["name"] for span in spans],
+                         ["store.read", "store.read_index", "store.read", "store.read_index", "sheet_to_map",
+                          "store.write", "lookup", "lookup"])
+        self.assertEqual(spans[0]["attributes"], {"sheet": "SHEET_NAME", "env": SAMPLE_ENV, "hit": False})
+        self.assertEqual(spans[4]["attributes"]["rows"], 2)
+        self.assertGreater(spans[5]["attributes"]["bytes"], 0)
+        self.assertEqual(spans[7]["attributes"]["source"], "memo")
+        self.assertEqual(spans[7]["attributes"]["error"], "CenvNotFoundError")
+        self.assertTrue(all(span["duration_ms"] >= 0 for span in spans))
+
+    def test_chrome_trace(self):
+        trace = os.path.join(self.directory, "trace.json")
+        with patch.object(configs, "TRACE", trace), patch('atexit.register'):
+            cenv.sheet_to_map(SAMPLE_SHEET_DATA, "SHEET_NAME", SAMPLE_ENV)
+            cenv.tracer.flush()
+
+        with open(trace) as f:
+            events = json.load(f)["traceEvents"]
+        self.assertEqual([(event["name"], event["ph"]) for event in events], [("sheet_to_map", "X")])
+        self.assertEqual(events[0]["args"], {"sheet": "SHEET_NAME", "env": SAMPLE_ENV, "rows": 2})
+
+    def test_disabled(self):
+        cenv.sheet_to_map(SAMPLE_SHEET_DATA, "SHEET_NAME", SAMPLE_ENV)
+        self.assertIsNone(cenv.tracer)
+
+
+# The regular expression stripping inline comments before the template engine was compiled
+LEGACY_COMMENT_PATTERN = re.compile(r'(?<!\\)(["\'].*?["\']|[^"\']*?)(?<!\\) #.*$')
+TEMPLATE_FUZZ_ALPHABET = ['a', 'B', '_', '$', '{', '}', ':', '-', '?', '"', "'", '#', ' ', '\\', '=', '/',
+                          ' #', '${', '$A', '$B', ':-', ':?', 'cenv://']
+
+
+def legacy_render(text, skip_comments, env_vars):
+    """Renders the template text the way inject did with the per-line regular expressions."""
+    lines = []
+    try:
+        for line in text.splitlines():
+            stripped_line = line.strip()
+            is_comment = stripped_line.startswith(("#", "//", ";", '"', "'", "/*", "="))
+            if skip_comments:
+                stripped_line = LEGACY_COMMENT_PATTERN.sub(r'\1', stripped_line).strip()
+            if skip_comments and is_comment:
+                continue
+            if not is_comment and "=" in stripped_line:
+                key, value = LEGACY_COMMENT_PATTERN.sub(r'\1', stripped_line).strip().split("=", 1)
+                value = cenv.resolve_value(env_vars, value.strip())
+                if cenv.is_cenv_value(value):
+                    url, has_q = cenv.unquote_cenv_value(value)
+                    value = f'"resolved:{url}"' if has_q else "resolved:" + url
+                env_vars[key.strip()] = value
+                lines.append(f"{key.strip()}={value}")
+            else:
+                lines.append(stripped_line)
+    except ValueError as err:
+        # the unpacking of an assignment whose '=' is in a comment, reported as a CenvTemplateError
+        broken = str(err).startswith("not enough values to unpack")
+        lines.append(("error", "broken assignment" if broken else str(err)))
+    return lines
+
+
+class TestTemplateEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        file_path = "./tests/inject.template"
+        if not os.path.exists(file_path):
+            file_path = "./inject.template"
+        with open(file_path) as f:
+            self.template = f.read()
+
+    def render(self, text, skip_comments, env_vars):
+        template_path = os.path.join(self.directory, "fuzz.template")
+        with open(template_path, "w") as f:
+            f.write(text)
+        lines = []
+        with patch('cenv.read_cenv_url', side_effect=lambda url, memo=None: "resolved:" + url):
+            try:
+                lines.extend(cenv.render_template(template_path, skip_comments, env_vars))
+            except cenv.CenvTemplateError:
+                lines.append(("error", "broken assignment"))
+            except ValueError as err:
+                lines.append(("error", str(err)))
+        return lines
+
+    def assert_renders_like_legacy(self, text, env_vars=None):
+        for skip_comments in (False, True):
+            self.assertEqual(self.render(text, skip_comments, dict(env_vars or {})),
+                             legacy_render(text, skip_comments, dict(env_vars or {})), (text, skip_comments))
+
+    @patch.dict(os.environ, {"B": "environment_b"})
+    def test_matches_legacy_render(self):
+        import random
+
+        self.assert_renders_like_legacy(self.template)
+
+        rnd = random.Random(42)
+        lines = self.template.splitlines()
+        for _ in range(1000):
+            # mutate a line of inject.template and append random assignments
+            mutated = list(lines)
+            index = rnd.randrange(len(mutated))
+            position = rnd.randint(0, len(mutated[index]))
+            noise = "".join(rnd.choice(TEMPLATE_FUZZ_ALPHABET) for _ in range(rnd.randint(1, 8)))
+            mutated[index] = mutated[index][:position] + noise + mutated[index][position:]
+            for _ in range(rnd.randint(0, 3)):
+                value = "".join(rnd.choice(TEMPLATE_FUZZ_ALPHABET) for _ in range(rnd.randint(0, 24)))
+                mutated.append(rnd.choice(["A", "B", "C"]) + "=" + value)
+            env_vars = {"A": rnd.choice(["", "a", '"q"', "'s'", "x}", "$B", "{"])}
+            self.assert_renders_like_legacy("\n".join(mutated) + "\n", env_vars)
+
+    def test_strip_inline_comment(self):
+        for line in ['A=1 # comment', 'A="1 # quoted" # comment', "A='1' # c", 'A=1 \\# escaped',
+                     'A="1 # unterminated', 'A=" # "\\" # c', '  #', '" #"" #']:
+            self.assertEqual(cenv.strip_inline_comment(line), LEGACY_COMMENT_PATTERN.sub(r'\1', line).strip(), line)
+
+        # the regular expression backtracks quadratically on this line
+        line = "x" + ' \\#"' * 20000
+        self.assertEqual(cenv.strip_inline_comment(line), line)
+
+    def test_broken_assignment_names_the_line(self):
+        template_path = os.path.join(self.directory, "broken.template")
+        with open(template_path, "w") as f:
+            f.write("A=1\nB # comment=1\n")
+        with self.assertRaisesRegex(cenv.CenvTemplateError, "line 2: .*'B # comment=1'"):
+            list(cenv.render_template(template_path, False))
+
+    def test_repeated_renders_skip_parsing(self):
+        template_path = os.path.join(self.directory, "cached.template")
+        with open(template_path, "w") as f:
+            f.write("A=1\nB=$A\n")
+        with patch('cenv.compile_template_text', wraps=cenv.compile_template_text) as mock_compile:
+            self.assertEqual(list(cenv.render_template(template_path, False)), ["A=1", "B=1"])
+            self.assertEqual(list(cenv.render_template(template_path, False)), ["A=1", "B=1"])
+            self.assertEqual(mock_compile.call_count, 1)
+
+            with open(template_path, "w") as f:
+                f.write("A=2\nB=$A\n")
+            self.assertEqual(list(cenv.render_template(template_path, False)), ["A=2", "B=2"])
+            self.assertEqual(mock_compile.call_count, 2)
+
+
+class CommandLineTestCase(unittest.TestCase):
+    """Runs the cenv script in a subprocess, with the sample sheet stored."""
+
+    def setUp(self):
+        patcher = patch.object(configs, "GOOGLE_SHEET_ID", SAMPLE_GOOGLE_SHEET_ID)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        cenv.save_to_file(cenv.sheet_to_map(SAMPLE_SHEET_DATA, "SHEET_NAME", SAMPLE_ENV))
+        self.addCleanup(cenv.delete_file)
+
+        self.env = {
+            **os.environ,
+            "CENV_GOOGLE_CREDENTIAL_BASE64": "e30=",
+            "CENV_GOOGLE_SHEET_ID": SAMPLE_GOOGLE_SHEET_ID,
+            "CENV_STORE_CONFIG_FILE": os.path.abspath(configs.CONFIG_FILE),
+        }
+        self.script = os.path.join(os.path.dirname(os.path.abspath(cenv.__file__)), "cenv.py")
+
+    def run_cenv(self, *args):
+        return subprocess.run([sys.executable, self.script, *args], env=self.env, capture_output=True, text=True)
+
+
+class TestStartup(CommandLineTestCase):
+    """The cache-hit get/read path must not import the network stacks and must fit the startup budget."""
+    BUDGET_SECONDS = float(os.getenv("CENV_STARTUP_BUDGET_MS", "500")) / 1000
+    HEAVY_MODULES = ["googleapiclient", "google_auth_oauthlib", "google", "httplib2", "requests", "yaml"]
+
+    def test_cache_hit_does_not_import_network_stacks(self):
+        code = f"""
+import sys
+sys.argv = ["cenv", "read", "cenv://SHEET_NAME/{SAMPLE_ENV}/{SAMPLE_CATEGORY}/{SAMPLE_NAME}"]
+import cenv
+cenv.main()
+print(",".join(sorted({{name.split(".")[0] for name in sys.modules}} & set({self.HEAVY_MODULES!r}))))
+"""
+        result = subprocess.run([sys.executable, "-c", code], env=self.env, capture_output=True, text=True,
+                                cwd=os.path.dirname(self.script))
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.splitlines(), [SAMPLE_VALUE, ""])
+
+    def test_cache_hit_startup_budget(self):
+        timings = []
+        for _ in range(3):
+            start = time.perf_counter()
+            result = self.run_cenv("get", "--sheet", "SHEET_NAME", "--env", SAMPLE_ENV,
+                                   "--category", SAMPLE_CATEGORY, "--name", SAMPLE_NAME)
+            timings.append(time.perf_counter() - start)
+            self.assertEqual(result.stdout.strip(), SAMPLE_VALUE, result.stderr)
+        self.assertLess(min(timings), self.BUDGET_SECONDS)
+
+
+class TestRun(CommandLineTestCase):
+
+    def test_run_execs_with_the_template_env(self):
+        template_path = os.path.join(tempfile.mkdtemp(), ".env.template")
+        with open(template_path, "w") as f:
+            f.write(f"""NAME="cenv"
+VALUE=cenv://SHEET_NAME/{SAMPLE_ENV}/{SAMPLE_CATEGORY}/{SAMPLE_NAME}
+""")
+        code = "import os; print(os.environ['NAME'], os.environ['VALUE'], os.environ['CENV_STORE_CONFIG_FILE'] != '')"
+        result = self.run_cenv("run", "--cache-only", "-t", template_path, "--", sys.executable, "-c", code)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip(), f"cenv {SAMPLE_VALUE} True")
+
+        result = self.run_cenv("run", "--cache-only", "-t", template_path, "--", sys.executable, "-c",
+                               "import sys; sys.exit(3)")
+        self.assertEqual(result.returncode, 3)
+
+
 if __name__ == "__main__":
     unittest.main()